@@ -0,0 +1,308 @@
+"""Load generator and fan-out latency benchmark for the chat server.
+
+Run from the project directory, for example:
+
+    python -m bench.chat_bench --clients 2000 --channels 20 --rate 2000
+
+The benchmark starts server.py (unless --no-server is given), connects the
+simulated clients from several processes, makes the senders publish at the
+target rate and measures the latency of every delivery from the send
+timestamp carried in the message text."""
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import resource
+import selectors
+import signal
+import socket
+import subprocess
+import sys
+import time
+from array import array
+
+from src.protocol import CDProto, CDProtoBadFormat, CDProtoDecoder
+
+SERVER_HOST = "127.0.0.1"
+
+# Seconds given to the last messages to reach their receivers
+DRAIN = 1.0
+
+
+def positive_int(value: str) -> int:
+    """argparse type of the counts that must be at least 1."""
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"{value} is not a positive integer")
+    return number
+
+
+def channel_layout(clients: int, channels: int, layout: str, seed: int) -> list[str]:
+    """Channel joined by each client."""
+    rand = random.Random(seed)
+    names = [f"#bench{i}" for i in range(channels)]
+
+    if layout == "single":
+        return [names[0]] * clients
+    if layout == "skewed":
+        # Zipf like: the first channels gather most of the members
+        weights = [1 / (i + 1) for i in range(channels)]
+        return rand.choices(names, weights, k=clients)
+    return [names[i % channels] for i in range(clients)]
+
+
+def client_worker(worker: int, address: tuple, channels: list[str], senders: int, rate: float,
+                  duration: float, version: int, barrier, results):
+    """Run a share of the simulated clients and report their latencies.
+
+    Sockets stay blocking: messages are sent whole with sendall, the time
+    the server makes the senders wait is reported, and the selector only
+    reads from the sockets with data. Clients closed by the server are
+    counted and stop sending."""
+    sel = selectors.DefaultSelector()
+    clients = []
+    for i, channel in enumerate(channels):
+        sock = socket.create_connection(address)
+        register = CDProto.register(f"bench{worker}-{i}", version)
+        sock.sendall(CDProto.encode(register, min(version, CDProto.VERSION)))
+        if version >= CDProto.BINARY_VERSION:
+            # Wait for the server to acknowledge the binary protocol before using it
+            CDProto.recv_msg(sock, CDProto.VERSION)
+        sock.sendall(CDProto.encode(CDProto.join(channel, history=0), version))
+        decoder = CDProtoDecoder(version)
+        sel.register(sock, selectors.EVENT_READ, decoder)
+        clients.append((sock, channel))
+
+    latencies = array("d")
+    sent = bad = 0
+    send_wait = 0.0
+    closed = set()
+
+    def receive(timeout):
+        nonlocal bad
+        for key, _ in sel.select(timeout):
+            try:
+                data = key.fileobj.recv(1 << 16)
+            except ConnectionError:
+                data = b""
+            if not data:
+                # End of stream, the server closed the connection
+                sel.unregister(key.fileobj)
+                closed.add(key.fileobj)
+                continue
+            now = time.time_ns()
+            key.data.feed(data)
+            for frame in key.data.frames():
+                try:
+                    message = CDProto.decode(frame, key.data.version)
+                except CDProtoBadFormat:
+                    bad += 1
+                    continue
+                fields = getattr(message, "message", "").split()
+                if len(fields) == 2 and fields[0] == "bench":
+                    latencies.append((now - int(fields[1])) / 1e6)
+
+    barrier.wait()
+    start = time.monotonic()
+    interval = 1 / rate if rate else None
+    next_send = start
+    while time.monotonic() - start < duration:
+        now = time.monotonic()
+        while interval and senders and next_send <= now:
+            sock, channel = clients[random.randrange(senders)]
+            next_send += interval
+            if sock in closed:
+                continue
+            msg = CDProto.message(f"bench {time.time_ns()}", channel)
+            started = time.monotonic()
+            try:
+                sock.sendall(CDProto.encode(msg, version))
+            except ConnectionError:
+                sel.unregister(sock)
+                closed.add(sock)
+                continue
+            send_wait += time.monotonic() - started
+            sent += 1
+        receive(max(next_send - time.monotonic(), 0) if interval else 0.1)
+
+    drain_end = time.monotonic() + DRAIN
+    while time.monotonic() < drain_end:
+        receive(0.05)
+
+    for sock, _ in clients:
+        sock.close()
+    results.put((sent, send_wait, bad, len(closed), latencies.tobytes()))
+
+
+def process_cpu(pid: int) -> float:
+    """CPU seconds used by a process and its children processes, from /proc."""
+    ticks = os.sysconf("SC_CLK_TCK")
+    pids = [pid]
+    for name in os.listdir("/proc"):
+        if name.isdigit():
+            try:
+                with open(f"/proc/{name}/stat") as stat:
+                    fields = stat.read().rsplit(")", 1)[1].split()
+            except OSError:
+                continue
+            if int(fields[1]) == pid:
+                pids.append(int(name))
+
+    total = 0
+    for child in pids:
+        try:
+            with open(f"/proc/{child}/stat") as stat:
+                fields = stat.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        total += int(fields[11]) + int(fields[12])
+    return total / ticks
+
+
+def percentile(values: list[float], p: float) -> float:
+    """Nearest rank percentile of sorted values."""
+    if not values:
+        return float("nan")
+    return values[min(int(len(values) * p / 100), len(values) - 1)]
+
+
+def start_server(args) -> subprocess.Popen:
+    """Start server.py and wait until it accepts connections."""
+    command = [sys.executable, "server.py", "--engine", args.engine,
+               "--workers", str(args.workers), "--port", str(args.port)]
+    server = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((SERVER_HOST, args.port), timeout=1).close()
+            return server
+        except OSError:
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError("server did not start")
+
+
+def run(args) -> dict:
+    """Run the benchmark and return its report."""
+    # Every simulated client needs a file descriptor
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (min(hard, max(soft, args.clients + 256)), hard))
+
+    server = None if args.no_server else start_server(args)
+    try:
+        layout = channel_layout(args.clients, args.channels, args.layout, args.seed)
+        processes = min(args.processes, args.clients)
+        senders = max(int(args.clients * args.senders), 1)
+
+        barrier = multiprocessing.Barrier(processes + 1)
+        results = multiprocessing.Queue()
+        workers = []
+        for worker in range(processes):
+            share = layout[worker::processes]
+            worker_senders = len(range(worker, senders, processes))
+            rate = args.rate * worker_senders / senders
+            workers.append(multiprocessing.Process(
+                target=client_worker,
+                args=(worker, (SERVER_HOST, args.port), share, worker_senders, rate, args.duration, args.version,
+                      barrier, results),
+            ))
+        for process in workers:
+            process.start()
+
+        barrier.wait()
+        cpu_start = process_cpu(server.pid) if server else None
+        started = time.monotonic()
+
+        reports = [results.get() for _ in workers]
+        elapsed = time.monotonic() - started - DRAIN
+        cpu = process_cpu(server.pid) - cpu_start if server else None
+        for process in workers:
+            process.join()
+    finally:
+        if server:
+            server.send_signal(signal.SIGTERM)
+            server.wait(timeout=10)
+
+    latencies = array("d")
+    for *_, data in reports:
+        latencies.frombytes(data)
+    latencies = sorted(latencies)
+    sent = sum(report[0] for report in reports)
+
+    return {
+        "engine": args.engine,
+        "workers": args.workers,
+        "version": args.version,
+        "clients": args.clients,
+        "channels": args.channels,
+        "layout": args.layout,
+        "sent": sent,
+        "send_wait_seconds": sum(report[1] for report in reports),
+        "bad_frames": sum(report[2] for report in reports),
+        "disconnected": sum(report[3] for report in reports),
+        "delivered": len(latencies),
+        "msgs_per_sec": sent / elapsed,
+        "deliveries_per_sec": len(latencies) / elapsed,
+        "latency_ms": {
+            "p50": percentile(latencies, 50),
+            "p99": percentile(latencies, 99),
+            "p999": percentile(latencies, 99.9),
+            "max": latencies[-1] if latencies else float("nan"),
+        },
+        "server_cpu_seconds": cpu,
+        "server_cpu_percent": 100 * cpu / elapsed if cpu is not None else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--clients", help="simulated clients", type=positive_int, default=1000)
+    parser.add_argument("--channels", help="channels the clients join", type=positive_int, default=10)
+    parser.add_argument(
+        "--layout",
+        help="how clients spread over the channels",
+        choices=["uniform", "skewed", "single"],
+        default="uniform",
+    )
+    parser.add_argument("--senders", help="fraction of clients sending", type=float, default=0.1)
+    parser.add_argument("--rate", help="messages per second sent overall", type=float, default=500)
+    parser.add_argument("--duration", help="seconds of load", type=float, default=10)
+    parser.add_argument(
+        "--version",
+        help="protocol version used by the clients",
+        type=int,
+        choices=[CDProto.LEGACY_VERSION, CDProto.VERSION, CDProto.BINARY_VERSION],
+        default=CDProto.VERSION,
+    )
+    parser.add_argument("--processes", help="processes running the clients", type=positive_int, default=4)
+    parser.add_argument("--engine", help="server engine", default="selectors")
+    parser.add_argument("--workers", help="server processes", type=positive_int, default=1)
+    parser.add_argument("--port", help="port of the server", type=int, default=2000)
+    parser.add_argument("--no-server", help="use a server already running", action="store_true")
+    parser.add_argument("--seed", help="seed of the channel layout", type=int, default=0)
+    parser.add_argument("--json", help="print the report as JSON", action="store_true")
+    args = parser.parse_args()
+
+    report = run(args)
+    if args.json:
+        print(json.dumps(report))
+        return
+
+    latency = report["latency_ms"]
+    print(f"{report['engine']} x{report['workers']} v{report['version']}: "
+          f"{report['clients']} clients in {report['channels']} {report['layout']} channels")
+    print(f"  sent       {report['sent']} ({report['msgs_per_sec']:.0f} msgs/s, "
+          f"{report['send_wait_seconds']:.2f} s waiting to send)")
+    print(f"  delivered  {report['delivered']} ({report['deliveries_per_sec']:.0f} msgs/s)")
+    if report["disconnected"]:
+        print(f"  disconnected {report['disconnected']} clients")
+    print(f"  latency    p50 {latency['p50']:.2f} ms  p99 {latency['p99']:.2f} ms  "
+          f"p999 {latency['p999']:.2f} ms  max {latency['max']:.2f} ms")
+    if report["server_cpu_seconds"] is not None:
+        print(f"  server CPU {report['server_cpu_seconds']:.2f} s "
+              f"({report['server_cpu_percent']:.0f}%)")
+
+
+if __name__ == "__main__":
+    main()
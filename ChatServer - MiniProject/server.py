@@ -1,6 +1,189 @@
-from src.server import Server
+import argparse
+
+from src.server import Server, SlowConsumerPolicy, MAX_QUEUED_BYTES, FANOUT_SLICE
+from src.ratelimit import RateLimitPolicy
+from src.history import HISTORY_MESSAGES, HISTORY_BYTES, REPLAY_MESSAGES
+from src.aio_server import AsyncServer
+from src.shard import serve
+from src.channel_log import LogStore, SEGMENT_BYTES
+
+engines = {
+    "selectors": Server,
+    "asyncio": AsyncServer,
+}
 
 if __name__ == "__main__":
-    s = Server()
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--engine",
+        help="event loop running the server",
+        choices=list(engines.keys()),
+        default="selectors",
+    )
+    parser.add_argument(
+        "--port",
+        help="port the clients connect to",
+        type=int,
+        default=2000,
+    )
+    parser.add_argument(
+        "--max-queue",
+        help="maximum bytes waiting to be sent to a client",
+        type=int,
+        default=MAX_QUEUED_BYTES,
+    )
+    parser.add_argument(
+        "--slow-consumer",
+        help="policy for clients whose queue is full",
+        choices=[policy.value for policy in SlowConsumerPolicy],
+        default=SlowConsumerPolicy.DROP_OLDEST.value,
+    )
+    parser.add_argument(
+        "--history",
+        help="messages kept in the history of each channel",
+        type=int,
+        default=HISTORY_MESSAGES,
+    )
+    parser.add_argument(
+        "--history-bytes",
+        help="maximum bytes kept in the history of each channel",
+        type=int,
+        default=HISTORY_BYTES,
+    )
+    parser.add_argument(
+        "--replay",
+        help="messages replayed to a client joining a channel",
+        type=int,
+        default=REPLAY_MESSAGES,
+    )
+    parser.add_argument(
+        "--no-search",
+        help="do not index the channels history for /search",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--log-dir",
+        help="directory of the durable channel log, disabled when not given",
+    )
+    parser.add_argument(
+        "--log-segment-bytes",
+        help="size of the durable log segments",
+        type=int,
+        default=SEGMENT_BYTES,
+    )
+    parser.add_argument(
+        "--log-retention-seconds",
+        help="age after which durable log segments are deleted",
+        type=float,
+    )
+    parser.add_argument(
+        "--log-retention-bytes",
+        help="size of the durable log of a channel after which old segments are deleted",
+        type=int,
+    )
+    parser.add_argument(
+        "--admin-port",
+        help="local port answering with the server metrics, disabled when not given",
+        type=int,
+    )
+    parser.add_argument(
+        "--heartbeat",
+        help="seconds of silence after which a client is pinged, disabled when not given",
+        type=float,
+    )
+    parser.add_argument(
+        "--idle-timeout",
+        help="seconds of silence after which a client is disconnected, disabled when not given",
+        type=float,
+    )
+    parser.add_argument(
+        "--fanout-slice",
+        help="deliveries made to a large channel between two polls of the sockets",
+        type=int,
+        default=FANOUT_SLICE,
+    )
+    parser.add_argument(
+        "--client-rate",
+        help="messages per second a client may send, unlimited when not given",
+        type=float,
+    )
+    parser.add_argument(
+        "--client-burst",
+        help="messages a client may send at once, defaults to its rate",
+        type=float,
+    )
+    parser.add_argument(
+        "--channel-rate",
+        help="messages per second a channel may receive, unlimited when not given",
+        type=float,
+    )
+    parser.add_argument(
+        "--channel-burst",
+        help="messages a channel may receive at once, defaults to its rate",
+        type=float,
+    )
+    parser.add_argument(
+        "--rate-limit",
+        help="policy for messages over the rate limits",
+        choices=[policy.value for policy in RateLimitPolicy],
+        default=RateLimitPolicy.THROTTLE.value,
+    )
+    parser.add_argument(
+        "--federation-port",
+        help="port the other servers of a federation link to, disabled when not given",
+        type=int,
+    )
+    parser.add_argument(
+        "--peer",
+        help="HOST:PORT federation port of a server to link to, every link is given on one side only",
+        action="append",
+        default=[],
+    )
+    parser.add_argument(
+        "--workers",
+        help="number of server processes sharing the chat port",
+        type=int,
+        default=1,
+    )
+    args = parser.parse_args()
+    if args.workers > 1 and (args.federation_port or args.peer):
+        parser.error("federation runs in a single process, --workers cannot be used with it")
+
+    options = {
+        "port": args.port,
+        "max_queued_bytes": args.max_queue,
+        "slow_consumer": SlowConsumerPolicy(args.slow_consumer),
+        "history_messages": args.history,
+        "history_bytes": args.history_bytes,
+        "replay_messages": args.replay,
+        "search": not args.no_search,
+        "admin_port": args.admin_port,
+        "heartbeat": args.heartbeat,
+        "idle_timeout": args.idle_timeout,
+        "fanout_slice": args.fanout_slice,
+        "client_rate": args.client_rate,
+        "client_burst": args.client_burst,
+        "channel_rate": args.channel_rate,
+        "channel_burst": args.channel_burst,
+        "rate_limit": RateLimitPolicy(args.rate_limit),
+        "federation_port": args.federation_port,
+        "peers": [(host, int(port)) for host, port in (peer.rsplit(":", 1) for peer in args.peer)],
+    }
+
+    log_options = None
+    if args.log_dir:
+        log_options = {
+            "directory": args.log_dir,
+            "segment_bytes": args.log_segment_bytes,
+            "retention_seconds": args.log_retention_seconds,
+            "retention_bytes": args.log_retention_bytes,
+        }
+
+    if args.workers > 1:
+        serve(args.workers, engines[args.engine], log_options, **options)
+    else:
+        if log_options:
+            options["log"] = LogStore(**log_options)
+        s = engines[args.engine](**options)
 
-    s.loop()
+        s.loop()
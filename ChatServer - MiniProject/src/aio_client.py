@@ -0,0 +1,185 @@
+"""CD Chat client library built on asyncio, for bots and tests."""
+import asyncio
+
+from .protocol import ACK_TIMEOUT, CDProto, CDProtoBadFormat, CDProtoDecoder, Message
+
+
+class ClientProtocol(asyncio.Protocol):
+    """asyncio protocol of the connection of an AsyncClient."""
+
+    def __init__(self, client: "AsyncClient"):
+        self.client = client
+
+    def connection_made(self, transport):
+        self.client.transport = transport
+
+    def data_received(self, data):
+        decoder = self.client.decoder
+        decoder.feed(data)
+        for frame in decoder.frames():
+            try:
+                message = CDProto.decode(frame, decoder.version)
+            except CDProtoBadFormat:
+                continue
+            if message:
+                self.client.dispatch(message)
+
+    def connection_lost(self, exc):
+        self.client.closed(exc)
+
+    def pause_writing(self):
+        self.client.writable.clear()
+
+    def resume_writing(self):
+        self.client.writable.set()
+
+
+class AsyncClient:
+    """Chat client driven by a program instead of a terminal.
+
+    Sends never wait: frames are batched and written with one call per
+    event loop iteration, drain() waits for the connection to take them.
+    Received messages go to the on_message callback when one is given,
+    otherwise they are read by iterating over the client:
+
+        client = AsyncClient("bot")
+        await client.connect()
+        client.join("#cd")
+        client.send("Hello", "#cd")
+        async for message in client:
+            ...
+
+    Heartbeats are answered, the binary protocol is used when the server
+    acknowledges it."""
+
+    def __init__(self, name: str, host: str = "127.0.0.1", port: int = 2000,
+                 version: int = CDProto.BINARY_VERSION, on_message=None):
+        self.name = name
+        self.address = (host, port)
+        self.requested_version = version
+        self.version = min(version, CDProto.VERSION)
+        self.on_message = on_message
+
+        self.transport = None
+        self.decoder = CDProtoDecoder()
+        # Made by connect(), before Python 3.10 they bind to the event loop current when created
+        self.writable = None
+        self.disconnected = None
+        self.messages = None
+        self.batch = []
+        self.acknowledged = None
+        self.error = None
+
+        # Frames sent and messages received
+        self.sent = 0
+        self.received = 0
+
+    async def connect(self):
+        """Connect to the server, register and negotiate the protocol version."""
+        loop = asyncio.get_running_loop()
+        self.writable = asyncio.Event()
+        self.writable.set()
+        self.disconnected = asyncio.Event()
+        self.messages = asyncio.Queue()
+        await loop.create_connection(lambda: ClientProtocol(self), *self.address)
+
+        register = CDProto.register(self.name, self.requested_version)
+        self.transport.write(CDProto.encode(register, self.version))
+        if self.requested_version >= CDProto.BINARY_VERSION:
+            # Servers knowing the binary protocol acknowledge it, the others are talked to in JSON
+            self.acknowledged = loop.create_future()
+            try:
+                await asyncio.wait_for(asyncio.shield(self.acknowledged), ACK_TIMEOUT)
+            except asyncio.TimeoutError:
+                pass
+            self.acknowledged = None
+
+    def dispatch(self, message: Message):
+        """Handle a message received from the server."""
+        if self.acknowledged is not None and not self.acknowledged.done():
+            if message.command == "register":
+                # Every frame after the acknowledgement is binary
+                self.version = self.decoder.version = message.version
+                self.acknowledged.set_result(message.version)
+                return
+            self.acknowledged.set_result(self.version)
+
+        if message.command == "ping":
+            self.write(CDProto.pong())
+            return
+
+        self.received += 1
+        if self.on_message:
+            self.on_message(message)
+        else:
+            self.messages.put_nowait(message)
+
+    def closed(self, exc):
+        """Wake up the readers once the connection is closed."""
+        self.error = exc
+        self.transport = None
+        self.writable.set()
+        self.disconnected.set()
+        if self.acknowledged is not None and not self.acknowledged.done():
+            self.acknowledged.set_result(self.version)
+        self.messages.put_nowait(None)
+
+    def write(self, msg: Message):
+        """Queue a message, the frames queued are written together once the current callbacks ran."""
+        if self.transport is None:
+            raise ConnectionError("not connected")
+        if not self.batch:
+            asyncio.get_running_loop().call_soon(self.flush)
+        self.batch.append(CDProto.encode(msg, self.version))
+
+    def flush(self):
+        """Write the frames queued."""
+        if self.batch and self.transport is not None:
+            self.transport.writelines(self.batch)
+            self.sent += len(self.batch)
+        self.batch = []
+
+    def send(self, text: str, channel: str = None):
+        """Send a message to the channel, the main one by default."""
+        self.write(CDProto.message(text, channel))
+
+    def join(self, channel: str, history: int = None, since: int = None):
+        """Join a channel, asking for its recent messages."""
+        self.write(CDProto.join(channel, history, since))
+
+    def leave(self, channel: str):
+        """Leave a channel."""
+        self.write(CDProto.leave(channel))
+
+    def search(self, query: str, channel: str = "main"):
+        """Search the recent messages of a channel, the results are received as a message."""
+        self.write(CDProto.search(channel, query))
+
+    async def drain(self):
+        """Wait until the frames queued are handed to the connection and it accepts more."""
+        if self.writable is None:
+            raise ConnectionError("not connected")
+        self.flush()
+        await self.writable.wait()
+        if self.transport is None and self.error:
+            raise self.error
+
+    async def close(self):
+        """Send the frames queued and close the connection."""
+        if self.transport is not None:
+            self.flush()
+            self.transport.close()
+            await self.disconnected.wait()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> Message:
+        if self.messages is None:
+            raise ConnectionError("not connected")
+        message = await self.messages.get()
+        if message is None:
+            # Later iterations end too
+            self.messages.put_nowait(None)
+            raise StopAsyncIteration
+        return message
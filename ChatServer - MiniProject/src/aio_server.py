@@ -0,0 +1,237 @@
+"""CD Chat server program built on asyncio."""
+import asyncio
+import logging
+import signal
+import time
+
+from .server import BaseServer, Connection, PEER_CONNECT_TIMEOUT, PEER_RETRY
+
+# Seconds given to the clients to receive their pending frames on shutdown
+SHUTDOWN_TIMEOUT = 5
+
+# Seconds between two measures of the event loop lag
+LAG_PROBE_INTERVAL = 0.1
+
+
+class ChatProtocol(asyncio.Protocol):
+    """asyncio protocol of a client connection, or of a link to another server when peer is set.
+
+    peer is True for the links accepted and the dialed address for the links opened."""
+
+    def __init__(self, server: "AsyncServer", peer=None):
+        self.server = server
+        self.transport = None
+        self.peer = peer
+
+    def connection_made(self, transport):
+        self.transport = transport
+        address = transport.get_extra_info('peername')
+        connection = self.server.connections[self] = Connection(self, address)
+        self.server.transports.add(transport)
+        if self.peer:
+            if self.peer is not True:
+                connection.dialed = self.peer
+            self.server.link(connection)
+            return
+
+        print(f"SERVER: Connection from {address}")
+        self.server.watch(connection)
+
+    def data_received(self, data):
+        if self in self.server.connections:
+            self.server.handle(self, data)
+
+    def connection_lost(self, exc):
+        self.server.terminate(self)
+        self.server.transports.discard(self.transport)
+
+    def pause_writing(self):
+        # The transport buffer is full, frames wait in the outbound queue
+        connection = self.server.connections.get(self)
+        if connection:
+            connection.writing = True
+
+    def resume_writing(self):
+        connection = self.server.connections.get(self)
+        if connection:
+            connection.writing = False
+            self.server.flush(connection)
+
+
+class AdminProtocol(asyncio.Protocol):
+    """asyncio protocol of the admin port, answers with the metrics and closes."""
+
+    def __init__(self, server: "AsyncServer"):
+        self.server = server
+
+    def connection_made(self, transport):
+        transport.write(self.server.stats_report())
+        transport.close()
+
+
+class AsyncServer(BaseServer):
+    """Chat Server process running on an asyncio event loop.
+
+    The transports buffer the writes and pause the connection when their
+    buffer is full; meanwhile frames wait in the client's outbound queue,
+    where the slow consumer policy applies. The timer wheel is advanced by
+    a loop callback on each of its ticks. Links to the other servers of a
+    federation are ChatProtocol connections too."""
+
+    def __init__(self, reuse_port: bool = False, port: int = 2000, **options):
+        super().__init__(**options)
+        self.server_address = ('', port)
+        self.reuse_port = reuse_port
+        self.listener = None
+        self.stopping = None
+
+        # Transports not closed yet
+        self.transports = set()
+
+        # Clients with frames queued during the current loop iteration
+        self.pending = set()
+
+    def schedule(self, connection):
+        """Hand the client's queued frames to the transport once the current callbacks ran."""
+        if not self.pending:
+            asyncio.get_running_loop().call_soon(self.flush_pending)
+        self.pending.add(connection)
+
+    def schedule_fanout(self):
+        """Run the pending fan-outs slice after slice from loop callbacks."""
+        asyncio.get_running_loop().call_soon(self.run_fanout)
+
+    def run_fanout(self):
+        """Make a slice of the pending fan-outs and replays and let the loop poll the sockets before the next.
+
+        Replays waiting for their clients to read are checked again on the next tick."""
+        self.fanout(self.fanout_slice)
+        self.resume_backfills(self.fanout_slice)
+        if self.ready():
+            asyncio.get_running_loop().call_soon(self.run_fanout)
+        elif self.busy():
+            asyncio.get_running_loop().call_later(self.timers.resolution, self.run_fanout)
+
+    def flush_pending(self):
+        """Write the frames queued during the loop iteration, one write per client."""
+        pending, self.pending = self.pending, set()
+        for connection in pending:
+            if connection.socket in self.connections:
+                self.flush(connection)
+
+    def flush(self, connection):
+        """Hand the client's outbound queue to the transport unless it is paused."""
+        if connection.writing or not connection.outbound:
+            return
+
+        frames = len(connection.outbound)
+        connection.socket.transport.writelines(connection.outbound)
+        connection.outbound.clear()
+        self.counters["bytes_out"] += connection.queued_bytes
+        self.counters["queued_bytes"] -= connection.queued_bytes
+        connection.queued_bytes = 0
+        self.count_send(connection, frames)
+
+    def terminate(self, client_socket):
+        """Remove the client from the server and close its connection."""
+        if self.disconnect(client_socket) is None:
+            return
+
+        # Pending writes are still sent before the transport closes
+        client_socket.transport.close()
+
+    def probe(self, expected):
+        """Record how late the event loop runs a callback, the asyncio loop latency."""
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        self.loop_latency.record(int((now - expected) * 1e6))
+        if not self.stopping.is_set():
+            loop.call_later(LAG_PROBE_INTERVAL, self.probe, now + LAG_PROBE_INTERVAL)
+
+    def dial(self, address):
+        """Open a link to another server, retried until it succeeds."""
+        asyncio.get_running_loop().create_task(self.open_link(address))
+
+    async def open_link(self, address):
+        """Connect to another server, scheduling a new attempt when it fails."""
+        loop = asyncio.get_running_loop()
+        try:
+            await asyncio.wait_for(
+                loop.create_connection(lambda: ChatProtocol(self, peer=address), *address),
+                PEER_CONNECT_TIMEOUT,
+            )
+        except (OSError, asyncio.TimeoutError) as error:
+            logging.debug("Could not link to %s: %s", address, error)
+            self.timers.schedule(time.monotonic() + PEER_RETRY, self.dial, address)
+
+    def tick(self):
+        """Run the expired timers and wait for the next tick of the wheel."""
+        loop = asyncio.get_running_loop()
+        self.timers.advance(time.monotonic())
+        if not self.stopping.is_set():
+            loop.call_later(self.timers.resolution, self.tick)
+
+    def stop(self):
+        """Ask the server to shut down gracefully."""
+        if self.stopping:
+            self.stopping.set()
+
+    async def serve(self):
+        """Accept clients until the server is stopped."""
+        loop = asyncio.get_running_loop()
+        self.stopping = asyncio.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, self.stop)
+
+        server = self.listener = await loop.create_server(
+            lambda: ChatProtocol(self),
+            *self.server_address,
+            backlog=50,
+            reuse_address=True,
+            reuse_port=self.reuse_port,
+        )
+        if self.bus:
+            loop.add_reader(self.bus, self.relay)
+        if self.admin_port:
+            admin = await loop.create_server(
+                lambda: AdminProtocol(self), '127.0.0.1', self.admin_port, reuse_address=True
+            )
+        loop.call_later(LAG_PROBE_INTERVAL, self.probe, loop.time() + LAG_PROBE_INTERVAL)
+        if self.federation_port:
+            federation = await loop.create_server(
+                lambda: ChatProtocol(self, peer=True), '', self.federation_port, reuse_address=True
+            )
+        loop.call_later(self.timers.resolution, self.tick)
+
+        await self.stopping.wait()
+        if self.admin_port:
+            admin.close()
+        if self.federation_port:
+            federation.close()
+        await self.shutdown(server)
+
+    async def shutdown(self, server):
+        """Stop accepting clients and close every connection after its pending frames."""
+        logging.debug("Shutting down with %d clients", len(self.connections))
+        loop = asyncio.get_running_loop()
+        server.close()
+        if self.bus:
+            loop.remove_reader(self.bus)
+
+        self.fanout()
+        for client, connection in tuple(self.connections.items()):
+            # Frames waiting for the transport go out before it closes
+            client.transport.writelines(connection.outbound)
+            self.terminate(client)
+
+        deadline = loop.time() + SHUTDOWN_TIMEOUT
+        while self.transports and loop.time() < deadline:
+            await asyncio.sleep(0.05)
+
+        for transport in tuple(self.transports):
+            transport.abort()
+        await server.wait_closed()
+
+    def loop(self):
+        """Loop until the server is stopped."""
+        asyncio.run(self.serve())
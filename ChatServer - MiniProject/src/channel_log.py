@@ -0,0 +1,264 @@
+"""Durable log of the chat channels messages."""
+import bisect
+import logging
+import mmap
+import os
+import struct
+import time
+
+from .protocol import CDProto, CDProtoBadFormat
+
+# Default size of a log segment
+SEGMENT_BYTES = 8 * 1024 * 1024
+
+# Bytes written between two entries of the sparse timestamp index
+INDEX_INTERVAL = 4096
+
+# Index entry: timestamp of the message and its position in the segment
+INDEX_ENTRY = struct.Struct(">qI")
+
+
+class Segment:
+    """A log file holding version 2 frames, with its sparse timestamp index.
+
+    The segment file name is the position of its first byte in the log of
+    the channel."""
+
+    def __init__(self, directory: str, base: int):
+        self.base = base
+        self.path = os.path.join(directory, f"{base:020d}.log")
+        self.index_path = os.path.join(directory, f"{base:020d}.idx")
+        self.index = []
+        self.size = 0
+        self.file = None
+        self.index_file = None
+        self._map = None
+
+    def load(self):
+        """Read the size and the index of an existing segment."""
+        self.size = os.path.getsize(self.path)
+        if os.path.exists(self.index_path):
+            with open(self.index_path, "rb") as index_file:
+                data = index_file.read()
+            data = data[:len(data) - len(data) % INDEX_ENTRY.size]
+            self.index = list(INDEX_ENTRY.iter_unpack(data))
+
+    def recover(self):
+        """Drop a partially written frame at the end of the segment."""
+        size = self.size
+        with open(self.path, "rb") as segment_file:
+            data = segment_file.read()
+        position = 0
+        while position + 2 <= size:
+            end = position + 2 + int.from_bytes(data[position:position + 2], "big")
+            if end > size:
+                break
+            position = end
+
+        if position != size:
+            logging.debug("Truncating %s to its last complete frame", self.path)
+            os.truncate(self.path, position)
+        self.size = position
+        self.index = [entry for entry in self.index if entry[1] < self.size]
+
+    @property
+    def first_ts(self) -> int:
+        return self.index[0][0] if self.index else None
+
+    @property
+    def mtime(self) -> float:
+        return os.path.getmtime(self.path)
+
+    def open(self):
+        """Open the segment for appending."""
+        self.file = open(self.path, "ab", buffering=0)
+        self.index_file = open(self.index_path, "ab", buffering=0)
+
+    def close(self):
+        """Stop appending to the segment."""
+        if self.file:
+            self.file.close()
+            self.index_file.close()
+            self.file = self.index_file = None
+
+    def append(self, frame: bytes, ts: int, index_interval: int):
+        """Write a frame, indexing it when the last index entry is far enough behind."""
+        if not self.index or self.size - self.index[-1][1] >= index_interval:
+            entry = (ts, self.size)
+            self.index.append(entry)
+            self.index_file.write(INDEX_ENTRY.pack(*entry))
+
+        self.file.write(frame)
+        self.size += len(frame)
+
+    def view(self) -> memoryview:
+        """Memory map of the segment, remapped when it grew."""
+        if self._map is None or len(self._map) < self.size:
+            with open(self.path, "rb") as segment_file:
+                self._map = mmap.mmap(segment_file.fileno(), self.size, access=mmap.ACCESS_READ)
+        return memoryview(self._map)[:self.size]
+
+    def find(self, since: int) -> int:
+        """Position of the first frame with a timestamp not older than since."""
+        # Start at the last indexed frame older than since and walk the frames from there
+        i = bisect.bisect_left(self.index, (since, -1)) - 1
+        position = self.index[i][1] if i >= 0 else 0
+        view = self.view()
+        try:
+            while position < self.size:
+                end = position + 2 + int.from_bytes(view[position:position + 2], "big")
+                try:
+                    ts = CDProto.decode(bytes(view[position + 2:end])).ts
+                except CDProtoBadFormat:
+                    ts = None
+                if ts is not None and ts >= since:
+                    break
+                position = end
+        finally:
+            view.release()
+        return position
+
+    def remove(self):
+        """Delete the segment files.
+
+        Replays still being sent keep the memory map alive until they are released."""
+        self.close()
+        self._map = None
+        for path in (self.path, self.index_path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+class ChannelLog:
+    """Segmented log of the messages of a channel."""
+
+    def __init__(self, directory: str, segment_bytes: int, index_interval: int):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.index_interval = index_interval
+        os.makedirs(directory, exist_ok=True)
+
+        self.segments = []
+        for name in sorted(os.listdir(directory)):
+            if name.endswith(".log"):
+                segment = Segment(directory, int(name[:-4]))
+                segment.load()
+                self.segments.append(segment)
+
+        # Only the last segment may have been interrupted while written
+        if self.segments:
+            self.segments[-1].recover()
+        else:
+            self.segments.append(Segment(directory, 0))
+        self.segments[-1].open()
+
+    @property
+    def size(self) -> int:
+        return sum(segment.size for segment in self.segments)
+
+    def append(self, frame: bytes, ts: int):
+        """Write a version 2 frame at the end of the log."""
+        active = self.segments[-1]
+        if active.size and active.size + len(frame) > self.segment_bytes:
+            active.close()
+            active = Segment(self.directory, active.base + active.size)
+            active.open()
+            self.segments.append(active)
+
+        active.append(frame, ts, self.index_interval)
+
+    def replay(self, since: int) -> list[memoryview]:
+        """Views of the frames sent since the timestamp, straight from the segments."""
+        # Segments hold messages up to the first timestamp of the next one
+        start = 0
+        for i, segment in enumerate(self.segments):
+            if segment.first_ts is not None and segment.first_ts < since:
+                start = i
+
+        views = []
+        for i in range(start, len(self.segments)):
+            segment = self.segments[i]
+            if not segment.size:
+                continue
+            position = segment.find(since) if i == start else 0
+            if position < segment.size:
+                views.append(segment.view()[position:])
+        return views
+
+    def retain(self, max_age: float = None, max_bytes: int = None):
+        """Delete the oldest segments beyond the retention limits, never the active one."""
+        now = time.time()
+        while len(self.segments) > 1:
+            oldest = self.segments[0]
+            expired = max_age is not None and now - oldest.mtime > max_age
+            oversized = max_bytes is not None and self.size > max_bytes
+            if not (expired or oversized):
+                break
+            oldest.remove()
+            self.segments.pop(0)
+
+    def close(self):
+        """Stop appending to the log."""
+        self.segments[-1].close()
+
+
+class LogStore:
+    """Durable segmented logs of every channel, kept under one directory.
+
+    Each channel has its own directory of segments. Retention removes
+    whole segments older than retention_seconds or beyond retention_bytes
+    per channel, checked whenever a segment is rolled."""
+
+    def __init__(self, directory: str, segment_bytes: int = SEGMENT_BYTES,
+                 index_interval: int = INDEX_INTERVAL, retention_seconds: float = None,
+                 retention_bytes: int = None):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.index_interval = index_interval
+        self.retention_seconds = retention_seconds
+        self.retention_bytes = retention_bytes
+        os.makedirs(directory, exist_ok=True)
+
+        # Channels logged before the server restarted
+        self.logs = {}
+        for name in os.listdir(directory):
+            try:
+                channel = bytes.fromhex(name).decode("utf-8")
+            except ValueError:
+                continue
+            self.logs[channel] = self._open(channel)
+        self.retain()
+
+    def _open(self, channel: str) -> ChannelLog:
+        directory = os.path.join(self.directory, channel.encode("utf-8").hex())
+        return ChannelLog(directory, self.segment_bytes, self.index_interval)
+
+    def append(self, channel: str, frame: bytes, ts: int):
+        """Write a version 2 frame to the log of the channel."""
+        log = self.logs.get(channel)
+        if log is None:
+            log = self.logs[channel] = self._open(channel)
+
+        segments = len(log.segments)
+        log.append(frame, ts)
+        if len(log.segments) != segments:
+            log.retain(self.retention_seconds, self.retention_bytes)
+
+    def replay(self, channel: str, since: int) -> list[memoryview]:
+        """Views of the frames sent to the channel since the timestamp."""
+        log = self.logs.get(channel)
+        if log is None:
+            return []
+        return log.replay(since)
+
+    def retain(self):
+        """Apply the retention limits to every channel."""
+        for log in self.logs.values():
+            log.retain(self.retention_seconds, self.retention_bytes)
+
+    def close(self):
+        """Stop appending to the logs."""
+        for log in self.logs.values():
+            log.close()
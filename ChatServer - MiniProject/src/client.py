@@ -4,7 +4,7 @@ import selectors
 import fcntl
 import os
 import socket
-from .protocol import CDProto
+from .protocol import CDProto, ACK_TIMEOUT
 
 logging.basicConfig(filename=f"{sys.argv[0]}.log", level=logging.DEBUG)
 
@@ -19,12 +19,26 @@ class Client:
         self.sel = selectors.DefaultSelector()
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.name = name
+        self.version = CDProto.VERSION
 
     def connect(self):
         """Connect to chat server and setup stdin flags."""
         self.socket.connect(self.server_address)
-        msg = CDProto.register(self.name)
-        CDProto.send_msg(self.socket, msg)
+        msg = CDProto.register(self.name, CDProto.BINARY_VERSION)
+        CDProto.send_msg(self.socket, msg, CDProto.VERSION)
+
+        # Servers knowing the binary protocol acknowledge it, the others are talked to in JSON
+        self.socket.settimeout(ACK_TIMEOUT)
+        try:
+            data = CDProto.recv_msg(self.socket, CDProto.VERSION)
+        except socket.timeout:
+            data = None
+        self.socket.settimeout(None)
+
+        if data and data.command == "register":
+            self.version = data.version
+        elif data and data.command == "message":
+            print("\n<<" + data.message)
 
     def send(self, stdin, mask):
         """Send message to server."""
@@ -39,14 +53,27 @@ class Client:
                 channel = InMessage[6:]
                 self.current_channel = channel
                 msg = CDProto.join(channel)
-                CDProto.send_msg(self.socket,msg)
+                CDProto.send_msg(self.socket,msg,self.version)
             
+            # Leave message
+            elif InMessage[:7] == "/leave ":
+                channel = InMessage[7:]
+                if channel == self.current_channel:
+                    self.current_channel = "main"
+                msg = CDProto.leave(channel)
+                CDProto.send_msg(self.socket,msg,self.version)
+
+            # Search the recent messages of the current channel
+            elif InMessage[:8] == "/search ":
+                msg = CDProto.search(self.current_channel, InMessage[8:])
+                CDProto.send_msg(self.socket,msg,self.version)
+
             # Register message
             elif InMessage[:10] == "/register ":
                 # Register the user
                 self.name = InMessage[10:]
-                msg = CDProto.register(self.name)
-                CDProto.send_msg(self.socket,msg)
+                msg = CDProto.register(self.name, self.version)
+                CDProto.send_msg(self.socket,msg,self.version)
 
             # Text message
             else:
@@ -55,15 +82,34 @@ class Client:
                     InMessage = InMessage[9:]
 
                 msg = CDProto.message(InMessage, self.current_channel)
-                CDProto.send_msg(self.socket,msg)
+                CDProto.send_msg(self.socket,msg,self.version)
                 if msg.message == "exit":
                     sys.exit(0)
     
     def receive(self, sock, mask):
         """Receive message from server."""
-        data = CDProto.recv_msg(sock)
+        data = CDProto.recv_msg(sock, self.version)
+
+        # Answer the server heartbeats
+        if data and data.command == "ping":
+            CDProto.send_msg(sock, CDProto.pong(), self.version)
+
+        # Messages found by a search
+        elif data and data.command == "results":
+            print(f"\n<< {len(data.messages)} messages in {data.channel} match '{data.query}'")
+            for message in data.messages:
+                print("<<  " + message)
+
+        # The server refused our message
+        elif data and data.command == "error":
+            print(f"\n<< Error: {data.error}")
+
+        # The server dropped our message for going over the rate limit
+        elif data and data.command == "throttle":
+            print(f"\n<< Slow down, retry in {data.retry} seconds")
+
         # If the message is not empty
-        if data != "" and data != None:
+        elif data != "" and data != None and data.command == "message":
             print("\n<<" + data.message)
 
     def loop(self):
@@ -0,0 +1,58 @@
+"""Recent messages of the chat channels."""
+from collections import deque
+from itertools import islice
+
+from .protocol import CDProto, EncodedMessage
+
+# Default bounds of the history of a channel
+HISTORY_MESSAGES = 100
+HISTORY_BYTES = 64 * 1024
+
+# Default number of messages replayed to a client joining a channel
+REPLAY_MESSAGES = 10
+
+
+class ChannelHistory:
+    """Ring buffer of the most recent messages of a channel.
+
+    Messages are kept already encoded, so replaying them reuses the frames
+    built for the broadcast. The oldest messages are evicted once the
+    buffer holds more than max_messages or max_bytes of version 2 frames."""
+
+    def __init__(self, max_messages: int = HISTORY_MESSAGES, max_bytes: int = HISTORY_BYTES):
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.messages = deque()
+        self.bytes = 0
+
+    def __len__(self) -> int:
+        return len(self.messages)
+
+    def append(self, encoded: EncodedMessage) -> list[EncodedMessage]:
+        """Add a message to the history and return the evicted ones."""
+        self.messages.append(encoded)
+        self.bytes += len(encoded.frame(CDProto.VERSION))
+
+        evicted = []
+        while len(self.messages) > self.max_messages or self.bytes > self.max_bytes:
+            old = self.messages.popleft()
+            self.bytes -= len(old.frame(CDProto.VERSION))
+            evicted.append(old)
+        return evicted
+
+    def replay(self, last: int = None, since: int = None) -> list[EncodedMessage]:
+        """Messages sent after the since timestamp, or the last ones."""
+        if since is not None:
+            messages = []
+            for encoded in reversed(self.messages):
+                if encoded.message.ts is None or encoded.message.ts < since:
+                    break
+                messages.append(encoded)
+            messages.reverse()
+            return messages
+
+        if not last or last < 0:
+            return []
+        messages = list(islice(reversed(self.messages), last))
+        messages.reverse()
+        return messages
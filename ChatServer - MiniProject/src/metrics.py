@@ -0,0 +1,42 @@
+"""Runtime metrics of the chat server."""
+import math
+
+
+class Histogram(dict):
+    """Count of values by the power of two bucket they fall in."""
+
+    def record(self, value: int):
+        """Count a value in the smallest power of two bucket holding it."""
+        bucket = 1 << max(value - 1, 0).bit_length()
+        self[bucket] = self.get(bucket, 0) + 1
+
+
+class RateMeter:
+    """Exponentially decaying rate of events per second.
+
+    Marking an event is a couple of float operations, so meters can be
+    updated on every message."""
+
+    __slots__ = ("count", "_rate", "_last")
+
+    # Seconds it takes the rate to forget about 63% of its past
+    TIME_CONSTANT = 10.0
+
+    def __init__(self):
+        self.count = 0
+        self._rate = 0.0
+        self._last = None
+
+    def mark(self, now: float):
+        """Account an event happening at <now>."""
+        if self._last is not None:
+            self._rate *= math.exp((self._last - now) / self.TIME_CONSTANT)
+        self._rate += 1 / self.TIME_CONSTANT
+        self._last = now
+        self.count += 1
+
+    def rate(self, now: float) -> float:
+        """Events per second at <now>."""
+        if self._last is None:
+            return 0.0
+        return self._rate * math.exp((self._last - now) / self.TIME_CONSTANT)
@@ -1,39 +1,167 @@
 """Protocol for chat server - Computação Distribuida Assignment 1."""
 import json
+import zlib
 from datetime import datetime
-from socket import socket
+from socket import socket, MSG_WAITALL
+from typing import Iterator
+
+# Largest frame accepted with the binary codec, the JSON frames are bounded by their header
+MAX_FRAME_BYTES = 1 << 20
+MAX_JSON_BYTES = 0xFFFF
+
+# Seconds a client waits for the server to acknowledge the binary protocol
+ACK_TIMEOUT = 1.0
+
+# Binary payloads at least this large are compressed when it makes them smaller
+COMPRESS_MIN_BYTES = 512
 
 
 class Message:
     """Message Type."""
+    __slots__ = ("command",)
+
     def __init__(self, command: str):
         self.command = command
 
     
 class JoinMessage(Message):
-    """Message to join a chat channel."""
+    """Message to join a chat channel.
+
+    history asks for the last messages of the channel, since for the
+    messages sent after that timestamp."""
+    __slots__ = ("channel", "history", "since")
+
+    def __init__(self, command: str, channel: str, history: int = None, since: int = None):
+        super().__init__(command)
+        self.channel = channel
+        self.history = history
+        self.since = since
+
+    def __str__(self) -> str:
+        """Converts object to JSON."""
+        replay = ""
+        if self.history is not None:
+            replay += f', "history": {self.history}'
+        if self.since is not None:
+            replay += f', "since": {self.since}'
+
+        return f'{{"command": "{self.command}", "channel": {json.dumps(self.channel)}{replay}}}'
+
+
+class LeaveMessage(Message):
+    """Message to leave a chat channel."""
+    __slots__ = ("channel",)
+
     def __init__(self, command: str, channel: str):
         super().__init__(command)
         self.channel = channel
 
     def __str__(self) -> str:
         """Converts object to JSON."""
-        return f'{{"command": "{self.command}", "channel": "{self.channel}"}}'
+        return f'{{"command": "{self.command}", "channel": {json.dumps(self.channel)}}}'
+
+
+class HeartbeatMessage(Message):
+    """Ping checking the peer is alive, answered with a pong."""
+    __slots__ = ()
+
+    def __str__(self) -> str:
+        """Converts object to JSON."""
+        return f'{{"command": "{self.command}"}}'
+
+
+class ThrottleMessage(Message):
+    """Notice to a client whose message was dropped for going over its rate limit."""
+    __slots__ = ("channel", "retry")
+
+    def __init__(self, command: str, channel: str = None, retry: float = None):
+        super().__init__(command)
+        self.channel = channel
+        self.retry = retry
+
+    def __str__(self) -> str:
+        """Converts object to JSON."""
+        return f'{{"command": "{self.command}", "channel": {json.dumps(self.channel)}, "retry": {self.retry}}}'
+
+
+class ChannelsMessage(Message):
+    """Summary of the channels a linked server added or removed members from."""
+    __slots__ = ("add", "remove")
+
+    def __init__(self, command: str, add: list = (), remove: list = ()):
+        super().__init__(command)
+        self.add = list(add or ())
+        self.remove = list(remove or ())
+
+    def __str__(self) -> str:
+        """Converts object to JSON."""
+        return f'{{"command": "{self.command}", "add": {json.dumps(self.add)}, "remove": {json.dumps(self.remove)}}}'
+
+
+class SearchMessage(Message):
+    """Message to search the recent messages of a channel."""
+    __slots__ = ("channel", "query")
+
+    def __init__(self, command: str, channel: str, query: str):
+        super().__init__(command)
+        self.channel = channel
+        self.query = query
+
+    def __str__(self) -> str:
+        """Converts object to JSON."""
+        return f'{{"command": "{self.command}", "channel": {json.dumps(self.channel)}, "query": {json.dumps(self.query)}}}'
+
+
+class ResultsMessage(Message):
+    """Messages of a channel matching a search."""
+    __slots__ = ("channel", "query", "messages")
+
+    def __init__(self, command: str, channel: str, query: str, messages: list = ()):
+        super().__init__(command)
+        self.channel = channel
+        self.query = query
+        self.messages = list(messages or ())
+
+    def __str__(self) -> str:
+        """Converts object to JSON."""
+        return (f'{{"command": "{self.command}", "channel": {json.dumps(self.channel)}, "query": {json.dumps(self.query)}, '
+                f'"messages": {json.dumps(self.messages)}}}')
+
+
+class ErrorMessage(Message):
+    """Notice to a client whose message was refused."""
+    __slots__ = ("error",)
+
+    def __init__(self, command: str, error: str):
+        super().__init__(command)
+        self.error = error
+
+    def __str__(self) -> str:
+        """Converts object to JSON."""
+        return f'{{"command": "{self.command}", "error": {json.dumps(self.error)}}}'
 
 
 class RegisterMessage(Message):
     """Message to register username in the server."""
-    def __init__(self, command: str, user: str):
+    __slots__ = ("user", "version")
+
+    def __init__(self, command: str, user: str, version: int = None):
         super().__init__(command)
         self.user = user
+        self.version = version
 
     def __str__(self) -> str:
         """Converts object to JSON."""
-        return f'{{"command": "{self.command}", "user": "{self.user}"}}'
+        if self.version:
+            return f'{{"command": "{self.command}", "user": {json.dumps(self.user)}, "version": {self.version}}}'
+
+        return f'{{"command": "{self.command}", "user": {json.dumps(self.user)}}}'
 
     
 class TextMessage(Message):
     """Message to chat with other clients."""
+    __slots__ = ("message", "channel", "ts")
+
     def __init__(self, command: str, message: str, channel: str = None, ts:int = None):
         super().__init__(command)
         self.message = message
@@ -43,23 +171,72 @@ class TextMessage(Message):
     def __str__(self) -> str:
         """Converts object to JSON."""
         if self.channel:
-            return f'{{"command": "{self.command}", "message": "{self.message}", "channel": "{self.channel}", "ts": {self.ts}}}'
+            return (f'{{"command": "{self.command}", "message": {json.dumps(self.message)}, '
+                    f'"channel": {json.dumps(self.channel)}, "ts": {self.ts}}}')
 
-        return f'{{"command": "{self.command}", "message": "{self.message}", "ts": {self.ts}}}'
+        return f'{{"command": "{self.command}", "message": {json.dumps(self.message)}, "ts": {self.ts}}}'
 
 
 class CDProto:
     """Computação Distribuida Protocol."""
 
+    # Version 1 frames carry the JSON document encoded again as a JSON string,
+    # version 2 frames carry the JSON document itself, version 3 frames are
+    # binary with a varint header. A client asks for version 3 in its register
+    # message and waits for the server to acknowledge it before switching.
+    LEGACY_VERSION = 1
+    VERSION = 2
+    BINARY_VERSION = 3
+
     @classmethod
-    def register(cls, username: str) -> RegisterMessage:
+    def register(cls, username: str, version: int = None) -> RegisterMessage:
         """Creates a RegisterMessage object."""
-        return RegisterMessage("register", username)
+        return RegisterMessage("register", username, version)
 
     @classmethod
-    def join(cls, channel: str) -> JoinMessage:
+    def join(cls, channel: str, history: int = None, since: int = None) -> JoinMessage:
         """Creates a JoinMessage object."""
-        return JoinMessage("join", channel)
+        return JoinMessage("join", channel, history, since)
+
+    @classmethod
+    def leave(cls, channel: str) -> LeaveMessage:
+        """Creates a LeaveMessage object."""
+        return LeaveMessage("leave", channel)
+
+    @classmethod
+    def ping(cls) -> HeartbeatMessage:
+        """Creates a ping HeartbeatMessage object."""
+        return HeartbeatMessage("ping")
+
+    @classmethod
+    def pong(cls) -> HeartbeatMessage:
+        """Creates a pong HeartbeatMessage object."""
+        return HeartbeatMessage("pong")
+
+    @classmethod
+    def throttle(cls, channel: str, retry: float) -> ThrottleMessage:
+        """Creates a ThrottleMessage object."""
+        return ThrottleMessage("throttle", channel, round(retry, 3))
+
+    @classmethod
+    def channels(cls, add: list = (), remove: list = ()) -> ChannelsMessage:
+        """Creates a ChannelsMessage object."""
+        return ChannelsMessage("channels", add, remove)
+
+    @classmethod
+    def search(cls, channel: str, query: str) -> SearchMessage:
+        """Creates a SearchMessage object."""
+        return SearchMessage("search", channel, query)
+
+    @classmethod
+    def results(cls, channel: str, query: str, messages: list) -> ResultsMessage:
+        """Creates a ResultsMessage object."""
+        return ResultsMessage("results", channel, query, messages)
+
+    @classmethod
+    def error(cls, error: str) -> ErrorMessage:
+        """Creates an ErrorMessage object."""
+        return ErrorMessage("error", error)
 
     @classmethod
     def message(cls, message: str, channel: str = None) -> TextMessage:
@@ -67,30 +244,80 @@ class CDProto:
         return TextMessage("message", message, channel, int(datetime.now().timestamp()))
 
     @classmethod
-    def send_msg(cls, connection: socket, msg: Message):
-        """Sends through a connection a Message object."""
-        
-        jsonMessage = json.dumps(str(msg))
+    def encode(cls, msg: Message, version: int = LEGACY_VERSION) -> bytes:
+        """Converts a Message object into a ready to send frame."""
+
+        if version >= cls.BINARY_VERSION:
+            payload = CDProtoBinary.encode(msg)
+            return CDProtoBinary.varint(len(payload)) + payload
+
+        if version >= cls.VERSION:
+            payload = str(msg).encode('utf-8')
+        else:
+            payload = json.dumps(str(msg)).encode('utf-8')
+
+        # Messages larger than the 2 bytes header can hold have no JSON frame
+        if len(payload) > MAX_JSON_BYTES:
+            raise CDProtoBadFormat(payload[:64])
 
         # Get header of the message 
-        h = len(jsonMessage).to_bytes(2,'big')
+        h = len(payload).to_bytes(2,'big')
+
+        return h + payload
+
+    @classmethod
+    def fits(cls, msg: Message, version: int = LEGACY_VERSION) -> bool:
+        """Whether the message has a frame in the version, JSON frames are bounded by their header."""
+        if version >= cls.BINARY_VERSION:
+            return len(CDProtoBinary.encode(msg)) <= MAX_FRAME_BYTES
+        try:
+            cls.encode(msg, version)
+        except CDProtoBadFormat:
+            return False
+        return True
+
+    @classmethod
+    def send_msg(cls, connection: socket, msg: Message, version: int = LEGACY_VERSION):
+        """Sends through a connection a Message object."""
 
         # Send the message to the server
-        connection.send(h + jsonMessage.encode('utf-8'))
+        connection.send(cls.encode(msg, version))
 
     @classmethod
-    def recv_msg(cls, connection: socket) -> Message:
+    def recv_msg(cls, connection: socket, version: int = LEGACY_VERSION) -> Message:
         """Receives through a connection a Message object."""
 
+        if version >= cls.BINARY_VERSION:
+            # Read the varint header byte after byte
+            size = shift = 0
+            while True:
+                byte = connection.recv(1)
+                if not byte:
+                    return None
+                size |= (byte[0] & 0x7F) << shift
+                shift += 7
+                if not byte[0] & 0x80:
+                    break
+            if size == 0 or size > MAX_FRAME_BYTES:
+                return None
+            return cls.decode(connection.recv(size, MSG_WAITALL), version)
+
         # Read the header of the message
         h = int.from_bytes(connection.recv(2),'big')
 
         if h == 0:
             return None
         
-        message = connection.recv(h).decode('utf-8')
+        return cls.decode(connection.recv(h))
+
+    @classmethod
+    def decode(cls, payload: bytes, version: int = LEGACY_VERSION) -> Message:
+        """Converts the payload of a frame into a Message object."""
+        if version >= cls.BINARY_VERSION:
+            return CDProtoBinary.decode(payload)
 
         try:
+            message = payload.decode('utf-8')
             jsonMessage = json.loads(message)
 
             if type(jsonMessage) is not dict:
@@ -99,38 +326,274 @@ class CDProto:
             else:
                 jsonToDict = jsonMessage
         
-        except json.JSONDecodeError:
-            raise CDProtoBadFormat(message)
+        except (UnicodeDecodeError, json.JSONDecodeError, TypeError):
+            raise CDProtoBadFormat(payload)
 
-               
-        if jsonToDict["command"] == "register":
-            user = jsonToDict["user"]
-            return CDProto.register(user)
+        try:
+            if jsonToDict["command"] == "register":
+                user = jsonToDict["user"]
+                version = jsonToDict.get("version")
+                # Versions are positive integers, booleans are not versions
+                if version is not None and (type(version) is not int or version < 1):
+                    raise CDProtoBadFormat(payload)
+                return CDProto.register(user, version)
 
-        elif jsonToDict["command"] == "join":
-            channel = jsonToDict["channel"]
-            return CDProto.join(channel)
-        
-        elif jsonToDict["command"] == "message":
-            msg = jsonToDict["message"]
+            elif jsonToDict["command"] == "join":
+                channel = jsonToDict["channel"]
+                for field in ("history", "since"):
+                    value = jsonToDict.get(field)
+                    if value is not None and (type(value) is not int or value < 0):
+                        raise CDProtoBadFormat(payload, f"{field} must be a non-negative integer")
+                return CDProto.join(channel, jsonToDict.get("history"), jsonToDict.get("since"))
 
-            # Check if the channel atribute exists
-            try:
+            elif jsonToDict["command"] == "leave":
                 channel = jsonToDict["channel"]
-            except KeyError:
-                return CDProto.message(msg)
+                return CDProto.leave(channel)
+
+            elif jsonToDict["command"] == "ping":
+                return CDProto.ping()
+
+            elif jsonToDict["command"] == "pong":
+                return CDProto.pong()
+
+            elif jsonToDict["command"] == "channels":
+                return CDProto.channels(jsonToDict["add"], jsonToDict["remove"])
+
+            elif jsonToDict["command"] == "search":
+                if type(jsonToDict["query"]) is not str or type(jsonToDict["channel"]) not in (str, type(None)):
+                    raise CDProtoBadFormat(payload)
+                return CDProto.search(jsonToDict["channel"], jsonToDict["query"])
+
+            elif jsonToDict["command"] == "results":
+                return CDProto.results(jsonToDict["channel"], jsonToDict["query"], jsonToDict["messages"])
+
+            elif jsonToDict["command"] == "error":
+                return CDProto.error(jsonToDict["error"])
+
+            elif jsonToDict["command"] == "throttle":
+                return CDProto.throttle(jsonToDict["channel"], jsonToDict["retry"])
             
-            return CDProto.message(msg,channel)
+            elif jsonToDict["command"] == "message":
+                msg = jsonToDict["message"]
+                if type(msg) is not str or type(jsonToDict.get("channel")) not in (str, type(None)):
+                    raise CDProtoBadFormat(payload)
+
+                # Check if the channel atribute exists
+                try:
+                    message = CDProto.message(msg, jsonToDict["channel"])
+                except KeyError:
+                    message = CDProto.message(msg)
+
+                # Keep the timestamp of the sender
+                if type(jsonToDict.get("ts")) is int:
+                    message.ts = jsonToDict["ts"]
+                return message
+
+        except (KeyError, TypeError):
+            raise CDProtoBadFormat(payload)
+
+
+class CDProtoBinary:
+    """Binary payloads of the version 3 frames.
+
+    A payload is the message type byte, whose high bit flags a zlib
+    compressed body, then the body: a varint with a bit set for each field
+    present and the fields present. Strings are a varint length and their
+    UTF-8 bytes, integers are varints."""
+
+    COMPRESSED = 0x80
+
+    # Message class, type byte and fields of every command
+    MESSAGES = {
+        "register": (RegisterMessage, 1, (("user", "str"), ("version", "int"))),
+        "join": (JoinMessage, 2, (("channel", "str"), ("history", "int"), ("since", "int"))),
+        "leave": (LeaveMessage, 3, (("channel", "str"),)),
+        "message": (TextMessage, 4, (("message", "str"), ("channel", "str"), ("ts", "int"))),
+        "ping": (HeartbeatMessage, 5, ()),
+        "pong": (HeartbeatMessage, 6, ()),
+        "throttle": (ThrottleMessage, 7, (("channel", "str"), ("retry", "ms"))),
+        "channels": (ChannelsMessage, 8, (("add", "strs"), ("remove", "strs"))),
+        "search": (SearchMessage, 9, (("channel", "str"), ("query", "str"))),
+        "results": (ResultsMessage, 10, (("channel", "str"), ("query", "str"), ("messages", "strs"))),
+        "error": (ErrorMessage, 11, (("error", "str"),)),
+    }
+    COMMANDS = {kind: command for command, (_, kind, _) in MESSAGES.items()}
+
+    @staticmethod
+    def varint(value: int) -> bytes:
+        """Unsigned LEB128 encoding of an integer."""
+        data = bytearray()
+        while value > 0x7F:
+            data.append(value & 0x7F | 0x80)
+            value >>= 7
+        data.append(value)
+        return bytes(data)
+
+    @staticmethod
+    def read_varint(data, offset: int) -> tuple:
+        """Integer at the offset and the offset following it, None when the varint is incomplete."""
+        value = shift = 0
+        while offset < len(data):
+            byte = data[offset]
+            offset += 1
+            value |= (byte & 0x7F) << shift
+            if not byte & 0x80:
+                return value, offset
+            shift += 7
+            if shift > 63:
+                raise CDProtoBadFormat(bytes(data))
+        return None, offset
+
+    @classmethod
+    def encode(cls, msg: Message) -> bytes:
+        """Converts a Message object into a binary payload."""
+        _, kind, fields = cls.MESSAGES[msg.command]
+        present = 0
+        body = bytearray()
+        for i, (name, field) in enumerate(fields):
+            value = getattr(msg, name)
+            if value is None:
+                continue
+            present |= 1 << i
+            if field == "str":
+                value = value.encode("utf-8")
+                body += cls.varint(len(value)) + value
+            elif field == "int":
+                body += cls.varint(value)
+            elif field == "ms":
+                body += cls.varint(int(value * 1000))
+            else:
+                body += cls.varint(len(value))
+                for item in value:
+                    item = item.encode("utf-8")
+                    body += cls.varint(len(item)) + item
+        body = cls.varint(present) + body
+
+        if len(body) >= COMPRESS_MIN_BYTES:
+            compressed = zlib.compress(body)
+            if len(compressed) < len(body):
+                return bytes((kind | cls.COMPRESSED,)) + compressed
+        return bytes((kind,)) + body
+
+    @classmethod
+    def decode(cls, payload: bytes) -> Message:
+        """Converts a binary payload into a Message object."""
+        try:
+            command = cls.COMMANDS[payload[0] & ~cls.COMPRESSED]
+            body = payload[1:]
+            if payload[0] & cls.COMPRESSED:
+                inflate = zlib.decompressobj()
+                body = inflate.decompress(body, MAX_FRAME_BYTES)
+                if inflate.unconsumed_tail:
+                    raise CDProtoBadFormat(payload)
+
+            message_class, _, fields = cls.MESSAGES[command]
+            present, offset = cls.read_varint(body, 0)
+            values = []
+            for i, (name, field) in enumerate(fields):
+                if present is None or not present & 1 << i:
+                    values.append(None)
+                    continue
+                if field == "strs":
+                    count, offset = cls.read_varint(body, offset)
+                    value = []
+                    for _ in range(count):
+                        size, offset = cls.read_varint(body, offset)
+                        value.append(bytes(body[offset:offset + size]).decode("utf-8"))
+                        offset += size
+                elif field == "str":
+                    size, offset = cls.read_varint(body, offset)
+                    value = bytes(body[offset:offset + size]).decode("utf-8")
+                    offset += size
+                else:
+                    value, offset = cls.read_varint(body, offset)
+                    if field == "ms":
+                        value /= 1000
+                values.append(value)
+        except (IndexError, KeyError, TypeError, UnicodeDecodeError, zlib.error):
+            raise CDProtoBadFormat(payload)
+
+        if offset != len(body):
+            raise CDProtoBadFormat(payload)
+        return message_class(command, *values)
+
+
+class EncodedMessage:
+    """Message whose frame is encoded at most once per protocol version."""
+
+    __slots__ = ("message", "_frames")
+
+    def __init__(self, msg: Message):
+        self.message = msg
+        self._frames = {}
+
+    def frame(self, version: int = CDProto.LEGACY_VERSION) -> bytes:
+        """Returns the frame of the message for the given protocol version."""
+        frame = self._frames.get(version)
+        if frame is None:
+            frame = self._frames[version] = CDProto.encode(self.message, version)
+        return frame
+
+
+class CDProtoDecoder:
+    """Incremental decoder of CDProto frames for non-blocking connections.
+
+    The frames header depends on the version, which may change between two frames."""
+
+    def __init__(self, version: int = CDProto.LEGACY_VERSION):
+        self._buffer = bytearray()
+        self.version = version
+
+    def __len__(self) -> int:
+        """Number of bytes waiting for a complete frame."""
+        return len(self._buffer)
+
+    def feed(self, data: bytes):
+        """Appends the bytes read from the connection to the buffer."""
+        self._buffer += data
+
+    def frames(self) -> Iterator[bytes]:
+        """Yields the payload of every complete frame in the buffer.
+
+        Partial frames are kept until the rest of their bytes are fed.
+        Binary frames larger than MAX_FRAME_BYTES raise CDProtoBadFormat."""
+        view = memoryview(self._buffer)
+        offset = 0
+        try:
+            while len(view) - offset >= 2 or (self.version >= CDProto.BINARY_VERSION and len(view) > offset):
+                if self.version >= CDProto.BINARY_VERSION:
+                    size, start = CDProtoBinary.read_varint(view, offset)
+                    if size is None:
+                        break
+                    if size > MAX_FRAME_BYTES:
+                        raise CDProtoBadFormat()
+                else:
+                    size = int.from_bytes(view[offset:offset + 2], 'big')
+                    start = offset + 2
+                end = start + size
+                if end > len(view):
+                    break
+
+                payload = bytes(view[start:end])
+                offset = end
+                if size:
+                    yield payload
+        finally:
+            view.release()
+            del self._buffer[:offset]
 
 
 class CDProtoBadFormat(Exception):
     """Exception when source message is not CDProto."""
 
-    def __init__(self, original_msg: bytes=None) :
-        """Store original message that triggered exception."""
+    def __init__(self, original_msg: bytes=None, reason: str = None) :
+        """Store original message that triggered exception, and why it is refused when the sender should be told."""
         self._original = original_msg
+        self.reason = reason
 
     @property
     def original_msg(self) -> str:
         """Retrieve original message as a string."""
-        return self._original.decode("utf-8")
+        if isinstance(self._original, bytes):
+            return self._original.decode("utf-8", "replace")
+        return self._original
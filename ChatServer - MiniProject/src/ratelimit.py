@@ -0,0 +1,40 @@
+"""Rate limits of the messages the chat clients send."""
+import enum
+
+# Default number of messages a client may send delayed while over its limit
+MAX_DELAYED = 64
+
+
+class RateLimitPolicy(enum.Enum):
+    """What to do with a message sent over the rate limit."""
+
+    DROP = "drop"
+    DELAY = "delay"
+    THROTTLE = "throttle"
+
+
+class TokenBucket:
+    """Token bucket refilled at <rate> tokens per second, holding at most <burst> tokens.
+
+    Tokens are refilled lazily from the time elapsed since the last check,
+    so idle buckets cost nothing."""
+
+    __slots__ = ("rate", "burst", "tokens", "last")
+
+    def __init__(self, rate: float, burst: float = None, now: float = 0.0):
+        self.rate = rate
+        self.burst = burst or max(rate, 1)
+        self.tokens = self.burst
+        self.last = now
+
+    def wait(self, now: float) -> float:
+        """Seconds until a token is available, 0 when there is one."""
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        """Use a token, only after wait returned 0."""
+        self.tokens -= 1
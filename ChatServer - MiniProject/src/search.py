@@ -0,0 +1,78 @@
+"""Inverted index of the recent messages of the chat channels."""
+import re
+from collections import deque
+
+from .protocol import EncodedMessage
+
+# Default number of messages answered to a search
+SEARCH_RESULTS = 10
+
+TERM = re.compile(r"\w+")
+
+
+def terms(text: str) -> set[str]:
+    """Lower case words of a text."""
+    return set(TERM.findall(text.lower()))
+
+
+class SearchIndex:
+    """Inverted index of the messages of a channel history.
+
+    Messages are numbered as they are added and every term maps to the
+    numbers of the messages holding it, oldest first. The history evicts
+    its oldest messages first, so their postings are always at the head
+    of the lists and are evicted along with them."""
+
+    def __init__(self):
+        self.postings = {}
+        self.messages = {}
+        self.first = 0
+        self.next = 0
+
+    def __len__(self) -> int:
+        return len(self.messages)
+
+    def add(self, encoded: EncodedMessage):
+        """Index a message added to the history."""
+        words = terms(encoded.message.message)
+        self.messages[self.next] = (encoded, words)
+        for word in words:
+            posting = self.postings.get(word)
+            if posting is None:
+                posting = self.postings[word] = deque()
+            posting.append(self.next)
+        self.next += 1
+
+    def evict(self):
+        """Forget the oldest message, evicted from the history."""
+        _, words = self.messages.pop(self.first)
+        for word in words:
+            posting = self.postings[word]
+            posting.popleft()
+            if not posting:
+                del self.postings[word]
+        self.first += 1
+
+    def search(self, query: str, limit: int = SEARCH_RESULTS) -> list[EncodedMessage]:
+        """Most recent messages holding every term of the query, oldest first."""
+        words = terms(query)
+        postings = []
+        for word in words:
+            posting = self.postings.get(word)
+            if posting is None:
+                return []
+            postings.append(posting)
+        if not postings:
+            return []
+
+        # Walk the shortest posting list from the newest message, checking the words of each message
+        shortest = min(postings, key=len)
+        found = []
+        for number in reversed(shortest):
+            encoded, message_words = self.messages[number]
+            if words <= message_words:
+                found.append(encoded)
+                if len(found) == limit:
+                    break
+        found.reverse()
+        return found
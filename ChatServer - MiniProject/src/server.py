@@ -1,100 +1,1016 @@
+import abc
+import enum
+import errno
+import heapq
+import json
 import logging
+import os
 import selectors
 import socket
-from .protocol import CDProto, CDProtoBadFormat
+import time
+from collections import OrderedDict, deque
+from functools import partial
+from itertools import islice
+from typing import Iterator
+from .history import ChannelHistory, HISTORY_MESSAGES, HISTORY_BYTES, REPLAY_MESSAGES
+from .metrics import Histogram, RateMeter
+from .search import SearchIndex, SEARCH_RESULTS
+from .ratelimit import RateLimitPolicy, TokenBucket, MAX_DELAYED
+from .protocol import CDProto, CDProtoBadFormat, CDProtoDecoder, EncodedMessage, MAX_JSON_BYTES
+from .timers import TimerWheel
 
 """CD Chat server program."""
 
 logging.basicConfig(filename="server.log", level=logging.DEBUG)
 
+# Maximum number of bytes read from a client on each selector wakeup
+RECV_SIZE = 65536
 
-class Server:
+# Default limit of bytes waiting to be sent to a single client
+MAX_QUEUED_BYTES = 1 << 20
+
+# Maximum number of frames given to a single sendmsg call
+IOV_MAX = os.sysconf("SC_IOV_MAX") if hasattr(os, "sysconf") else 1024
+
+# Deliveries made by a fan-out slice, larger channels are sent to between socket events
+FANOUT_SLICE = 1024
+
+# Bytes waiting to be sent to a linked server beyond which relayed messages are dropped
+PEER_MAX_QUEUED_BYTES = 16 << 20
+
+# Seconds between two attempts to link to a server
+PEER_RETRY = 2.0
+
+# Seconds given to a server to accept a link
+PEER_CONNECT_TIMEOUT = 1.0
+
+# Number of hottest channels and deepest client queues listed in the stats
+STATS_TOP = 50
+
+
+class SlowConsumerPolicy(enum.Enum):
+    """What to do with a client whose outbound queue is full."""
+
+    DROP_OLDEST = "drop-oldest"
+    DROP_NEWEST = "drop-newest"
+    DISCONNECT = "disconnect"
+
+
+class Connection:
+    """State the server keeps for each connected client."""
+
+    def __init__(self, sock: socket.socket, address=None):
+        self.socket = sock
+        self.address = address
+        self.name = None
+        self.decoder = CDProtoDecoder()
+        self.version = CDProto.LEGACY_VERSION
+
+        # Channels the client is member of
+        self.channels = set()
+
+        # Frames waiting to be sent, the first one may be partially sent
+        self.outbound = deque()
+        self.sent_offset = 0
+        self.queued_bytes = 0
+        self.dropped_frames = 0
+        self.writing = False
+
+        # Send calls made to the client and frames they carried
+        self.sends = 0
+        self.frames_sent = 0
+
+        # Last time the client sent something and its idle check timer
+        self.last_seen = time.monotonic()
+        self.timer = None
+
+        # Rate limit of the client's messages and the messages delayed by it
+        self.bucket = None
+        self.delayed = deque()
+        self.release_timer = None
+        # Time until which the client was told to wait, no other notice is sent before
+        self.notice_until = 0.0
+
+        # Channels with members on the other end of a server link, None for clients
+        self.peer = None
+
+        # Address of the server linked to, when this server opened the link
+        self.dialed = None
+
+
+class FanoutJob:
+    """Delivery of a message to the members of a large channel, resumed slice after slice."""
+
+    __slots__ = ("channel", "encoded", "members", "position")
+
+    def __init__(self, channel: str, encoded: EncodedMessage, members: tuple):
+        self.channel = channel
+        self.encoded = encoded
+        self.members = members
+        self.position = 0
+
+
+class BackfillJob:
+    """Replay of the durable log to a client, resumed while its outbound queue has room."""
+
+    __slots__ = ("connection", "channel", "frames", "frame")
+
+    def __init__(self, connection: Connection, channel: str, frames: Iterator):
+        self.connection = connection
+        self.channel = channel
+        self.frames = frames
+        # Next frame, taken from the replay but waiting for room in the queue
+        self.frame = None
+
+
+class BaseServer(abc.ABC):
+    """Channels and message handling shared by the chat server engines.
+
+    Engines own the client connections and implement dial, flush and terminate."""
+
+    def __init__(self, max_queued_bytes: int = MAX_QUEUED_BYTES,
+                 slow_consumer: SlowConsumerPolicy = SlowConsumerPolicy.DROP_OLDEST,
+                 bus=None, history_messages: int = HISTORY_MESSAGES,
+                 history_bytes: int = HISTORY_BYTES, replay_messages: int = REPLAY_MESSAGES,
+                 log=None, admin_port: int = None, heartbeat: float = None,
+                 idle_timeout: float = None, fanout_slice: int = FANOUT_SLICE,
+                 client_rate: float = None, client_burst: float = None,
+                 channel_rate: float = None, channel_burst: float = None,
+                 rate_limit: RateLimitPolicy = RateLimitPolicy.THROTTLE,
+                 federation_port: int = None, peers: list = (), search: bool = True):
+
+        # Bus to the other workers of a sharded server
+        self.bus = bus
+
+        # Channels members, main channel is the default
+        self.channels = {"main": set()}
+
+        # Recent messages of each channel, replayed to the clients joining it
+        self.history = {}
+        self.history_messages = history_messages
+        self.history_bytes = history_bytes
+        self.replay_messages = replay_messages
+
+        # Inverted indexes of the channels histories, answering the searches
+        self.search = {} if search else None
+
+        # Durable log of the channels, replays since a timestamp are served from it
+        self.log = log
+
+        # Connected clients
+        self.connections = {}
+
+        # Fan-outs of large channels not finished yet, per channel in the order of the messages
+        self.fanouts = OrderedDict()
+        self.fanout_slice = fanout_slice
+
+        # Replays from the durable log not finished yet
+        self.backfills = deque()
+
+        # Outbound queues
+        self.max_queued_bytes = max_queued_bytes
+        self.slow_consumer = slow_consumer
+        self.counters = {"queued_bytes": 0, "dropped_frames": 0, "slow_disconnects": 0,
+                         "sends": 0, "frames_sent": 0, "bytes_in": 0, "bytes_out": 0,
+                         "pings": 0, "reaped": 0, "throttle_dropped": 0, "throttle_delayed": 0,
+                         "throttle_notices": 0, "federated": 0, "federation_dropped": 0, "oversize_dropped": 0}
+
+        # Number of send calls by the power of two of the frames they carried
+        self.frames_per_send = Histogram()
+
+        # Metrics served on the admin port
+        self.admin_port = admin_port
+        self.started = time.monotonic()
+        self.channel_rates = {}
+        self.loop_latency = Histogram()
+
+        # Idle clients are pinged every heartbeat seconds and reaped after idle_timeout seconds
+        self.heartbeat = heartbeat
+        self.idle_timeout = idle_timeout
+        self.timers = TimerWheel(now=time.monotonic())
+
+        # Messages per second each client may send and each channel may receive
+        self.client_rate = client_rate
+        self.client_burst = client_burst
+        self.channel_rate = channel_rate
+        self.channel_burst = channel_burst
+        self.rate_limit = rate_limit
+        self.channel_buckets = {}
+
+        # Links to the other servers of a federation, the servers in <peers> are dialed
+        self.federation_port = federation_port
+        self.peers = set()
+        for address in peers:
+            self.timers.schedule(0, self.dial, address)
+
+    def handle(self, client_socket, data):
+        """Process every complete frame received from the client."""
+        self.counters["bytes_in"] += len(data)
+        connection = self.connections[client_socket]
+        connection.last_seen = time.monotonic()
+        decoder = connection.decoder
+        decoder.feed(data)
+        frames = decoder.frames()
+        while True:
+            try:
+                frame = next(frames, None)
+            except CDProtoBadFormat:
+                print("SERVER: Frame too large")
+                self.terminate(client_socket)
+                return
+            if frame is None:
+                break
+
+            # The register message may switch the frames following it to the binary codec
+            try:
+                message = CDProto.decode(frame, decoder.version)
+            except CDProtoBadFormat as error:
+                print("SERVER: Bad Format Error")
+                if error.reason:
+                    notice = CDProto.encode(CDProto.error(error.reason), connection.version)
+                    self.send(connection, notice)
+                continue
+
+            if message:
+                self.process(client_socket, message)
+
+            # The client left while its frames were being processed
+            if client_socket not in self.connections:
+                frames.close()
+                break
+
+    def process(self, client_socket, data):
+        """Process a message received from the client."""
+        if self.connections[client_socket].peer is not None:
+            self.process_peer(self.connections[client_socket], data)
+            return
+
+        # Process Register
+        if(data.command == "register"):
+            connection = self.connections[client_socket]
+            connection.name = data.user
+
+            # Negotiate the protocol version used in the frames sent to the client,
+            # connections already binary stay binary since both decoders are
+            if data.version and connection.version < CDProto.BINARY_VERSION:
+                version = min(data.version, CDProto.BINARY_VERSION)
+                if version >= CDProto.BINARY_VERSION > connection.version:
+                    # Acknowledged in JSON, every frame after the acknowledgement is binary both ways
+                    ack = CDProto.register(data.user, version)
+                    self.send(connection, CDProto.encode(ack, CDProto.VERSION), bounded=False)
+                    connection.decoder.version = version
+                connection.version = version
+
+            # Add user to the main channel
+            self.join(client_socket, "main")
+
+        # Process Join
+        elif(data.command == "join"):
+            self.join(client_socket, data.channel, data.history, data.since)
+
+        # Process Leave
+        elif(data.command == "leave"):
+            self.leave(client_socket, data.channel)
+
+        # Process search
+        elif(data.command == "search"):
+            connection = self.connections[client_socket]
+            channel = data.channel or "main"
+            index = self.search.get(channel) if self.search is not None else None
+            found = index.search(data.query, SEARCH_RESULTS) if index else []
+            results = CDProto.results(channel, data.query, [encoded.message.message for encoded in found])
+            # The oldest results are left out when they do not fit in a frame
+            while results.messages and not CDProto.fits(results, connection.version):
+                results.messages.pop(0)
+            self.send(connection, CDProto.encode(results, connection.version))
+
+        # Process heartbeats, receiving the pong already marked the client alive
+        elif(data.command == "ping"):
+            connection = self.connections[client_socket]
+            self.send(connection, CDProto.encode(CDProto.pong(), connection.version))
+
+        # Process message
+        elif(data.command == "message"):
+            # Messages are timestamped when the server receives them
+            data.ts = int(time.time())
+
+            # Exit message
+            if data.message == "exit":
+                self.terminate(client_socket)
+
+            # Messages over the rate limits are not sent to anyone
+            elif not self.admit(self.connections[client_socket], data):
+                return
+
+            # Check if the atribute channel exists
+            elif data.channel:
+                self.broadcast(data.channel, data)
+            else:
+                self.broadcast("main", data) # Send the message to all users
+
+    def throttled(self, connection, channel, now) -> float:
+        """Seconds before the client may send to the channel, taking the tokens when 0."""
+        buckets = []
+        if self.client_rate:
+            if connection.bucket is None:
+                connection.bucket = TokenBucket(self.client_rate, self.client_burst, now)
+            buckets.append(connection.bucket)
+        if self.channel_rate and channel in self.channels:
+            bucket = self.channel_buckets.get(channel)
+            if bucket is None:
+                bucket = self.channel_buckets[channel] = TokenBucket(self.channel_rate, self.channel_burst, now)
+            buckets.append(bucket)
+
+        wait = max((bucket.wait(now) for bucket in buckets), default=0)
+        if not wait:
+            for bucket in buckets:
+                bucket.take()
+        return wait
+
+    def admit(self, connection, data) -> bool:
+        """Whether the message is within the rate limits, applying the policy when it is not."""
+        if not (self.client_rate or self.channel_rate):
+            return True
+
+        # Messages sent after delayed ones wait their turn
+        channel = data.channel or "main"
+        wait = self.throttled(connection, channel, time.monotonic()) if not connection.delayed else 1
+        if not wait:
+            return True
+
+        if self.rate_limit == RateLimitPolicy.DELAY and len(connection.delayed) < MAX_DELAYED:
+            self.counters["throttle_delayed"] += 1
+            connection.delayed.append(data)
+            if connection.release_timer is None:
+                connection.release_timer = self.timers.schedule(time.monotonic() + wait, self.release, connection)
+            return False
+
+        self.counters["throttle_dropped"] += 1
+        # One notice per throttle window, a client flooding without reading gets no more
+        now = time.monotonic()
+        if self.rate_limit == RateLimitPolicy.THROTTLE and now >= connection.notice_until:
+            self.counters["throttle_notices"] += 1
+            connection.notice_until = now + wait
+            notice = CDProto.throttle(channel, wait)
+            self.send(connection, CDProto.encode(notice, connection.version))
+        return False
+
+    def release(self, connection):
+        """Send the delayed messages of the client the rate limits now allow."""
+        connection.release_timer = None
+        if self.connections.get(connection.socket) is not connection:
+            return
+
+        now = time.monotonic()
+        while connection.delayed:
+            data = connection.delayed[0]
+            wait = self.throttled(connection, data.channel or "main", now)
+            if wait:
+                connection.release_timer = self.timers.schedule(now + wait, self.release, connection)
+                return
+            connection.delayed.popleft()
+            self.broadcast(data.channel or "main", data)
+
+    def process_peer(self, connection, data):
+        """Process a message received from a linked server."""
+        if data.command == "channels":
+            connection.peer.difference_update(data.remove)
+            connection.peer.update(data.add)
+
+        # Messages from the other servers are not forwarded again, every server is linked to every other
+        elif data.command == "message":
+            self.broadcast(data.channel or "main", data, relay=False)
+
+        elif data.command == "ping":
+            self.send(connection, CDProto.encode(CDProto.pong(), connection.version), bounded=False)
+
+    def link(self, connection):
+        """Make a connection a link to another server and send it our channels."""
+        print(f"SERVER: Linked to server {connection.address}")
+        connection.peer = set()
+        connection.version = CDProto.VERSION
+        self.peers.add(connection)
+        summary = CDProto.channels(add=list(self.channels))
+        self.send(connection, CDProto.encode(summary, CDProto.VERSION), bounded=False)
+
+    def announce(self, add=(), remove=()):
+        """Tell the linked servers which channels got their first member or lost their last."""
+        if self.peers:
+            frame = CDProto.encode(CDProto.channels(add, remove), CDProto.VERSION)
+            for peer in tuple(self.peers):
+                self.send(peer, frame, bounded=False)
+
+    def federate(self, channel, encoded):
+        """Forward a local message once to each linked server with members in the channel."""
+        frame = encoded.frame(CDProto.VERSION)
+        for peer in tuple(self.peers):
+            if channel not in peer.peer:
+                continue
+            if peer.queued_bytes + len(frame) > PEER_MAX_QUEUED_BYTES:
+                self.counters["federation_dropped"] += 1
+                continue
+            self.counters["federated"] += 1
+            self.send(peer, frame, bounded=False)
+
+    @abc.abstractmethod
+    def dial(self, address):
+        """Open a link to another server, retried until it succeeds."""
+
+    def join(self, client_socket, channel, history=None, since=None):
+        """Add the client to the channel and replay its recent messages."""
+        connection = self.connections.get(client_socket)
+        if connection is None:
+            return
+
+        # Create the channel when its first member joins
+        if channel not in self.channels:
+            self.channels[channel] = set()
+            self.announce(add=[channel])
+        self.channels[channel].add(client_socket)
+        connection.channels.add(channel)
+
+        if since is not None and self.log:
+            self.backfill(connection, channel, since)
+        elif channel in self.history:
+            if history is None:
+                history = self.replay_messages
+            for encoded in self.history[channel].replay(history, since):
+                self.send(connection, encoded.frame(connection.version))
+
+    def backfill(self, connection, channel, since):
+        """Replay from the durable log the messages sent to the channel since the timestamp.
+
+        The replay is sent in slices, between the other clients' events, and
+        only while the client's outbound queue has room for its next frame."""
+        if not self.busy():
+            self.schedule_fanout()
+        self.backfills.append(BackfillJob(connection, channel, self.logged_frames(connection, channel, since)))
+
+    def logged_frames(self, connection, channel, since) -> Iterator:
+        """Frames of the messages logged since the timestamp, in the client's version."""
+        for view in self.log.replay(channel, since):
+            position = 0
+            while position + 2 <= len(view):
+                end = position + 2 + int.from_bytes(view[position:position + 2], "big")
+                frame, position = view[position:end], end
+                if connection.version == CDProto.VERSION:
+                    # The log holds version 2 frames, they are sent as they are
+                    yield frame
+                    continue
+
+                try:
+                    message = CDProto.decode(bytes(frame[2:]))
+                except CDProtoBadFormat:
+                    logging.debug("Skipping bad logged frame %r", bytes(frame[2:66]))
+                    continue
+                yield CDProto.encode(message, connection.version)
+
+    def room(self, job) -> bool:
+        """Whether the client of a replay has room for its next frame, or is gone."""
+        connection = job.connection
+        return (not connection.queued_bytes or job.frame is None
+                or connection.queued_bytes + len(job.frame) <= self.max_queued_bytes)
+
+    def resume_backfills(self, budget: int = None):
+        """Send up to <budget> frames of the pending replays, to the clients with room in their queue.
+
+        Replays take turns, a replay waiting for its client to read does not
+        hold back the others. Replays of clients who left are abandoned."""
+        for _ in range(len(self.backfills)):
+            if budget is not None and budget <= 0:
+                break
+            job = self.backfills.popleft()
+            connection = job.connection
+            if self.connections.get(connection.socket) is not connection or job.channel not in connection.channels:
+                continue
+
+            while True:
+                if job.frame is None:
+                    job.frame = next(job.frames, None)
+                if job.frame is None or not self.room(job) or (budget is not None and budget <= 0):
+                    break
+                frame, job.frame = job.frame, None
+                self.send(connection, frame)
+                if budget is not None:
+                    budget -= 1
+            if job.frame is not None:
+                self.backfills.append(job)
+
+    def busy(self) -> bool:
+        """Whether fan-outs or replays are pending."""
+        return bool(self.fanouts or self.backfills)
+
+    def ready(self) -> bool:
+        """Whether pending fan-outs or replays can make progress right away."""
+        return bool(self.fanouts) or any(self.room(job) for job in self.backfills)
+
+    def leave(self, client_socket, channel):
+        """Remove the client from the channel."""
+        members = self.channels.get(channel)
+        if members is None:
+            return
+
+        members.discard(client_socket)
+        connection = self.connections.get(client_socket)
+        if connection:
+            connection.channels.discard(channel)
+
+        # Forget empty channels, except the main one
+        if not members and channel != "main":
+            del self.channels[channel]
+            self.channel_rates.pop(channel, None)
+            self.channel_buckets.pop(channel, None)
+            self.announce(remove=[channel])
+
+    def broadcast(self, channel, data, relay=True):
+        """Send a message to every member of the channel.
+
+        Messages relayed from another worker or server are not relayed again."""
+        # The frame is encoded once per protocol version and reused for every member
+        encoded = EncodedMessage(data)
+
+        # Binary messages may be too large for the JSON frames of the other members, the log and the links
+        if not self.encodable(encoded):
+            print("SERVER: Message too large")
+            self.counters["oversize_dropped"] += 1
+            return
+
+        meter = self.channel_rates.get(channel)
+        if meter is None:
+            meter = self.channel_rates[channel] = RateMeter()
+        meter.mark(time.monotonic())
+
+        if self.history_messages:
+            history = self.history.get(channel)
+            if history is None:
+                history = self.history[channel] = ChannelHistory(self.history_messages, self.history_bytes)
+            evicted = history.append(encoded)
+
+            if self.search is not None:
+                index = self.search.get(channel)
+                if index is None:
+                    index = self.search[channel] = SearchIndex()
+                index.add(encoded)
+                for _ in evicted:
+                    index.evict()
+
+        if self.log:
+            self.log.append(channel, encoded.frame(CDProto.VERSION), data.ts)
+
+        members = tuple(self.channels.get(channel, ()))
+        jobs = self.fanouts.get(channel)
+        if len(members) > self.fanout_slice or jobs:
+            # Large channels are sent to in slices, between the other clients' events,
+            # the next messages of a channel wait for its fan-outs to keep their order
+            if not self.busy():
+                self.schedule_fanout()
+            if jobs is None:
+                jobs = self.fanouts[channel] = deque()
+            jobs.append(FanoutJob(channel, encoded, members))
+        else:
+            for client in members:
+                connection = self.connections.get(client)
+                if connection:
+                    self.send(connection, encoded.frame(connection.version))
+
+        # Members connected to the other workers and servers
+        if self.bus and relay:
+            self.bus.publish(encoded.frame(CDProto.VERSION))
+        if self.peers and relay:
+            self.federate(channel, encoded)
+
+    def encodable(self, encoded) -> bool:
+        """Whether the message has a frame in every JSON version."""
+        try:
+            frame = encoded.frame(CDProto.VERSION)
+            # Escaping makes legacy frames at most 6 times larger
+            if len(frame) * 6 > MAX_JSON_BYTES:
+                encoded.frame(CDProto.LEGACY_VERSION)
+        except CDProtoBadFormat:
+            return False
+        return True
+
+    def fanout(self, budget: int = None):
+        """Make up to <budget> deliveries of the pending fan-outs, every one when None.
+
+        Channels with pending fan-outs take turns, each getting a share of
+        the budget, so a large channel does not hold back the others. The
+        fan-outs of a channel run in the order of its messages so every
+        member receives them in order. Members who left meanwhile are skipped."""
+        share = None if budget is None else max(budget // max(len(self.fanouts), 1), 1)
+        while self.fanouts and (budget is None or budget > 0):
+            channel, jobs = next(iter(self.fanouts.items()))
+            made = self.fanout_channel(jobs, share if budget is None else min(share, budget))
+            if budget is not None:
+                budget -= made
+            if jobs:
+                self.fanouts.move_to_end(channel)
+            else:
+                del self.fanouts[channel]
+
+    def fanout_channel(self, jobs: deque, budget: int = None) -> int:
+        """Make up to <budget> deliveries of the fan-outs of a channel, the number made."""
+        made = 0
+        while jobs and (budget is None or made < budget):
+            job = jobs[0]
+            end = len(job.members) if budget is None else min(job.position + budget - made, len(job.members))
+            for client in islice(job.members, job.position, end):
+                connection = self.connections.get(client)
+                if connection and job.channel in connection.channels:
+                    self.send(connection, job.encoded.frame(connection.version))
+
+            made += end - job.position
+            job.position = end
+            if job.position == len(job.members):
+                jobs.popleft()
+        return made
+
+    def schedule_fanout(self):
+        """Arrange for the pending fan-outs to run, engines without a polling loop override it."""
+
+    def relay(self, sock=None, mask=None):
+        """Deliver the messages relayed by the other workers to the local members."""
+        for data in self.bus.receive():
+            self.broadcast(data.channel or "main", data, relay=False)
+
+    def send(self, connection, frame, bounded=True):
+        """Queue a frame to the client, applying the slow consumer policy when the queue is full.
+
+        Replays are not bounded, they are sent whatever their size."""
+        if bounded and connection.queued_bytes + len(frame) > self.max_queued_bytes:
+            if self.slow_consumer == SlowConsumerPolicy.DISCONNECT:
+                logging.debug("Disconnecting slow client %s", connection.socket)
+                self.counters["slow_disconnects"] += 1
+                self.terminate(connection.socket)
+                return
+
+            if self.slow_consumer == SlowConsumerPolicy.DROP_NEWEST:
+                self.drop(connection, 1)
+                return
+
+            # Drop the oldest frames, except the one already partially sent
+            dropped = 0
+            keep = 1 if connection.sent_offset else 0
+            while len(connection.outbound) > keep and \
+                    connection.queued_bytes + len(frame) > self.max_queued_bytes:
+                old = connection.outbound[keep]
+                del connection.outbound[keep]
+                connection.queued_bytes -= len(old)
+                self.counters["queued_bytes"] -= len(old)
+                dropped += 1
+
+            if connection.queued_bytes + len(frame) > self.max_queued_bytes:
+                self.drop(connection, dropped + 1)
+                return
+            self.drop(connection, dropped)
+
+        connection.outbound.append(frame)
+        connection.queued_bytes += len(frame)
+        self.counters["queued_bytes"] += len(frame)
+
+        if not connection.writing:
+            self.schedule(connection)
+
+    def drop(self, connection, frames):
+        """Account frames dropped from the client's outbound queue."""
+        if frames:
+            connection.dropped_frames += frames
+            self.counters["dropped_frames"] += frames
+
+    def count_send(self, connection, frames):
+        """Account a send call carrying <frames> complete frames."""
+        connection.sends += 1
+        connection.frames_sent += frames
+        self.counters["sends"] += 1
+        self.counters["frames_sent"] += frames
+        self.frames_per_send.record(frames)
+
+    def stats(self) -> dict:
+        """Snapshot of the server metrics."""
+        now = time.monotonic()
+        channels = heapq.nlargest(
+            STATS_TOP, self.channel_rates.items(), key=lambda item: item[1].rate(now)
+        )
+        clients = heapq.nlargest(
+            STATS_TOP, self.connections.values(), key=lambda connection: connection.queued_bytes
+        )
+
+        return {
+            "uptime": now - self.started,
+            "clients": len(self.connections) - len(self.peers),
+            "peers": len(self.peers),
+            "channels": len(self.channels),
+            "counters": dict(self.counters),
+            "frames_per_send": dict(self.frames_per_send),
+            "loop_latency_us": dict(self.loop_latency),
+            "hot_channels": {
+                channel: {
+                    "members": len(self.channels.get(channel, ())),
+                    "messages": meter.count,
+                    "rate": meter.rate(now),
+                }
+                for channel, meter in channels
+            },
+            "deepest_queues": [
+                {
+                    "name": connection.name,
+                    "address": str(connection.address),
+                    "queued_bytes": connection.queued_bytes,
+                    "queued_frames": len(connection.outbound),
+                    "dropped_frames": connection.dropped_frames,
+                }
+                for connection in clients
+            ],
+        }
+
+    def stats_report(self) -> bytes:
+        """Metrics snapshot as sent on the admin port."""
+        return json.dumps(self.stats(), sort_keys=True).encode("utf-8") + b"\n"
+
+    def schedule(self, connection):
+        """Flush the client's outbound queue, engines may defer it to coalesce frames."""
+        self.flush(connection)
+
+    @abc.abstractmethod
+    def flush(self, connection):
+        """Send as much of the client's outbound queue as the connection accepts."""
+
+    def watch(self, connection):
+        """Start the idle checks of a new client, when heartbeats or idle timeouts are set."""
+        if connection.peer is None and (self.heartbeat or self.idle_timeout):
+            delay = min(delay for delay in (self.heartbeat, self.idle_timeout) if delay)
+            connection.timer = self.timers.schedule(connection.last_seen + delay, self.check, connection)
+
+    def check(self, connection):
+        """Ping or reap an idle client and schedule its next check.
+
+        The timer is not moved on every received frame, the check compares
+        the time elapsed since the client was last seen instead."""
+        connection.timer = None
+        if self.connections.get(connection.socket) is not connection:
+            return
+
+        now = time.monotonic()
+        idle = now - connection.last_seen
+        if self.idle_timeout and idle >= self.idle_timeout:
+            logging.debug("Reaping client %s idle for %.1f seconds", connection.address, idle)
+            self.counters["reaped"] += 1
+            self.terminate(connection.socket)
+            return
+
+        deadlines = []
+        if self.idle_timeout:
+            deadlines.append(connection.last_seen + self.idle_timeout)
+        if self.heartbeat:
+            if idle >= self.heartbeat:
+                self.counters["pings"] += 1
+                self.send(connection, CDProto.encode(CDProto.ping(), connection.version), bounded=False)
+                deadlines.append(now + self.heartbeat)
+            else:
+                deadlines.append(connection.last_seen + self.heartbeat)
+        connection.timer = self.timers.schedule(min(deadlines), self.check, connection)
+
+    def disconnect(self, client_socket) -> Connection:
+        """Remove the client from every channel and forget its connection."""
+        connection = self.connections.get(client_socket)
+        if connection is None:
+            return None
+
+        for timer in (connection.timer, connection.release_timer):
+            if timer:
+                self.timers.cancel(timer)
+        connection.timer = connection.release_timer = None
+
+        # Links this server opened are opened again
+        self.peers.discard(connection)
+        if connection.dialed:
+            print(f"SERVER: Lost link to server {connection.dialed}")
+            self.timers.schedule(time.monotonic() + PEER_RETRY, self.dial, connection.dialed)
+
+        for channel in tuple(connection.channels):
+            self.leave(client_socket, channel)
+        del self.connections[client_socket]
+        self.counters["queued_bytes"] -= connection.queued_bytes
+        return connection
+
+    @abc.abstractmethod
+    def terminate(self, client_socket):
+        """Remove the client from the server and close its connection."""
+
+
+class Server(BaseServer):
     """Chat Server process."""
 
-    def __init__(self):
+    def __init__(self, reuse_port: bool = False, port: int = 2000, **options):
+        super().__init__(**options)
 
         # Socket setup
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.server_address = ('', 2000)
+        self.server_address = ('', port)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            # Several workers accept connections on the same port
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.socket.bind(self.server_address)
         self.socket.listen(50)
-        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+
+        # Clients with frames queued during the current loop iteration
+        self.pending = set()
 
         # Selector setup
         self.sel = selectors.DefaultSelector()
         self.sel.register(self.socket, selectors.EVENT_READ, self.accept)
+        if self.bus:
+            self.sel.register(self.bus, selectors.EVENT_READ, self.relay)
+
+        # Admin port answering every connection with the metrics
+        if self.admin_port:
+            self.admin_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.admin_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.admin_socket.bind(('127.0.0.1', self.admin_port))
+            self.admin_socket.listen(5)
+            self.sel.register(self.admin_socket, selectors.EVENT_READ, self.admin)
 
-        # Channels, main channel is the default
-        self.channels = {"main": []}
+        # Port the other servers of a federation link to
+        if self.federation_port:
+            self.federation_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.federation_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.federation_socket.bind(('', self.federation_port))
+            self.federation_socket.listen(50)
+            self.sel.register(self.federation_socket, selectors.EVENT_READ, self.accept_peer)
 
     def accept(self, sock, mask):
         """Accept new client connections."""
         client_socket, client_address = sock.accept()
         print(f"SERVER: Connection from {client_address}")
         client_socket.setblocking(False)
+        connection = self.connections[client_socket] = Connection(client_socket, client_address)
         self.sel.register(client_socket, selectors.EVENT_READ, self.receive)
+        self.watch(connection)
 
-    def receive(self, client_socket, mask):
-        """Receive data from the client."""
+    def accept_peer(self, sock, mask):
+        """Accept links from the other servers."""
+        peer_socket, peer_address = sock.accept()
+        peer_socket.setblocking(False)
+        connection = self.connections[peer_socket] = Connection(peer_socket, peer_address)
+        self.sel.register(peer_socket, selectors.EVENT_READ, self.receive)
+        self.link(connection)
+
+    def dial(self, address):
+        """Open a link to another server without blocking, retried until it succeeds.
+
+        The link is made once the socket is writable, or abandoned after PEER_CONNECT_TIMEOUT."""
+        peer_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        peer_socket.setblocking(False)
         try:
-            data = CDProto.recv_msg(client_socket) # Receive message
-        except CDProtoBadFormat:
-            print("SERVER: Bad Format Error")
+            error = peer_socket.connect_ex(address)
+        except OSError as exception:
+            error = exception.errno or errno.EINVAL
+        if error not in (0, errno.EINPROGRESS):
+            self.redial(peer_socket, address, os.strerror(error))
             return
 
-        if data:
-
-            # Process Register
-            if(data.command == "register"):
-                # Add user to the main channel
-                self.channels["main"].append(client_socket)
-
-            # Process Join
-            elif(data.command == "join"):
-                # Remove user from the current channel
-                for channel in self.channels:
-                    if client_socket in self.channels[channel]:
-                        self.channels[channel].remove(client_socket)
-                        break
-
-                # Check if the channel exists
-                if data.channel in self.channels:
-                    # Add user to the channel
-                    self.channels[data.channel].append(client_socket)
-                else:
-                    # Create a new channel
-                    self.channels[data.channel] = [client_socket]
-
-            # Process message
-            elif(data.command == "message"):
-                # Exit message
-                if data.message == "exit":
-                    self.terminate(client_socket)
-
-                # Check if the atribute channel exists
-                elif data.channel:
-                    for client in self.channels[data.channel]:
-                        CDProto.send_msg(client,data)
-                else:
-                    for client in self.channels["main"]:
-                        CDProto.send_msg(client,data) # Send the message to all users  
-
-                
+        timer = self.timers.schedule(time.monotonic() + PEER_CONNECT_TIMEOUT, self.dial_timeout, peer_socket, address)
+        self.sel.register(peer_socket, selectors.EVENT_WRITE, partial(self.dialed, address, timer))
+
+    def dialed(self, address, timer, peer_socket, mask):
+        """Link to another server once its connection completed, or retry when it failed."""
+        self.timers.cancel(timer)
+        self.sel.unregister(peer_socket)
+        error = peer_socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if error:
+            self.redial(peer_socket, address, os.strerror(error))
+            return
+
+        connection = self.connections[peer_socket] = Connection(peer_socket, address)
+        connection.dialed = address
+        self.sel.register(peer_socket, selectors.EVENT_READ, self.receive)
+        self.link(connection)
+
+    def dial_timeout(self, peer_socket, address):
+        """Abandon a connection to another server still not made, its timer is cancelled once it is."""
+        self.sel.unregister(peer_socket)
+        self.redial(peer_socket, address, "timed out")
+
+    def redial(self, peer_socket, address, reason):
+        """Close a failed connection to another server and try again later."""
+        logging.debug("Could not link to %s: %s", address, reason)
+        peer_socket.close()
+        self.timers.schedule(time.monotonic() + PEER_RETRY, self.dial, address)
+
+    def admin(self, sock, mask):
+        """Accept an admin connection and send it the metrics."""
+        admin_socket, _ = sock.accept()
+        admin_socket.setblocking(False)
+        self.report(memoryview(self.stats_report()), admin_socket)
+
+    def report(self, report, admin_socket, mask=None):
+        """Send what the admin connection takes of the metrics, the rest once it is writable, then close it."""
+        try:
+            report = report[admin_socket.send(report):]
+        except (BlockingIOError, InterruptedError):
+            pass
+        except OSError:
+            report = report[:0]
+
+        registered = admin_socket in self.sel.get_map()
+        if not report:
+            if registered:
+                self.sel.unregister(admin_socket)
+            admin_socket.close()
+        elif registered:
+            self.sel.modify(admin_socket, selectors.EVENT_WRITE, partial(self.report, report))
         else:
+            self.sel.register(admin_socket, selectors.EVENT_WRITE, partial(self.report, report))
+
+    def receive(self, client_socket, mask):
+        """Receive data from the client and process every complete frame."""
+        if mask & selectors.EVENT_WRITE:
+            self.flush(self.connections[client_socket])
+            if client_socket not in self.connections or not mask & selectors.EVENT_READ:
+                return
+
+        try:
+            data = client_socket.recv(RECV_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return
+        except ConnectionError:
+            data = b""
+
+        if not data:
             self.terminate(client_socket)
+            return
 
-    def terminate(self, client_socket):
-        for channel in self.channels:
-            if client_socket in self.channels[channel]:
-                self.channels[channel].remove(client_socket)
+        self.handle(client_socket, data)
+
+    def schedule(self, connection):
+        """Send the client's queued frames at the end of the loop iteration."""
+        self.pending.add(connection)
+
+    def flush_pending(self):
+        """Send the frames queued during the loop iteration, one sendmsg call per client."""
+        pending, self.pending = self.pending, set()
+        for connection in pending:
+            if connection.socket in self.connections and not connection.writing:
+                self.flush(connection)
+
+    def flush(self, connection):
+        """Send as much of the client's outbound queue as the socket accepts."""
+        while connection.outbound:
+            buffers = list(islice(connection.outbound, IOV_MAX))
+            buffers[0] = memoryview(buffers[0])[connection.sent_offset:]
+            try:
+                sent = connection.socket.sendmsg(buffers)
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError:
+                self.terminate(connection.socket)
+                return
+            self.counters["bytes_out"] += sent
+
+            # Drop the frames sent, keeping the offset of a partially sent one
+            frames = 0
+            while connection.outbound and sent >= len(connection.outbound[0]) - connection.sent_offset:
+                frame = connection.outbound.popleft()
+                sent -= len(frame) - connection.sent_offset
+                connection.sent_offset = 0
+                connection.queued_bytes -= len(frame)
+                self.counters["queued_bytes"] -= len(frame)
+                frames += 1
+            connection.sent_offset += sent
+            self.count_send(connection, frames)
+
+            if connection.sent_offset:
                 break
+
+        # Only ask the selector for write readiness while there is something left to send
+        writing = bool(connection.outbound)
+        if writing != connection.writing:
+            connection.writing = writing
+            events = selectors.EVENT_READ | selectors.EVENT_WRITE if writing else selectors.EVENT_READ
+            self.sel.modify(connection.socket, events, self.receive)
+
+    def terminate(self, client_socket):
+        """Remove the client from the server and close its connection."""
+        if self.disconnect(client_socket) is None:
+            return
+
         self.sel.unregister(client_socket)
         client_socket.close()
 
     def loop(self):
         """Loop indefinitely."""
         while True:
-            events = self.sel.select()
+            # Wake up for the next tick of the timer wheel when timers are scheduled,
+            # only poll the sockets while fan-outs or replays can go on
+            timeout = 0 if self.ready() else self.timers.timeout(time.monotonic())
+            events = self.sel.select(timeout)
+            start = time.perf_counter()
             for key, mask in events:
                 callback = key.data
                 callback(key.fileobj, mask)
+            self.fanout(self.fanout_slice)
+            self.resume_backfills(self.fanout_slice)
+            self.timers.advance(time.monotonic())
+            self.flush_pending()
+            self.loop_latency.record(int((time.perf_counter() - start) * 1e6))
@@ -0,0 +1,236 @@
+"""Multi-process chat server sharing the chat port between worker processes."""
+import logging
+import multiprocessing
+import os
+import selectors
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+from collections import deque
+
+from .channel_log import LogStore
+from .protocol import CDProto, CDProtoBadFormat, Message
+
+
+# Bytes of relayed frames queued for a worker not up yet or not reading fast enough
+BUS_QUEUE_BYTES = 8 * 1024 * 1024
+
+
+class BusPeer:
+    """Link to another worker and the payloads waiting to be sent on it."""
+
+    __slots__ = ("path", "socket", "outbox", "queued_bytes")
+
+    def __init__(self, path: str):
+        self.path = path
+        self.socket = None
+        self.outbox = deque()
+        self.queued_bytes = 0
+
+
+class ShardBus:
+    """Relays channel messages between the workers of a sharded server.
+
+    Every worker listens on a unix SOCK_SEQPACKET socket in a shared
+    directory and links to the sockets of the other workers. A packet
+    carries the payload of a version 2 frame, so the frame already encoded
+    for the local members is reused as is. Payloads a worker does not take
+    right away, or relayed before it is up, wait in its outbox until its
+    link is writable; they are only dropped once the outbox holds
+    max_queued_bytes. The bus sockets are watched by a selector of its own,
+    the engines watch the bus itself, readable whenever one of them is ready."""
+
+    def __init__(self, directory: str, shard: int, shards: int, max_queued_bytes: int = BUS_QUEUE_BYTES):
+        self.shard = shard
+        self.max_queued_bytes = max_queued_bytes
+        self.selector = selectors.DefaultSelector()
+
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self.listener.bind(self.path(directory, shard))
+        self.listener.listen(shards)
+        self.listener.setblocking(False)
+        self.selector.register(self.listener, selectors.EVENT_READ)
+
+        self.relayed = 0
+        self.dropped = 0
+
+        # Workers not up yet are linked to once they link to this one, or on the next publish
+        self.peers = [BusPeer(self.path(directory, i)) for i in range(shards) if i != shard]
+        for peer in self.peers:
+            self.link(peer)
+
+    @staticmethod
+    def path(directory: str, shard: int) -> str:
+        """Path of the socket of a shard."""
+        return os.path.join(directory, f"shard-{shard}.sock")
+
+    def fileno(self) -> int:
+        return self.selector.fileno()
+
+    def link(self, peer: BusPeer) -> bool:
+        """Connect to another worker, False when it is not up."""
+        link = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        link.setblocking(False)
+        try:
+            link.connect(peer.path)
+        except OSError as error:
+            logging.debug("Could not link to %s: %s", peer.path, error)
+            link.close()
+            return False
+        peer.socket = link
+        return True
+
+    def unlink(self, peer: BusPeer):
+        """Close the link to a worker, its payloads wait for the next link."""
+        if peer.socket in self.selector.get_map():
+            self.selector.unregister(peer.socket)
+        peer.socket.close()
+        peer.socket = None
+
+    def publish(self, frame: bytes):
+        """Send a version 2 frame to every other worker."""
+        payload = memoryview(frame)[2:]
+        for peer in self.peers:
+            if peer.queued_bytes + len(payload) > self.max_queued_bytes:
+                logging.warning("Relay queue to %s is full, dropping a message", peer.path)
+                self.dropped += 1
+                continue
+            peer.outbox.append(payload)
+            peer.queued_bytes += len(payload)
+            self.flush(peer)
+
+    def flush(self, peer: BusPeer):
+        """Send the payloads queued for a worker until its link is full."""
+        if peer.socket is None and not self.link(peer):
+            return
+
+        while peer.outbox:
+            try:
+                peer.socket.send(peer.outbox[0])
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError as error:
+                logging.warning("Lost the link to %s: %s", peer.path, error)
+                self.unlink(peer)
+                return
+            payload = peer.outbox.popleft()
+            peer.queued_bytes -= len(payload)
+            self.relayed += 1
+
+        # Only ask for write readiness while payloads are left
+        registered = peer.socket in self.selector.get_map()
+        if peer.outbox and not registered:
+            self.selector.register(peer.socket, selectors.EVENT_WRITE, peer)
+        elif not peer.outbox and registered:
+            self.selector.unregister(peer.socket)
+
+    def receive(self) -> list[Message]:
+        """Read every message relayed by the other workers, and send the payloads their links now take."""
+        messages = []
+        for key, _ in self.selector.select(0):
+            if key.fileobj is self.listener:
+                self.accept(messages)
+            elif key.data is not None:
+                self.flush(key.data)
+            else:
+                self.read(key.fileobj, messages)
+        return messages
+
+    def accept(self, messages: list):
+        """Accept the links of the other workers, and link back to the ones not linked to yet."""
+        while True:
+            try:
+                link, _ = self.listener.accept()
+            except (BlockingIOError, InterruptedError):
+                break
+            link.setblocking(False)
+            self.selector.register(link, selectors.EVENT_READ)
+            self.read(link, messages)
+
+        for peer in self.peers:
+            if peer.socket is None:
+                self.flush(peer)
+
+    def read(self, link: socket.socket, messages: list):
+        """Read the packets a worker relayed on its link."""
+        while True:
+            try:
+                payload = link.recv(1 << 16)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                payload = b""
+            if not payload:
+                self.selector.unregister(link)
+                link.close()
+                return
+
+            try:
+                message = CDProto.decode(payload)
+            except CDProtoBadFormat:
+                logging.debug("Bad relayed frame %r", payload)
+                continue
+
+            if message:
+                messages.append(message)
+
+    def close(self):
+        """Close the bus sockets."""
+        for key in tuple(self.selector.get_map().values()):
+            key.fileobj.close()
+        for peer in self.peers:
+            if peer.socket is not None:
+                peer.socket.close()
+        self.selector.close()
+
+
+def _worker(engine: type, directory: str, shard: int, shards: int, options: dict,
+            log_options: dict):
+    """Run one worker of the sharded server."""
+    if log_options:
+        # Every worker logs the whole channels in its own directory
+        log_directory = os.path.join(log_options["directory"], f"shard-{shard}")
+        options = dict(options, log=LogStore(**dict(log_options, directory=log_directory)))
+
+    # Each worker answers its own metrics on the port following the previous worker's
+    if options.get("admin_port"):
+        options = dict(options, admin_port=options["admin_port"] + shard)
+
+    server = engine(reuse_port=True, bus=ShardBus(directory, shard, shards), **options)
+    try:
+        server.loop()
+    except KeyboardInterrupt:
+        pass
+
+
+def serve(workers: int, engine: type, log_options: dict = None, **options):
+    """Run the chat server <engine> in <workers> processes sharing the chat port.
+
+    The kernel spreads new connections between the workers (SO_REUSEPORT)
+    and channel messages are relayed to the other workers over a ShardBus.
+    log_options are the LogStore arguments of the durable log, if any. The
+    workers listen on consecutive admin ports starting at admin_port."""
+    directory = tempfile.mkdtemp(prefix="cdchat-")
+
+    # Stopping the server with SIGTERM also stops the workers
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    processes = [
+        multiprocessing.Process(target=_worker, args=(engine, directory, shard, workers, options, log_options))
+        for shard in range(workers)
+    ]
+
+    try:
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+                process.join()
+        shutil.rmtree(directory, ignore_errors=True)
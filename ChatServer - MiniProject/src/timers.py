@@ -0,0 +1,80 @@
+"""Hashed timer wheel scheduling the chat server timeouts."""
+import math
+
+# Default seconds between two ticks of the wheel
+TICK = 0.5
+
+# Default number of slots of the wheel
+SLOTS = 512
+
+
+class Timer:
+    """A callback scheduled on a TimerWheel."""
+
+    __slots__ = ("tick", "callback", "args", "slot")
+
+    def __init__(self, tick: int, callback, args: tuple):
+        self.tick = tick
+        self.callback = callback
+        self.args = args
+        self.slot = None
+
+
+class TimerWheel:
+    """Hashed timer wheel: timers hash to the slot of their expiry tick.
+
+    Scheduling and cancelling a timer are O(1) whatever the number of
+    timers; advancing the wheel only looks at the slots of the ticks that
+    passed. Timers further away than a revolution stay in their slot until
+    the tick they expire at comes."""
+
+    def __init__(self, tick: float = TICK, slots: int = SLOTS, now: float = 0.0):
+        self.resolution = tick
+        self.slots = [set() for _ in range(slots)]
+        self.current = int(now / tick)
+        self.count = 0
+
+    def __len__(self) -> int:
+        """Number of timers scheduled."""
+        return self.count
+
+    def schedule(self, deadline: float, callback, *args) -> Timer:
+        """Run callback(*args) once the wheel reaches the deadline."""
+        tick = max(math.ceil(deadline / self.resolution), self.current + 1)
+        timer = Timer(tick, callback, args)
+        timer.slot = self.slots[tick % len(self.slots)]
+        timer.slot.add(timer)
+        self.count += 1
+        return timer
+
+    def cancel(self, timer: Timer):
+        """Forget a timer not run yet."""
+        if timer.slot is not None:
+            timer.slot.discard(timer)
+            timer.slot = None
+            self.count -= 1
+
+    def timeout(self, now: float) -> float:
+        """Seconds until the next tick, None when no timer is scheduled."""
+        if not self.count:
+            return None
+        return max((self.current + 1) * self.resolution - now, 0)
+
+    def advance(self, now: float) -> int:
+        """Run the timers expired at <now> and return how many ran."""
+        target = int(now / self.resolution)
+        expired = []
+
+        # A revolution visits every slot, longer jumps need no more steps
+        steps = min(target - self.current, len(self.slots))
+        for tick in range(self.current + 1, self.current + steps + 1):
+            slot = self.slots[tick % len(self.slots)]
+            if slot:
+                expired.extend(timer for timer in slot if timer.tick <= target)
+        self.current = max(self.current, target)
+
+        for timer in expired:
+            self.cancel(timer)
+        for timer in expired:
+            timer.callback(*timer.args)
+        return len(expired)
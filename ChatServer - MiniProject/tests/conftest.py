@@ -0,0 +1,91 @@
+import asyncio
+import selectors
+import socket
+import threading
+from unittest.mock import patch
+
+import pytest
+
+from src.aio_server import AsyncServer
+from src.server import Connection, Server
+
+
+@pytest.fixture
+def make_server():
+    """Build servers without binding the chat port."""
+
+    def make(**kwargs):
+        with patch("socket.socket"), patch("selectors.DefaultSelector.register"):
+            return Server(**kwargs)
+
+    return make
+
+
+@pytest.fixture
+def connect():
+    """Attach one end of a socket pair to a server as a client connection."""
+    pairs = []
+
+    def attach(server):
+        server_side, client_side = socket.socketpair()
+        server_side.setblocking(False)
+        pairs.append((server_side, client_side))
+        server.connections[server_side] = Connection(server_side)
+        server.sel.register(server_side, selectors.EVENT_READ, server.receive)
+        return server_side, client_side
+
+    yield attach
+
+    for server_side, client_side in pairs:
+        server_side.close()
+        client_side.close()
+
+
+class Stopped(Exception):
+    pass
+
+
+@pytest.fixture(params=["selectors", "asyncio"])
+def start(request):
+    """Start a chat server on a free port with either engine.
+
+    Returns the server, its address and a coroutine function stopping it."""
+
+    async def start_asyncio(**options):
+        server = AsyncServer(**options)
+        server.server_address = ("127.0.0.1", 0)
+        task = asyncio.create_task(server.serve())
+        while server.listener is None:
+            await asyncio.sleep(0.01)
+
+        async def stop():
+            server.stop()
+            await asyncio.wait_for(task, 1)
+
+        return server, server.listener.sockets[0].getsockname(), stop
+
+    async def start_selectors(**options):
+        server = Server(port=0, **options)
+        address = ("127.0.0.1", server.socket.getsockname()[1])
+
+        def serve():
+            try:
+                server.loop()
+            except Stopped:
+                pass
+            for client in tuple(server.connections):
+                server.terminate(client)
+            server.socket.close()
+
+        thread = threading.Thread(target=serve, daemon=True)
+        thread.start()
+
+        async def stop():
+            # The loop ends on its next select, woken up by a connection
+            with patch.object(server.sel, "select", side_effect=Stopped):
+                socket.create_connection(address).close()
+                await asyncio.get_running_loop().run_in_executor(None, thread.join, 1)
+
+        return server, address, stop
+
+    return start_asyncio if request.param == "asyncio" else start_selectors
@@ -0,0 +1,61 @@
+"""Tests for the asyncio chat client library."""
+import asyncio
+
+from src.aio_client import AsyncClient
+from src.protocol import CDProto
+
+
+def test_pipelined_messages(start):
+    async def scenario():
+        server, address, stop = await start()
+        bot = AsyncClient("bot", *address)
+        reader = AsyncClient("reader", *address, version=CDProto.VERSION)
+        await bot.connect()
+        await reader.connect()
+        assert bot.version == CDProto.BINARY_VERSION
+        assert reader.version == CDProto.VERSION
+
+        reader.join("#cd", history=0)
+        await reader.drain()
+        await asyncio.sleep(0.1)
+
+        # Thousands of sends are batched without waiting for the server
+        for i in range(2000):
+            bot.send(f"message {i}", "#cd")
+        await bot.drain()
+
+        received = []
+        async for message in reader:
+            received.append(message.message)
+            if len(received) == 2000:
+                break
+        assert received == [f"message {i}" for i in range(2000)]
+
+        # Results and other messages are delivered to the callback when there is one
+        results = asyncio.get_running_loop().create_future()
+        bot.on_message = lambda message: message.command == "results" and results.set_result(message)
+        bot.search("message 1999", "#cd")
+        assert (await asyncio.wait_for(results, 1)).messages == ["message 1999"]
+
+        await bot.close()
+        await stop()
+        assert [message async for message in reader] == []
+
+    asyncio.run(scenario())
+
+
+def test_client_made_outside_the_loop(start):
+    # Python 3.9 binds the events and queues to the loop current when they are made
+    client = AsyncClient("bot", version=CDProto.VERSION)
+
+    async def scenario():
+        server, address, stop = await start()
+        client.address = address
+        await client.connect()
+        client.send("Hello")
+        await client.drain()
+        await client.close()
+        await stop()
+        assert [message async for message in client] == []
+
+    asyncio.run(scenario())
@@ -0,0 +1,41 @@
+"""Tests for the chat server engines over real connections."""
+import asyncio
+
+from src.protocol import CDProto, CDProtoDecoder
+
+
+async def client(address, name):
+    reader, writer = await asyncio.open_connection(*address)
+    writer.write(CDProto.encode(CDProto.register(name, CDProto.VERSION), CDProto.VERSION))
+    await writer.drain()
+    return reader, writer
+
+
+async def read_message(reader):
+    decoder = CDProtoDecoder()
+    while True:
+        decoder.feed(await reader.read(1 << 16))
+        for frame in decoder.frames():
+            return CDProto.decode(frame)
+
+
+def test_fan_out_and_shutdown(start):
+    async def scenario():
+        server, address, stop = await start()
+        foo_reader, foo_writer = await client(address, "foo")
+        bar_reader, bar_writer = await client(address, "bar")
+        await asyncio.sleep(0.1)
+
+        foo_writer.write(CDProto.encode(CDProto.message("Hello"), CDProto.VERSION))
+        message = await asyncio.wait_for(read_message(bar_reader), 1)
+        assert message.message == "Hello"
+        assert len(server.channels["main"]) == 2
+
+        await stop()
+
+        assert server.connections == {}
+        assert await asyncio.wait_for(bar_reader.read(), 1) == b""
+        foo_writer.close()
+        bar_writer.close()
+
+    asyncio.run(scenario())
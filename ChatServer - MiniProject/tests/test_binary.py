@@ -0,0 +1,147 @@
+"""Tests for the binary protocol version."""
+import pytest
+
+from src.protocol import CDProto, CDProtoBadFormat, CDProtoDecoder, MAX_FRAME_BYTES
+
+BINARY = CDProto.BINARY_VERSION
+
+
+def roundtrip(msg):
+    decoder = CDProtoDecoder(BINARY)
+    decoder.feed(CDProto.encode(msg, BINARY))
+    frames = list(decoder.frames())
+    assert len(frames) == 1
+    return CDProto.decode(frames[0], BINARY)
+
+
+def test_roundtrip():
+    for msg in (
+        CDProto.register("student", BINARY),
+        CDProto.join("#cd", history=5, since=1615852800),
+        CDProto.join("#cd"),
+        CDProto.leave("#cd"),
+        CDProto.message("Olá", "#cd"),
+        CDProto.message("Hello World"),
+        CDProto.ping(),
+        CDProto.throttle("#cd", 0.25),
+        CDProto.channels(["#cd", "main"], []),
+        CDProto.search("#cd", "hello world"),
+        CDProto.results("#cd", "hello", ["hello world", "hello"]),
+    ):
+        assert str(roundtrip(msg)) == str(msg)
+
+
+def test_compact_and_unbounded():
+    msg = CDProto.message("Hello World", "#cd")
+    assert len(CDProto.encode(msg, BINARY)) < len(CDProto.encode(msg, CDProto.VERSION)) / 3
+
+    # Messages are no longer bounded by the 2 bytes header, large ones are compressed
+    large = CDProto.message("a" * 100000, "#cd")
+    frame = CDProto.encode(large, BINARY)
+    assert len(frame) < 1000
+    assert roundtrip(large).message == large.message
+
+
+def test_bad_frames():
+    decoder = CDProtoDecoder(BINARY)
+    decoder.feed(b"\xff\xff\xff\x7f")
+    with pytest.raises(CDProtoBadFormat):
+        list(decoder.frames())
+    assert MAX_FRAME_BYTES < 0xfffffff
+
+    with pytest.raises(CDProtoBadFormat):
+        CDProto.decode(b"\x63\x00", BINARY)
+    with pytest.raises(CDProtoBadFormat):
+        CDProto.decode(b"\x01\x01\x10ab", BINARY)
+
+
+def test_negotiation(make_server, connect):
+    server = make_server()
+    foo, foo_peer = connect(server)
+    bar, bar_peer = connect(server)
+
+    # The register frame is JSON, the join frame after it already binary
+    register = CDProto.encode(CDProto.register("foo", BINARY), CDProto.VERSION)
+    join = CDProto.encode(CDProto.join("#cd"), BINARY)
+    server.handle(foo, register + join)
+    server.process(bar, CDProto.register("bar"))
+    server.process(bar, CDProto.message("Hello", "#cd"))
+    server.flush_pending()
+
+    assert server.channels["#cd"] == {foo}
+    decoder = CDProtoDecoder()
+    decoder.feed(foo_peer.recv(1024))
+    ack = next(decoder.frames())
+    assert CDProto.decode(ack).version == BINARY
+
+    decoder.version = BINARY
+    assert [CDProto.decode(frame, BINARY).message for frame in decoder.frames()] == ["Hello"]
+
+    # Clients not asking for it keep receiving JSON
+    world = CDProto.message("World")
+    server.process(foo, world)
+    server.flush_pending()
+    assert bar_peer.recv(1024) == CDProto.encode(world)
+
+
+def test_large_binary_message_to_json_members(make_server, connect):
+    server = make_server()
+    foo, foo_peer = connect(server)
+    bar, bar_peer = connect(server)
+    server.handle(foo, CDProto.encode(CDProto.register("foo", BINARY), CDProto.VERSION))
+    server.process(bar, CDProto.register("bar", CDProto.VERSION))
+    server.flush_pending()
+    foo_peer.recv(1024)
+
+    # Too large for the 2 bytes header of the JSON frames, it is dropped instead of crashing the server
+    large = CDProto.message("a" * 70000)
+    server.handle(foo, CDProto.encode(large, BINARY))
+    assert server.counters["oversize_dropped"] == 1
+    assert "main" not in server.history
+
+    small = CDProto.message("Hello")
+    server.handle(foo, CDProto.encode(small, BINARY))
+    server.flush_pending()
+    decoder = CDProtoDecoder(CDProto.VERSION)
+    decoder.feed(bar_peer.recv(1024))
+    assert [CDProto.decode(frame, CDProto.VERSION).message for frame in decoder.frames()] == ["Hello"]
+    assert not CDProto.fits(large, CDProto.VERSION)
+    assert CDProto.fits(large, BINARY)
+
+
+def test_quotes_from_binary_to_json_members(make_server, connect):
+    server = make_server()
+    foo, foo_peer = connect(server)
+    bar, bar_peer = connect(server)
+    server.handle(foo, CDProto.encode(CDProto.register("foo", BINARY), CDProto.VERSION))
+    server.process(bar, CDProto.register("bar", CDProto.VERSION))
+    server.process(bar, CDProto.join('#"q\\'))
+    server.handle(foo, CDProto.encode(CDProto.join('#"q\\'), BINARY))
+    server.flush_pending()
+    foo_peer.recv(1024)
+
+    # Binary text is escaped when it is encoded again as JSON
+    server.handle(foo, CDProto.encode(CDProto.message('a"b\\c', '#"q\\'), BINARY))
+    server.flush_pending()
+    decoder = CDProtoDecoder(CDProto.VERSION)
+    decoder.feed(bar_peer.recv(1024))
+    received = [CDProto.decode(frame, CDProto.VERSION) for frame in decoder.frames()]
+    assert [(message.message, message.channel) for message in received] == [('a"b\\c', '#"q\\')]
+
+
+def test_register_again_keeps_binary(make_server, connect):
+    server = make_server()
+    foo, foo_peer = connect(server)
+    server.handle(foo, CDProto.encode(CDProto.register("foo", BINARY), CDProto.VERSION))
+    server.handle(foo, CDProto.encode(CDProto.register("bar", CDProto.VERSION), BINARY))
+    server.handle(foo, CDProto.encode(CDProto.message("Hello"), BINARY))
+    server.flush_pending()
+
+    connection = server.connections[foo]
+    assert connection.name == "bar"
+    assert connection.version == connection.decoder.version == BINARY
+    decoder = CDProtoDecoder()
+    decoder.feed(foo_peer.recv(1024))
+    next(decoder.frames())
+    decoder.version = BINARY
+    assert [CDProto.decode(frame, BINARY).message for frame in decoder.frames()] == ["Hello"]
@@ -0,0 +1,124 @@
+"""Tests for the durable channel log."""
+import os
+
+from src.channel_log import LogStore
+from src.protocol import CDProto, CDProtoDecoder, TextMessage
+
+
+def frame(text, ts):
+    return CDProto.encode(TextMessage("message", text, "#cd", ts), CDProto.VERSION)
+
+
+def messages(views):
+    decoder = CDProtoDecoder()
+    for view in views:
+        decoder.feed(view)
+    return [CDProto.decode(f) for f in decoder.frames()]
+
+
+def test_replay_since(tmp_path):
+    store = LogStore(str(tmp_path), segment_bytes=1024, index_interval=200)
+    for ts in range(100):
+        store.append("#cd", frame(f"message {ts}", ts), ts)
+
+    assert len(store.logs["#cd"].segments) > 1
+
+    replayed = messages(store.replay("#cd", 42))
+    assert [m.ts for m in replayed] == list(range(42, 100))
+    assert replayed[0].message == "message 42"
+
+    assert store.replay("#cd", 1000) == []
+    assert store.replay("#other", 0) == []
+
+
+def test_restart(tmp_path):
+    store = LogStore(str(tmp_path))
+    for ts in range(10):
+        store.append("#cd", frame(str(ts), ts), ts)
+    store.close()
+
+    # A frame interrupted while written is dropped
+    path = store.logs["#cd"].segments[-1].path
+    with open(path, "ab") as segment:
+        segment.write(frame("lost", 10)[:5])
+
+    store = LogStore(str(tmp_path))
+    store.append("#cd", frame("10", 10), 10)
+
+    assert [m.ts for m in messages(store.replay("#cd", 0))] == list(range(11))
+
+
+def test_retention_by_size(tmp_path):
+    store = LogStore(str(tmp_path), segment_bytes=1024, retention_bytes=2048)
+    for ts in range(200):
+        store.append("#cd", frame(f"message {ts}", ts), ts)
+
+    log = store.logs["#cd"]
+    assert log.size <= 2048 + 1024
+    assert len(os.listdir(log.directory)) == 2 * len(log.segments)
+    assert messages(store.replay("#cd", 0))[-1].ts == 199
+
+
+def test_backfill_on_join(make_server, connect, tmp_path):
+    server = make_server(log=LogStore(str(tmp_path)), history_messages=0)
+    foo, _ = connect(server)
+    bar, bar_client = connect(server)
+
+    server.process(foo, CDProto.join("#cd"))
+    server.process(foo, CDProto.message("Hello", "#cd"))
+    server.process(foo, CDProto.message("World", "#cd"))
+
+    server.process(bar, CDProto.register("bar", CDProto.VERSION))
+    server.process(bar, CDProto.join("#cd", since=0))
+
+    server.resume_backfills()
+    server.flush_pending()
+    bar_client.settimeout(1)
+    replayed = messages([bar_client.recv(1 << 16)])
+    assert [m.message for m in replayed] == ["Hello", "World"]
+
+
+def test_backfill_skips_bad_frames(make_server, connect, tmp_path):
+    store = LogStore(str(tmp_path))
+    server = make_server(log=store, history_messages=0)
+    bar, bar_client = connect(server)
+    store.append("#cd", frame("Hello", 1), 1)
+    bad = b'{"command": "message", "message": "a"b", "ts": 2}'
+    store.append("#cd", len(bad).to_bytes(2, "big") + bad, 2)
+    store.append("#cd", frame("World", 3), 3)
+
+    # A corrupt frame in the log is left out of the replay instead of failing the join
+    server.process(bar, CDProto.register("bar"))
+    server.process(bar, CDProto.join("#cd", since=0))
+    server.resume_backfills()
+    server.flush_pending()
+    bar_client.settimeout(1)
+    decoder = CDProtoDecoder()
+    decoder.feed(bar_client.recv(1 << 16))
+    assert [CDProto.decode(data).message for data in decoder.frames()] == ["Hello", "World"]
+
+
+def test_backfill_waits_for_room(make_server, connect, tmp_path):
+    store = LogStore(str(tmp_path))
+    server = make_server(log=store, history_messages=0, max_queued_bytes=1024)
+    bar, bar_client = connect(server)
+    for i in range(200):
+        store.append("#cd", frame(f"message {i}", i), i)
+
+    # The replay goes on as the client reads, its queue never goes over the limit
+    server.process(bar, CDProto.register("bar"))
+    server.process(bar, CDProto.join("#cd", since=0))
+    bar_client.settimeout(1)
+    decoder = CDProtoDecoder()
+    received = []
+    while len(received) < 200:
+        server.resume_backfills(40)
+        assert server.connections[bar].queued_bytes <= 1024
+        server.flush_pending()
+        server.flush(server.connections[bar])
+        decoder.feed(bar_client.recv(1 << 16))
+        received.extend(CDProto.decode(data).message for data in decoder.frames())
+
+    assert received == [f"message {i}" for i in range(200)]
+    assert server.connections[bar].dropped_frames == 0
+    assert not server.backfills
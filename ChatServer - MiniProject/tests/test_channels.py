@@ -0,0 +1,118 @@
+"""Tests for the server channel membership."""
+from src.protocol import CDProto
+
+
+def test_join_leave(make_server, connect):
+    server = make_server()
+    foo, _ = connect(server)
+    bar, _ = connect(server)
+
+    server.process(foo, CDProto.register("foo"))
+    server.process(bar, CDProto.register("bar"))
+    server.process(foo, CDProto.join("#cd"))
+    server.process(foo, CDProto.join("#c1"))
+
+    assert server.channels["main"] == {foo, bar}
+    assert server.channels["#cd"] == {foo}
+    assert server.connections[foo].channels == {"main", "#cd", "#c1"}
+
+    server.process(foo, CDProto.leave("#cd"))
+    assert "#cd" not in server.channels
+    assert server.connections[foo].channels == {"main", "#c1"}
+
+
+def test_disconnect(make_server, connect):
+    server = make_server()
+    foo, _ = connect(server)
+    bar, _ = connect(server)
+
+    server.process(foo, CDProto.register("foo"))
+    server.process(bar, CDProto.register("bar"))
+    server.process(foo, CDProto.join("#cd"))
+    server.process(bar, CDProto.join("#cd"))
+
+    server.terminate(foo)
+
+    assert server.channels == {"main": {bar}, "#cd": {bar}}
+    assert foo not in server.connections
+
+
+def test_message_to_channel(make_server, connect):
+    server = make_server()
+    foo, foo_client = connect(server)
+    bar, bar_client = connect(server)
+
+    server.process(foo, CDProto.register("foo", CDProto.VERSION))
+    server.process(bar, CDProto.register("bar"))
+    server.process(foo, CDProto.join("#cd"))
+
+    server.process(bar, CDProto.message("Hello", "#cd"))
+    server.process(bar, CDProto.message("World"))
+
+    server.flush_pending()
+    foo_client.settimeout(1)
+    data = foo_client.recv(1 << 16)
+    assert b"Hello" in data
+    assert b"World" in data
+
+    bar_client.settimeout(1)
+    data = bar_client.recv(1 << 16)
+    assert b"Hello" not in data
+    assert b"World" in data
+
+
+def test_sliced_fanout(make_server, connect):
+    server = make_server(fanout_slice=2)
+    clients = [connect(server) for _ in range(5)]
+    for client, _ in clients:
+        server.process(client, CDProto.register("foo", CDProto.VERSION))
+        server.process(client, CDProto.join("#cd"))
+
+    first = CDProto.message("first", "#cd")
+    second = CDProto.message("second", "#cd")
+    server.process(clients[0][0], first)
+    server.process(clients[0][0], second)
+    server.process(clients[4][0], CDProto.leave("#cd"))
+
+    # A slice visits two members, the first message reaches every member first
+    server.fanout(2)
+    assert server.fanouts["#cd"][0].encoded.message is first
+    assert server.fanouts["#cd"][0].position == 2
+    server.fanout(4)
+    server.fanout()
+    assert not server.fanouts
+    server.flush_pending()
+
+    for client, peer in clients[:4]:
+        assert peer.recv(1024) == CDProto.encode(first, CDProto.VERSION) + CDProto.encode(second, CDProto.VERSION)
+    assert not server.connections[clients[4][0]].outbound
+
+
+def test_fanouts_take_turns(make_server, connect):
+    server = make_server(fanout_slice=2)
+    clients = [connect(server) for _ in range(8)]
+    for i, (client, _) in enumerate(clients):
+        server.process(client, CDProto.register("foo", CDProto.VERSION))
+        server.process(client, CDProto.join("#large" if i < 4 else "#other"))
+    small, small_peer = connect(server)
+    server.process(small, CDProto.register("bar", CDProto.VERSION))
+    server.process(small, CDProto.join("#small"))
+
+    for _ in range(3):
+        server.process(clients[0][0], CDProto.message("big", "#large"))
+    server.process(clients[4][0], CDProto.message("other", "#other"))
+
+    # Small channels are sent to right away, behind no fan-out
+    hello = CDProto.message("hello", "#small")
+    server.process(small, hello)
+    assert "#small" not in server.fanouts
+    server.flush_pending()
+    small_peer.settimeout(1)
+    assert small_peer.recv(1024) == CDProto.encode(hello, CDProto.VERSION)
+
+    # The large channels share each slice instead of waiting for each other
+    server.fanout(2)
+    assert server.fanouts["#large"][0].position == 1
+    assert server.fanouts["#other"][0].position == 1
+    server.fanout()
+    assert not server.fanouts
@@ -0,0 +1,82 @@
+"""Tests for the incremental frame decoder."""
+import pytest
+
+from src.protocol import CDProto, CDProtoBadFormat, CDProtoDecoder, JoinMessage, RegisterMessage
+
+
+def frame(content):
+    return len(content).to_bytes(2, "big") + content
+
+
+def test_partial_frames():
+    decoder = CDProtoDecoder()
+    data = frame(b'{"command": "register", "user": "student"}')
+
+    decoder.feed(data[:1])
+    assert list(decoder.frames()) == []
+
+    decoder.feed(data[1:10])
+    assert list(decoder.frames()) == []
+    assert len(decoder) == 10
+
+    decoder.feed(data[10:])
+    frames = list(decoder.frames())
+    assert len(frames) == 1
+    assert isinstance(CDProto.decode(frames[0]), RegisterMessage)
+    assert len(decoder) == 0
+
+
+def test_pipelined_frames():
+    decoder = CDProtoDecoder()
+    register = frame(b'{"command": "register", "user": "student"}')
+    join = frame(b'{"command": "join", "channel": "#cd"}')
+
+    decoder.feed(register + join + join[:5])
+    messages = [CDProto.decode(f) for f in decoder.frames()]
+
+    assert isinstance(messages[0], RegisterMessage)
+    assert isinstance(messages[1], JoinMessage)
+    assert len(messages) == 2
+    assert len(decoder) == 5
+
+    decoder.feed(join[5:])
+    assert isinstance(CDProto.decode(next(decoder.frames())), JoinMessage)
+
+
+def test_versions():
+    msg = CDProto.message("Olá Mundo", "#cd")
+
+    legacy = CDProto.encode(msg)
+    lean = CDProto.encode(msg, CDProto.VERSION)
+
+    assert len(lean) < len(legacy)
+    assert int.from_bytes(lean[:2], "big") == len(lean) - 2
+
+    for data in (legacy, lean):
+        decoder = CDProtoDecoder()
+        decoder.feed(data)
+        decoded = CDProto.decode(next(decoder.frames()))
+        assert decoded.message == "Olá Mundo"
+        assert decoded.channel == "#cd"
+
+
+def test_register_version():
+    assert str(CDProto.register("student", 2)) == (
+        '{"command": "register", "user": "student", "version": 2}'
+    )
+    decoder = CDProtoDecoder()
+    decoder.feed(CDProto.encode(CDProto.register("student", 2), CDProto.VERSION))
+    assert CDProto.decode(next(decoder.frames())).version == 2
+
+
+def test_register_bad_version(make_server, connect):
+    for version in (b'"2"', b"true", b"0", b"[2]"):
+        with pytest.raises(CDProtoBadFormat):
+            CDProto.decode(b'{"command": "register", "user": "student", "version": ' + version + b"}")
+
+    # Bad register frames are skipped, the server keeps running
+    server = make_server()
+    foo, _ = connect(server)
+    server.handle(foo, frame(b'{"command": "register", "user": "foo", "version": "3"}'))
+    assert server.connections[foo].version == CDProto.LEGACY_VERSION
+    assert foo not in server.channels.get("main", ())
@@ -0,0 +1,115 @@
+"""Tests for the links between federated servers."""
+import selectors
+import socket
+
+from src.protocol import CDProto, CDProtoDecoder
+from src.server import Connection
+
+
+def link(a, b):
+    """Link two servers through a socket pair."""
+    sides = socket.socketpair()
+    for server, side in zip((a, b), sides):
+        side.setblocking(False)
+        server.connections[side] = Connection(side)
+        server.sel.register(side, selectors.EVENT_READ, server.receive)
+        server.link(server.connections[side])
+    return sides
+
+
+def exchange(*links):
+    """Deliver the frames sent over the links."""
+    for server, side in links:
+        server.flush_pending()
+    for server, side in links:
+        try:
+            server.handle(side, side.recv(65536))
+        except BlockingIOError:
+            pass
+
+
+def received(peer):
+    decoder = CDProtoDecoder()
+    try:
+        decoder.feed(peer.recv(65536))
+    except BlockingIOError:
+        pass
+    return [CDProto.decode(frame).message for frame in decoder.frames()]
+
+
+def test_federation(make_server, connect):
+    a, b = make_server(), make_server()
+    a_side, b_side = link(a, b)
+    links = ((a, a_side), (b, b_side))
+
+    foo, foo_peer = connect(a)
+    bar, bar_peer = connect(b)
+    foo_peer.setblocking(False)
+    bar_peer.setblocking(False)
+    a.process(foo, CDProto.register("foo", CDProto.VERSION))
+    b.process(bar, CDProto.register("bar", CDProto.VERSION))
+    b.process(bar, CDProto.join("#cd"))
+    exchange(*links)
+
+    # Only the server with members in the channel gets its messages
+    assert a.connections[a_side].peer == {"main", "#cd"}
+    a.process(foo, CDProto.message("to #cd", "#cd"))
+    a.process(foo, CDProto.message("to #c1", "#c1"))
+    exchange(*links)
+    b.flush_pending()
+    assert received(bar_peer) == ["to #cd"]
+    assert a.counters["federated"] == 1
+
+    # Messages from a linked server are not sent back to it
+    b.process(bar, CDProto.message("hello"))
+    exchange(*links)
+    a.flush_pending()
+    b.flush_pending()
+    assert received(foo_peer) == ["hello"]
+    assert b.counters["federated"] == 1
+    assert a.counters["federated"] == 1
+
+    # The channel is withdrawn when its last member leaves
+    b.process(bar, CDProto.leave("#cd"))
+    exchange(*links)
+    assert a.connections[a_side].peer == {"main"}
+    assert a.stats()["peers"] == 1
+
+
+def test_dial_without_blocking(make_server):
+    server = make_server()
+    listener = socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(1)
+    closed = socket.socket()
+    closed.bind(("127.0.0.1", 0))
+
+    # Connections complete in the loop, refused ones are retried later
+    timers = len(server.timers)
+    server.dial(listener.getsockname())
+    server.dial(closed.getsockname())
+    assert not server.peers
+    for _ in range(2):
+        for key, mask in server.sel.select(1):
+            key.data(key.fileobj, mask)
+
+    assert [connection.dialed for connection in server.peers] == [listener.getsockname()]
+    assert len(server.timers) == timers + 1
+    peer, _ = listener.accept()
+    for sock in (listener, closed, peer):
+        sock.close()
+
+
+def test_admin_report(make_server):
+    server = make_server()
+    admin_socket, client = socket.socketpair()
+    listener = type("Listener", (), {"accept": lambda self: (admin_socket, None)})()
+
+    server.admin(listener, selectors.EVENT_READ)
+    client.settimeout(1)
+    data = b""
+    while not data.endswith(b"\n"):
+        data += client.recv(1 << 16)
+    assert b'"counters"' in data
+    assert admin_socket.fileno() == -1
+    client.close()
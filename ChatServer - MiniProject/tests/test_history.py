@@ -0,0 +1,80 @@
+"""Tests for the channel history."""
+from src.history import ChannelHistory
+from src.protocol import CDProto, CDProtoDecoder, EncodedMessage, TextMessage
+
+
+def encoded(text, ts):
+    return EncodedMessage(TextMessage("message", text, "#cd", ts))
+
+
+def test_evict_by_count():
+    history = ChannelHistory(max_messages=3)
+    for i in range(5):
+        history.append(encoded(str(i), i))
+
+    assert len(history) == 3
+    assert [e.message.message for e in history.replay(10)] == ["2", "3", "4"]
+    assert [e.message.message for e in history.replay(2)] == ["3", "4"]
+    assert history.replay(0) == []
+
+
+def test_evict_by_bytes():
+    size = len(encoded("x" * 100, 0).frame(CDProto.VERSION))
+    history = ChannelHistory(max_bytes=3 * size)
+
+    evicted = []
+    for i in range(5):
+        evicted += history.append(encoded("x" * 100, i))
+
+    assert len(history) == 3
+    assert history.bytes == 3 * size
+    assert [e.message.ts for e in evicted] == [0, 1]
+
+
+def test_replay_since():
+    history = ChannelHistory()
+    for i in range(5):
+        history.append(encoded(str(i), 100 + i))
+
+    assert [e.message.ts for e in history.replay(since=103)] == [103, 104]
+    assert history.replay(since=200) == []
+
+
+def test_replay_on_join(make_server, connect):
+    server = make_server(replay_messages=2)
+    foo, _ = connect(server)
+    bar, bar_client = connect(server)
+
+    server.process(foo, CDProto.register("foo"))
+    server.process(foo, CDProto.join("#cd"))
+    for text in ("one", "two", "three"):
+        server.process(foo, CDProto.message(text, "#cd"))
+
+    server.process(bar, CDProto.join("#cd"))
+    server.flush_pending()
+
+    decoder = CDProtoDecoder()
+    bar_client.settimeout(1)
+    decoder.feed(bar_client.recv(1 << 16))
+    assert [CDProto.decode(f).message for f in decoder.frames()] == ["two", "three"]
+
+
+def test_join_bad_replay_fields(make_server, connect):
+    server = make_server()
+    foo, foo_client = connect(server)
+    server.process(foo, CDProto.register("foo", CDProto.VERSION))
+    server.process(foo, CDProto.message("one"))
+    server.flush_pending()
+    foo_client.recv(1 << 16)
+
+    for join in (b'{"command": "join", "channel": "main", "since": "yesterday"}',
+                 b'{"command": "join", "channel": "main", "history": -1}'):
+        server.handle(foo, len(join).to_bytes(2, "big") + join)
+    server.flush_pending()
+
+    decoder = CDProtoDecoder()
+    foo_client.settimeout(1)
+    decoder.feed(foo_client.recv(1 << 16))
+    errors = [CDProto.decode(f) for f in decoder.frames()]
+    assert [error.command for error in errors] == ["error", "error"]
+    assert "since" in errors[0].error and "history" in errors[1].error
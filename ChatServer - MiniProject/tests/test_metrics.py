@@ -0,0 +1,47 @@
+"""Tests for the server metrics."""
+import json
+
+from src.metrics import Histogram, RateMeter
+from src.protocol import CDProto
+
+
+def test_histogram():
+    histogram = Histogram()
+    for value in (0, 1, 2, 3, 4, 5, 1000):
+        histogram.record(value)
+
+    assert histogram == {1: 2, 2: 1, 4: 2, 8: 1, 1024: 1}
+
+
+def test_rate_meter():
+    meter = RateMeter()
+    assert meter.rate(0) == 0
+
+    for i in range(1000):
+        meter.mark(i / 10)
+
+    assert meter.count == 1000
+    assert 9 < meter.rate(100) < 11
+    assert meter.rate(200) < meter.rate(100) / 1000
+
+
+def test_stats(make_server, connect):
+    server = make_server()
+    foo, _ = connect(server)
+    bar, _ = connect(server)
+
+    server.handle(foo, CDProto.encode(CDProto.register("foo")))
+    server.process(foo, CDProto.join("#cd"))
+    server.process(bar, CDProto.join("#cd"))
+    for _ in range(3):
+        server.process(bar, CDProto.message("Hello", "#cd"))
+    server.flush_pending()
+
+    stats = json.loads(server.stats_report())
+
+    assert stats["clients"] == 2
+    assert stats["hot_channels"]["#cd"]["members"] == 2
+    assert stats["hot_channels"]["#cd"]["messages"] == 3
+    assert stats["counters"]["bytes_in"] > 0
+    assert stats["counters"]["bytes_out"] > 0
+    assert {client["name"] for client in stats["deepest_queues"]} == {"foo", None}
@@ -0,0 +1,84 @@
+"""Tests for the server outbound queues."""
+import pytest
+
+from src.server import SlowConsumerPolicy
+
+FRAME = b"x" * 60000
+
+
+def test_queue_flushed_on_write(make_server, connect):
+    server = make_server(max_queued_bytes=30 * len(FRAME))
+    server_side, client_side = connect(server)
+    connection = server.connections[server_side]
+
+    for _ in range(20):
+        server.send(connection, FRAME)
+    server.flush_pending()
+
+    assert connection.queued_bytes > 0
+    assert connection.writing
+    assert server.counters["queued_bytes"] == connection.queued_bytes
+
+    # Reading on the client side lets the selector flush the rest
+    received = 0
+    client_side.settimeout(1)
+    while received < 20 * len(FRAME):
+        received += len(client_side.recv(1 << 20))
+        for key, mask in server.sel.select(timeout=0):
+            key.data(key.fileobj, mask)
+
+    assert received == 20 * len(FRAME)
+    assert connection.dropped_frames == 0
+    assert not connection.writing
+    assert server.counters["queued_bytes"] == 0
+
+
+@pytest.mark.parametrize(
+    "policy", [SlowConsumerPolicy.DROP_OLDEST, SlowConsumerPolicy.DROP_NEWEST]
+)
+def test_drop_policies(make_server, connect, policy):
+    server = make_server(max_queued_bytes=4 * len(FRAME), slow_consumer=policy)
+    server_side, _ = connect(server)
+    connection = server.connections[server_side]
+
+    for _ in range(100):
+        server.send(connection, FRAME)
+        server.flush_pending()
+
+    assert connection.queued_bytes <= 4 * len(FRAME)
+    assert connection.dropped_frames > 0
+    assert server.counters["dropped_frames"] == connection.dropped_frames
+
+
+def test_disconnect_policy(make_server, connect):
+    server = make_server(
+        max_queued_bytes=4 * len(FRAME), slow_consumer=SlowConsumerPolicy.DISCONNECT
+    )
+    server_side, _ = connect(server)
+    connection = server.connections[server_side]
+
+    for _ in range(100):
+        server.send(connection, FRAME)
+        server.flush_pending()
+        if server_side not in server.connections:
+            break
+
+    assert server_side not in server.connections
+    assert server.counters["slow_disconnects"] == 1
+    assert server.counters["queued_bytes"] == 0
+
+
+def test_frames_coalesced(make_server, connect):
+    server = make_server()
+    server_side, client_side = connect(server)
+    connection = server.connections[server_side]
+
+    for i in range(50):
+        server.send(connection, b"%02d" % i)
+    server.flush_pending()
+
+    client_side.settimeout(1)
+    assert client_side.recv(1 << 16) == b"".join(b"%02d" % i for i in range(50))
+    assert connection.sends == 1
+    assert connection.frames_sent == 50
+    assert server.frames_per_send == {64: 1}
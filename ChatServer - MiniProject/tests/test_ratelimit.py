@@ -0,0 +1,96 @@
+"""Tests for the rate limits of the client messages."""
+from src.protocol import CDProto, CDProtoDecoder
+from src.ratelimit import RateLimitPolicy, TokenBucket
+
+
+def received(peer):
+    decoder = CDProtoDecoder()
+    decoder.feed(peer.recv(4096))
+    return [CDProto.decode(frame) for frame in decoder.frames()]
+
+
+def test_token_bucket():
+    bucket = TokenBucket(2, 3)
+
+    for _ in range(3):
+        assert bucket.wait(0) == 0
+        bucket.take()
+    assert bucket.wait(0) == 0.5
+    assert bucket.wait(0.5) == 0
+    bucket.take()
+
+    # Idle buckets fill up to the burst only
+    assert bucket.wait(100) == 0
+    assert bucket.tokens == 3
+
+
+def test_throttle(make_server, connect):
+    server = make_server(client_rate=1, client_burst=2)
+    foo, foo_peer = connect(server)
+    server.process(foo, CDProto.register("foo", CDProto.VERSION))
+
+    for i in range(3):
+        server.process(foo, CDProto.message(f"hello {i}"))
+    server.flush_pending()
+
+    messages = received(foo_peer)
+    assert [message.command for message in messages] == ["message", "message", "throttle"]
+    assert messages[2].channel == "main" and 0 < messages[2].retry <= 1
+    assert server.counters["throttle_dropped"] == 1
+    assert server.counters["throttle_notices"] == 1
+
+
+def test_throttle_notice_once_per_window(make_server, connect):
+    server = make_server(client_rate=1, client_burst=1)
+    foo, foo_peer = connect(server)
+    server.process(foo, CDProto.register("foo", CDProto.VERSION))
+
+    # A client flooding without reading is told to wait once, not once per message dropped
+    for i in range(50):
+        server.process(foo, CDProto.message(f"hello {i}"))
+    assert server.counters["throttle_dropped"] == 49
+    assert server.counters["throttle_notices"] == 1
+    server.flush_pending()
+    assert [message.command for message in received(foo_peer)] == ["message", "throttle"]
+
+    # A new window gets a new notice
+    server.connections[foo].notice_until = 0.0
+    server.process(foo, CDProto.message("hello again"))
+    assert server.counters["throttle_notices"] == 2
+
+
+def test_channel_limit_drop(make_server, connect):
+    server = make_server(channel_rate=1, rate_limit=RateLimitPolicy.DROP)
+    foo, foo_peer = connect(server)
+    bar, _ = connect(server)
+    server.process(foo, CDProto.register("foo", CDProto.VERSION))
+    server.process(foo, CDProto.join("#cd"))
+
+    server.process(bar, CDProto.message("hello", "#cd"))
+    server.process(foo, CDProto.message("hello", "#cd"))
+    server.process(foo, CDProto.message("hello"))
+    server.flush_pending()
+
+    assert [message.channel for message in received(foo_peer)] == ["#cd", None]
+    assert server.counters["throttle_dropped"] == 1
+    assert server.counters["throttle_notices"] == 0
+
+
+def test_delay(make_server, connect):
+    server = make_server(client_rate=1, client_burst=2, rate_limit=RateLimitPolicy.DELAY)
+    foo, foo_peer = connect(server)
+    server.process(foo, CDProto.register("foo", CDProto.VERSION))
+    connection = server.connections[foo]
+
+    for i in range(4):
+        server.process(foo, CDProto.message(f"hello {i}"))
+    assert len(connection.delayed) == 2
+    assert connection.release_timer is not None
+
+    # The bucket refilled
+    connection.bucket.last -= 2
+    server.release(connection)
+    server.flush_pending()
+
+    assert [message.message for message in received(foo_peer)] == [f"hello {i}" for i in range(4)]
+    assert server.counters["throttle_delayed"] == 2
@@ -0,0 +1,68 @@
+"""Tests for the search of the channels history."""
+import pytest
+
+from src.history import ChannelHistory
+from src.protocol import CDProto, CDProtoBadFormat, CDProtoDecoder, EncodedMessage
+from src.search import SearchIndex
+
+
+def test_search_index():
+    history = ChannelHistory(max_messages=3)
+    index = SearchIndex()
+    for text in ("Hello World", "hello there", "General Kenobi", "hello, world!"):
+        encoded = EncodedMessage(CDProto.message(text, "#cd"))
+        index.add(encoded)
+        for _ in history.append(encoded):
+            index.evict()
+
+    def search(query, limit=10):
+        return [encoded.message.message for encoded in index.search(query, limit)]
+
+    # The first message was evicted along with its postings
+    assert search("hello") == ["hello there", "hello, world!"]
+    assert search("World HELLO") == ["hello, world!"]
+    assert search("hello", limit=1) == ["hello, world!"]
+    assert search("kenobi obi") == []
+    assert search("!!") == []
+    assert len(index) == 3
+    assert "there" in index.postings and "hello" in index.postings
+
+
+def test_search_command(make_server, connect):
+    server = make_server()
+    foo, foo_peer = connect(server)
+    server.process(foo, CDProto.register("foo", CDProto.VERSION))
+    server.process(foo, CDProto.join("#cd", history=0))
+    server.process(foo, CDProto.message("first message", "#cd"))
+    server.process(foo, CDProto.message("second message", "#cd"))
+    server.flush_pending()
+    foo_peer.recv(1024)
+
+    server.process(foo, CDProto.search("#cd", "message"))
+    server.process(foo, CDProto.search("#other", "message"))
+    server.flush_pending()
+
+    decoder = CDProtoDecoder()
+    decoder.feed(foo_peer.recv(1024))
+    results = [CDProto.decode(frame) for frame in decoder.frames()]
+    assert results[0].messages == ["first message", "second message"]
+    assert results[1].channel == "#other" and results[1].messages == []
+
+
+def test_search_bad_fields(make_server, connect):
+    for payload in (
+        b'{"command": "search", "channel": "#cd", "query": 42}',
+        b'{"command": "search", "channel": ["#cd"], "query": "hello"}',
+        b'{"command": "message", "message": ["hello"], "channel": "#cd", "ts": 1}',
+        b'{"command": "message", "message": "hello", "channel": 7, "ts": 1}',
+    ):
+        with pytest.raises(CDProtoBadFormat):
+            CDProto.decode(payload)
+
+    # Bad frames are skipped, the server keeps running
+    server = make_server()
+    foo, _ = connect(server)
+    server.process(foo, CDProto.register("foo", CDProto.VERSION))
+    bad = b'{"command": "search", "channel": "main", "query": {"a": 1}}'
+    server.handle(foo, len(bad).to_bytes(2, "big") + bad)
+    assert foo in server.connections
@@ -0,0 +1,75 @@
+"""Tests for the bus between the workers of a sharded server."""
+import selectors
+import time
+
+from src.protocol import CDProto, EncodedMessage
+from src.shard import ShardBus
+
+
+def test_relay(tmp_path):
+    buses = [ShardBus(str(tmp_path), shard, 3) for shard in range(3)]
+
+    frame = EncodedMessage(CDProto.message("Hello", "#cd")).frame(CDProto.VERSION)
+    buses[0].publish(frame)
+    time.sleep(0.1)
+
+    assert buses[0].relayed == 2
+    assert buses[0].receive() == []
+    for bus in buses[1:]:
+        messages = bus.receive()
+        assert len(messages) == 1
+        assert messages[0].message == "Hello"
+        assert messages[0].channel == "#cd"
+
+    for bus in buses:
+        bus.close()
+
+
+def test_missing_peer(tmp_path):
+    bus = ShardBus(str(tmp_path), 0, 2, max_queued_bytes=1024)
+
+    # Messages wait for the worker to come up, until its queue is full
+    for i in range(30):
+        bus.publish(CDProto.encode(CDProto.message(f"Hello {i}"), CDProto.VERSION))
+    assert bus.relayed == 0
+    assert 0 < bus.dropped < 30
+    queued = 30 - bus.dropped
+
+    # The worker coming up links to the bus, which links back and sends the queued messages
+    late = ShardBus(str(tmp_path), 1, 2)
+    bus.receive()
+    assert bus.relayed == queued
+    time.sleep(0.1)
+    assert [message.message for message in late.receive()] == [f"Hello {i}" for i in range(queued)]
+
+    bus.close()
+    late.close()
+
+
+def test_burst(tmp_path):
+    buses = [ShardBus(str(tmp_path), shard, 3) for shard in range(3)]
+    sel = selectors.DefaultSelector()
+    for bus in buses:
+        sel.register(bus, selectors.EVENT_READ)
+
+    # More than the links buffer, the rest waits in the outboxes until they are writable
+    for i in range(2000):
+        buses[0].publish(CDProto.encode(CDProto.message(f"{i} " + "x" * 1000, "#cd"), CDProto.VERSION))
+    assert buses[0].dropped == 0
+
+    received = {1: [], 2: []}
+    deadline = time.monotonic() + 10
+    while min(len(messages) for messages in received.values()) < 2000 and time.monotonic() < deadline:
+        for key, _ in sel.select(1):
+            bus = key.fileobj
+            messages = bus.receive()
+            if bus.shard in received:
+                received[bus.shard].extend(messages)
+
+    for messages in received.values():
+        assert [int(message.message.split()[0]) for message in messages] == list(range(2000))
+    assert buses[0].relayed == 4000
+
+    sel.close()
+    for bus in buses:
+        bus.close()
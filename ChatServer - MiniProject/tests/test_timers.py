@@ -0,0 +1,66 @@
+"""Tests for the timer wheel and the idle clients checks."""
+from src.protocol import CDProto, CDProtoDecoder
+from src.timers import TimerWheel
+
+
+def test_timer_wheel():
+    wheel = TimerWheel(tick=1, slots=8)
+    fired = []
+    wheel.schedule(3, fired.append, "soon")
+    wheel.schedule(20, fired.append, "after a revolution")
+    cancelled = wheel.schedule(3, fired.append, "cancelled")
+    wheel.cancel(cancelled)
+
+    assert len(wheel) == 2
+    assert wheel.timeout(0.25) == 0.75
+
+    assert wheel.advance(2.5) == 0
+    assert wheel.advance(3) == 1
+    assert fired == ["soon"]
+
+    # Slot 4 is visited again at tick 12, before the second timer expires
+    assert wheel.advance(12) == 0
+    assert wheel.advance(100) == 1
+    assert fired == ["soon", "after a revolution"]
+    assert len(wheel) == 0
+    assert wheel.timeout(100) is None
+
+
+def test_idle_client_reaped(make_server, connect):
+    server = make_server(idle_timeout=30)
+    client, _ = connect(server)
+    server.process(client, CDProto.join("#cd"))
+    connection = server.connections[client]
+
+    # Activity postpones the reaping
+    connection.last_seen -= 20
+    server.check(connection)
+    assert client in server.channels["#cd"]
+    assert len(server.timers) == 1
+
+    connection.last_seen -= 20
+    server.check(connection)
+    assert client not in server.connections
+    assert "#cd" not in server.channels
+    assert server.counters["reaped"] == 1
+
+
+def test_heartbeat(make_server, connect):
+    server = make_server(heartbeat=10)
+    client, peer = connect(server)
+    server.process(client, CDProto.register("foo", CDProto.VERSION))
+    connection = server.connections[client]
+
+    connection.last_seen -= 15
+    server.check(connection)
+    server.flush_pending()
+
+    decoder = CDProtoDecoder()
+    decoder.feed(peer.recv(1024))
+    assert [CDProto.decode(frame).command for frame in decoder.frames()] == ["ping"]
+    assert client in server.connections
+
+    # The server answers the pings of the clients
+    server.handle(client, CDProto.encode(CDProto.ping(), CDProto.VERSION))
+    server.flush_pending()
+    assert peer.recv(1024) == CDProto.encode(CDProto.pong(), CDProto.VERSION)
@@ -1,7 +1,33 @@
 """Call broker."""
+import argparse
 
 from src.broker import Broker
+from src.outbox import MAX_PENDING, SlowConsumerPolicy
+from src.topiclog import SEGMENT_BYTES, TopicLog
 
 if __name__ == "__main__":
-    broker = Broker()
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--policy",
+        help="what to do with subscribers falling behind",
+        choices=[policy.value for policy in SlowConsumerPolicy],
+        default=SlowConsumerPolicy.BLOCK.value,
+    )
+    parser.add_argument("--max_pending", help="frames a subscriber may fall behind", default=MAX_PENDING)
+    parser.add_argument("--log_dir", help="directory of the durable log of the topics, not logged by default")
+    parser.add_argument("--segment_bytes", help="size of the log segments", default=SEGMENT_BYTES)
+    parser.add_argument("--retention_bytes", help="size of the log kept per topic", default=None)
+    parser.add_argument("--retention_seconds", help="seconds the log segments are kept", default=None)
+    args = parser.parse_args()
+
+    log = None
+    if args.log_dir:
+        log = TopicLog(
+            args.log_dir,
+            segment_bytes=int(args.segment_bytes),
+            retention_bytes=int(args.retention_bytes) if args.retention_bytes else None,
+            retention_seconds=float(args.retention_seconds) if args.retention_seconds else None,
+        )
+
+    broker = Broker(policy=SlowConsumerPolicy(args.policy), max_pending=int(args.max_pending), log=log)
     broker.run()
@@ -13,6 +13,7 @@ if __name__ == "__main__":
         default=list(q_generator.keys())[0],
     )
     parser.add_argument("--length", help="number of messages to be sent", default=10)
+    parser.add_argument("--batch", help="number of messages received at a time", default=1)
     parser.add_argument(
         "--queue_type",
         help="producers queue type",
@@ -23,4 +24,4 @@ if __name__ == "__main__":
 
     c = Consumer(args.topic, q_protocol[args.queue_type])
 
-    c.run(int(args.length))
+    c.run(int(args.length), int(args.batch))
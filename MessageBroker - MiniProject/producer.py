@@ -97,6 +97,7 @@ if __name__ == "__main__":
         default=list(q_generator.keys())[0],
     )
     parser.add_argument("--length", help="number of messages to be sent", default=10)
+    parser.add_argument("--batch", help="number of messages sent at a time", default=1)
     parser.add_argument(
         "--queue_type",
         help="producers queue type",
@@ -109,4 +110,4 @@ if __name__ == "__main__":
         q_subtopics[args.topic], q_generator[args.topic], q_protocol[args.queue_type]
     )
 
-    p.run(int(args.length))
+    p.run(int(args.length), int(args.batch))
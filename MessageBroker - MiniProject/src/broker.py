@@ -5,7 +5,38 @@ from typing import Dict, List, Any, Tuple
 import selectors
 import json
 import pickle
+import tempfile
 import xml.etree.ElementTree as xml
+from collections import deque
+
+from .framing import (FrameDecoder, FrameTooLarge, STREAM_ID, STREAM_THRESHOLD, CHUNK_BYTES, RECV_SIZE,
+                      frame, chunk_frame, decode_value)
+from .log import get_logger
+from .outbox import MAX_PENDING, Outbox, SlowConsumer, SlowConsumerPolicy
+from .topiclog import LoggedStream
+from .topics import TopicTrie, subscribed
+
+# Most values logged sent in a frame when a subscriber resumes from an offset
+REPLAY_BATCH = 256
+
+
+def parse_offset(value):
+    """Offset received, an int or its digits in XML, None when it is no non-negative integer."""
+    if isinstance(value, str) and value.isascii() and value.isdigit():
+        return int(value)
+    if isinstance(value, int) and not isinstance(value, bool) and value >= 0:
+        return value
+    return None
+
+
+def parse_offsets(value):
+    """Offset received, or offsets of the topics when it maps topics to them, None when invalid."""
+    if not isinstance(value, dict):
+        return parse_offset(value)
+    offsets = {topic: parse_offset(offset) for topic, offset in value.items()}
+    if any(not isinstance(topic, str) or offset is None for topic, offset in offsets.items()):
+        return None
+    return offsets
 
 
 class Serializer(enum.Enum):
@@ -23,12 +54,66 @@ class Serializer(enum.Enum):
         elif value == "pickle":
             return Serializer.PICKLE  
 
+
+class StreamedValue:
+    """Value published in chunks, spooled to a temporary file once larger than the threshold."""
+
+    def __init__(self, codec, threshold):
+        self.codec = codec
+        self.size = 0
+        self.spool = tempfile.SpooledTemporaryFile(max_size=threshold)
+
+    def write(self, data):
+        self.spool.write(data)
+        self.size += len(data)
+
+    def chunks(self):
+        """Chunks of the encoded value, several subscribers may be streamed the value at once."""
+        position = 0
+        while True:
+            self.spool.seek(position)
+            data = self.spool.read(CHUNK_BYTES)
+            if not data:
+                return
+            position += len(data)
+            yield data
+
+    def load(self):
+        """Decoded value."""
+        return decode_value(self.codec, b"".join(self.chunks()))
+
+
+class Stream:
+    """Value being streamed by a publisher, forwarded to the subscribers as its chunks arrive."""
+
+    __slots__ = ("topic", "size", "value", "subscribers", "id")
+
+    def __init__(self, topic, size, value, subscribers, stream_id):
+        self.topic = topic
+        self.size = size
+        self.value = value
+        self.subscribers = subscribers
+        self.id = stream_id
+
+
 class Broker:
-    """Implementation of a PubSub Message Broker."""
+    """Implementation of a PubSub Message Broker.
+
+    Connections are non-blocking, each has an Outbox flushed when the
+    selector finds it writable. Subscribers falling max_pending frames
+    behind are handled by the slow consumer policy: BLOCK stops reading
+    from the publisher until they catch up, DROP_OLDEST and CONFLATE drop
+    their oldest frame or replace the one queued for the same topic, and
+    DISCONNECT closes their connection.
 
-    def __init__(self):
+    With a TopicLog, every value published is logged with the next offset of
+    its topic, and subscribers may resume from an offset."""
+
+    def __init__(self, stream_threshold=STREAM_THRESHOLD, policy=SlowConsumerPolicy.BLOCK, max_pending=MAX_PENDING,
+                 log=None):
         """Initialize broker."""
         self.canceled = False
+        self.logger = get_logger("Broker")
         self._host = "localhost"
         self._port = 5000
 
@@ -42,55 +127,89 @@ class Broker:
         self.selelector = selectors.DefaultSelector()
         self.selelector.register(self.socket, selectors.EVENT_READ, self.accept) 
 
-        # Initialize topics dictionary
-        self.topics={} # {topic: [[(socket,Serializer),...], value]}
+        # Initialize topics trie, subscriptions may use the + and # wildcards
+        self.topics = TopicTrie()
         self.sockets={} # {socket: Serializer}
+        self.subscriptions={} # {socket: {topic,...}}
+
+        # Frames received, and values being streamed by the publishers
+        self.decoders={} # {socket: FrameDecoder}
+        self.streams={} # {(socket, stream id): Stream}
+        self.stream_threshold = stream_threshold
+        self.next_stream = 0
+
+        # Frames waiting to be sent, and publishers not read from until their subscribers catch up
+        self.outboxes={} # {socket: Outbox}
+        self.feeds={} # {socket: deque of (stream id, chunks of a value streamed to it)}
+        self.blocked={} # {subscriber socket: {publisher socket,...}}
+        self.paused=set()
+        self.policy = policy
+        self.max_pending = max_pending
+
+        # Durable log of the topics, their last values are restored from it
+        self.log = log
+        if log is not None:
+            for topic, value in log.latest():
+                self.put_topic(topic, value)
  
     def list_topics(self) -> List[str]:
         """Returns a list of strings containing all topics containing values."""
-        topic_list = []
-        for k, v in self.topics.items():
-            if v[1] != None:
-                topic_list.append(k)
-        return topic_list
-            
+        return [topic for topic, value in self.topics.values() if value != None]
     
     def get_topic(self, topic):
         """Returns the currently stored value in topic."""
-        for k, v in self.topics.items():
-            if topic == k:
-                if v[1] != None:
-                    return v[1]
-        return None
+        value = self.topics.get(topic)
+        if isinstance(value, (StreamedValue, LoggedStream)):
+            return value.load()
+        return value
     
     def put_topic(self, topic, value):
         """Store in topic the value."""
-        keys = self.topics.keys()
-        if topic in keys:
-            self.topics[topic][1] = value
-        else:
-            self.topics[topic] = [[],value]
+        self.topics.put(topic, value)
 
     def list_subscriptions(self, topic: str) -> List[Tuple[socket.socket, Serializer]]:
         """Provide list of subscribers to a given topic."""
-        return self.topics.get(topic)[0]
+        return list(self.topics.subscribers(topic).items())
     
     def subscribe(self, topic: str, address: socket.socket, _format: Serializer = None):
         """Subscribe to topic by client in address."""
-        if topic in self.topics.keys():
-            if (address,_format) not in self.topics[topic][0]:
-                self.topics[topic][0].append((address,_format))
-        else:
-            self.topics[topic] = [[(address,_format)],None]
+        self.topics.subscribe(topic, address, _format)
+        self.subscriptions.setdefault(address, set()).add(topic)
 
     def unsubscribe(self, topic, address):
         """Unsubscribe to topic by client in address."""
-        for i in self.topics[topic][0]:
-            if(i[0]==address):
-                self.topics[topic][0].remove(i)
-                break
+        self.topics.unsubscribe(topic, address)
+        topics = self.subscriptions.get(address)
+        if topics is not None:
+            topics.discard(topic)
+            if not topics:
+                del self.subscriptions[address]
+
+    def disconnect(self, conn):
+        """Close a connection and forget its subscriptions and serializer."""
+        for topic in self.subscriptions.pop(conn, ()):
+            self.topics.unsubscribe(topic, conn)
+        self.sockets.pop(conn, None)
+        self.decoders.pop(conn, None)
+        self.outboxes.pop(conn, None)
+        for _, chunks in self.feeds.pop(conn, ()):
+            chunks.close()
+        self.paused.discard(conn)
+        self.resume(conn)
+        for publishers in self.blocked.values():
+            publishers.discard(conn)
+        for key, stream in list(self.streams.items()):
+            if key[0] is conn:
+                del self.streams[key]
+            else:
+                stream.subscribers.pop(conn, None)
+        try:
+            self.selelector.unregister(conn)
+        except (KeyError, ValueError):
+            pass
+        conn.close()
     
-    def format(self, action, topic=None, value=None, serialization=None):
+    def format(self, action, topic=None, value=None, serialization=None, **fields):
         """Format message."""
         if serialization == Serializer.JSON or serialization == Serializer.PICKLE:
             message = {"action": action}
@@ -98,16 +217,23 @@ class Broker:
                 message["topic"] = topic
             if value != None:
                 message["value"] = value
+            message.update((key, field) for key, field in fields.items() if field != None)
             return message
         elif serialization == Serializer.XML:
-            if topic == None and value == None:
-                return f"<data><action>{action}</action></data>"
-            elif value == None:
-                return f"<data><action>{action}</action><topic>{topic}</topic></data>"
-            elif topic == None:
-                return f"<data><action>{action}</action><value>{value}</value></data>"
-            else:
-                return f"<data><action>{action}</action><topic>{topic}</topic><value>{value}</value></data>"
+            elements = f"<action>{action}</action>"
+            if topic != None:
+                elements += f"<topic>{topic}</topic>"
+            if value != None:
+                elements += f"<value>{value}</value>"
+            for tag, text in fields.items():
+                if text == None:
+                    continue
+                if isinstance(text, list):
+                    text = "".join(f"<value>{item}</value>" for item in text)
+                elif isinstance(text, dict):
+                    text = "".join(f'<offset topic="{key}">{item}</offset>' for key, item in text.items())
+                elements += f"<{tag}>{text}</{tag}>"
+            return f"<data>{elements}</data>"
     
     def encode(self, message, serialization):
         """Encode message."""
@@ -123,11 +249,16 @@ class Broker:
         if serialization == Serializer.JSON:
             return json.loads(message.decode("utf-8"))
         elif serialization == Serializer.XML:
-            tree = xml.ElementTree(xml.fromstring(message.decode("utf-8")))           
+            root = xml.fromstring(message.decode("utf-8"))
             message = {}
 
-            for el in tree.iter():
-                message[el.tag] = el.text
+            for el in root:
+                if el.tag == "values":
+                    message[el.tag] = [value.text for value in el]
+                elif el.tag == "offsets":
+                    message[el.tag] = {offset.get("topic"): offset.text for offset in el}
+                else:
+                    message[el.tag] = el.text
 
             return message
         elif serialization == Serializer.PICKLE:
@@ -136,81 +267,319 @@ class Broker:
     def accept(self, sock, mask):
         """Accept new connection."""
         conn, addr = sock.accept()
-        self.selelector.register(conn, selectors.EVENT_READ, self.read)
+        conn.setblocking(False)
+        self.selelector.register(conn, selectors.EVENT_READ, self.ready)
+        self.decoders[conn] = FrameDecoder()
+        self.outboxes[conn] = Outbox(self.max_pending)
 
-    def recv_msg(self, conn, mask):
-        """Receive message from connection."""
-        header = conn.recv(2)
-        size = int.from_bytes(header, "big")
-        message = conn.recv(size)
-        
-        if len(message) != 0:
-            if conn in self.sockets.keys():
-                serialization = self.sockets[conn]
-            else:
-                try:
-                    if message.decode("utf-8").startswith("{"):
-                        serialization = Serializer.JSON
-                    else:
-                        serialization = Serializer.XML
-                except:
-                    serialization = Serializer.PICKLE
-                
-            data = self.decode(message, serialization) 
-            return data 
-        return None
+    def ready(self, conn, mask):
+        """Flush or read from a connection the selector found ready."""
+        if mask & selectors.EVENT_WRITE:
+            self.flush(conn)
+        if mask & selectors.EVENT_READ and conn in self.decoders:
+            self.read(conn, mask)
+
+    def watch(self, conn):
+        """Select conn for reading unless paused, and for writing while frames are pending."""
+        events = 0
+        if conn not in self.paused:
+            events |= selectors.EVENT_READ
+        if self.outboxes.get(conn):
+            events |= selectors.EVENT_WRITE
+
+        key = self.selelector.get_map().get(conn)
+        if not events:
+            if key is not None:
+                self.selelector.unregister(conn)
+        elif key is None:
+            self.selelector.register(conn, events, self.ready)
+        elif key.events != events:
+            self.selelector.modify(conn, events, self.ready)
+
+    def flush(self, conn):
+        """Send the frames pending for conn the connection takes now."""
+        outbox = self.outboxes.get(conn)
+        if outbox is None:
+            return
+        try:
+            outbox.flush(conn)
+            self.feed(conn)
+        except OSError:
+            self.disconnect(conn)
+            return
+        if len(outbox) <= outbox.max_frames // 2:
+            self.resume(conn)
+        self.watch(conn)
+
+    def feed(self, conn):
+        """Queue the next chunks of the values streamed to conn while its outbox is less than half full.
+
+        The other half is left to the frames published meanwhile.
+        Raises OSError when the connection is gone."""
+        feeds = self.feeds.get(conn)
+        if not feeds:
+            return
+        outbox = self.outboxes[conn]
+        while feeds and len(outbox) < max(outbox.max_frames // 2, 1):
+            stream_id, chunks = feeds[0]
+            data = next(chunks, None)
+            if data is None:
+                feeds.popleft()
+                continue
+            outbox.append(None, chunk_frame(stream_id, data))
+            outbox.flush(conn)
+        if not feeds:
+            del self.feeds[conn]
+
+    def resume(self, conn):
+        """Read again from the publishers conn blocked, unless other subscribers still block them."""
+        for publisher in self.blocked.pop(conn, ()):
+            if publisher in self.paused and not any(publisher in others for others in self.blocked.values()):
+                self.paused.discard(publisher)
+                self.watch(publisher)
+
+    def enqueue(self, conn, frame, topic=None, publisher=None):
+        """Queue a frame for conn, applying the slow consumer policy when it is too far behind.
+
+        Raises OSError when the connection is gone or disconnected by the policy."""
+        outbox = self.outboxes[conn]
+        if self.policy == SlowConsumerPolicy.CONFLATE and topic is not None and outbox.conflate(topic, frame):
+            return
+        if outbox.full():
+            if self.policy == SlowConsumerPolicy.DISCONNECT:
+                raise SlowConsumer(len(outbox))
+            if self.policy == SlowConsumerPolicy.BLOCK:
+                if publisher is not None and publisher in self.outboxes:
+                    self.blocked.setdefault(conn, set()).add(publisher)
+                    self.paused.add(publisher)
+                    self.watch(publisher)
+            elif topic is not None:
+                outbox.drop_oldest()
+        outbox.append(topic, frame)
+        outbox.flush(conn)
+        self.watch(conn)
+
+    def lag(self, conn) -> dict:
+        """Lag of a subscriber: frames and bytes pending, seconds the oldest frame waited, frames dropped."""
+        outbox = self.outboxes.get(conn)
+        return outbox.stats() if outbox is not None else None
+
+    def subscriber_lag(self) -> Dict[socket.socket, dict]:
+        """Lag of every subscriber."""
+        return {conn: self.lag(conn) for conn in self.subscriptions if conn in self.outboxes}
+
+    def recv_msg(self, conn, message):
+        """Deserialize a message received from connection."""
+        if conn in self.sockets.keys():
+            serialization = self.sockets[conn]
+        else:
+            try:
+                if message.decode("utf-8").startswith("{"):
+                    serialization = Serializer.JSON
+                else:
+                    serialization = Serializer.XML
+            except:
+                serialization = Serializer.PICKLE
+
+        return self.decode(message, serialization)
     
+    def frame(self, message) -> bytes:
+        """Frame an encoded message with its header."""
+        return frame(message)
+
     def send(self,conn,message):
         """Send message to conn."""
-        header = len(message).to_bytes(2, "big")
-        conn.send(header + message)
-
-    def getRootsTopics(self,topic)->list:
-        """Get list of topics by recursive leaf."""
-        roots=topic.split("/")
-        topics=[]
-        for i in range(len(roots)):
-            root=""
-            for ii in range(len(roots)-i):
-                root+=(roots[ii])+"/"
-            topics.append(root[:-1])
-        return topics
+        self.enqueue(conn, self.frame(message))
 
-    def read(self, conn, mask):
-        """Read message from connection."""
-        data = self.recv_msg(conn, mask)
-        if data != None:
-            if conn not in self.sockets.keys() and data["action"]=="format":
-                self.sockets[conn] = Serializer.getSerializer(data["value"])
-
-            elif data["action"]=="list_topics":
-                message = self.encode(self.format("send",value=self.list_topics(), serialization=self.sockets[conn]), self.sockets[conn])
+    def broadcast(self, subscribers, frame_for, topic=None, publisher=None):
+        """Queue for every subscriber the frame of its serializer.
+
+        The frame is built once per serializer and reused for every subscriber
+        using it. Frames with a topic may be dropped or conflated by the slow
+        consumer policy."""
+        frames = {}
+        closed = []
+        for sub, serialization in list(subscribers.items()):
+            if serialization not in frames:
+                try:
+                    frames[serialization] = frame_for(serialization)
+                except Exception as err:
+                    # Values this serializer can not encode are not sent to its subscribers
+                    self.logger.warning("Can not encode for %s: %s", serialization, err)
+                    frames[serialization] = None
+            frame = frames[serialization]
+            if frame is None:
+                continue
+            try:
+                self.enqueue(sub, frame, topic, publisher)
+            except OSError:
+                closed.append(sub)
+
+        # Subscribers whose connection is gone are not sent to again
+        for sub in closed:
+            self.disconnect(sub)
+
+    def publish(self, topic, value, publisher=None):
+        """Store the value in topic and send it to the subscribers."""
+        self.put_topic(topic, value)
+        offset = self.log.append(topic, value) if self.log is not None else None
+        self.broadcast(self.topics.match(topic), lambda serialization: self.frame(self.encode(
+            self.format("send", topic=topic, value=value, serialization=serialization, offset=offset), serialization)),
+            topic, publisher)
+
+    def publish_batch(self, topic, values, publisher=None):
+        """Store the last of the values in topic and send them to the subscribers in one frame."""
+        if not values:
+            return
+        self.put_topic(topic, values[-1])
+        offset = None
+        if self.log is not None:
+            offset = self.log.append(topic, values[0])
+            for value in values[1:]:
+                self.log.append(topic, value)
+        self.broadcast(self.topics.match(topic), lambda serialization: self.frame(self.encode(
+            self.format("send", topic=topic, serialization=serialization, values=values, offset=offset), serialization)),
+            topic, publisher)
+
+    def replay(self, conn, topic, start):
+        """Send conn the values logged of every topic the subscription gets.
+
+        Each topic is replayed from the start offset, or when start maps
+        topics to offsets from the offset of the topic, 0 when missing."""
+        for logged in [logged for logged in self.log.topics() if subscribed(topic, logged)]:
+            batch = []
+            for offset, value in self.log.read(logged, start.get(logged, 0) if isinstance(start, dict) else start):
+                if isinstance(value, LoggedStream):
+                    self.send_batch(conn, logged, batch)
+                    batch = []
+                    self.send_stream(conn, logged, value, offset)
+                    continue
+                batch.append((offset, value))
+                if len(batch) == REPLAY_BATCH:
+                    self.send_batch(conn, logged, batch)
+                    batch = []
+            self.send_batch(conn, logged, batch)
+
+    def send_batch(self, conn, topic, batch):
+        """Send conn the (offset, value) logged of the topic in one frame."""
+        if not batch:
+            return
+        serialization = self.sockets[conn]
+        message = self.encode(self.format("send", topic=topic, serialization=serialization,
+                                          values=[value for _, value in batch], offset=batch[0][0]), serialization)
+        self.send(conn, message)
+
+    def open_stream(self, conn, topic, size, stream_id, codec):
+        """Start forwarding a value streamed by the publisher in conn."""
+        stream = Stream(topic, size, StreamedValue(codec, self.stream_threshold),
+                        self.topics.match(topic), self.next_stream)
+        self.next_stream += 1
+        self.streams[(conn, stream_id)] = stream
+        self.broadcast(stream.subscribers, lambda serialization: self.frame(self.encode(self.format(
+            "send", topic=topic, serialization=serialization, stream=size, stream_id=stream.id, codec=codec),
+            serialization)), topic, conn)
+
+    def stream_chunk(self, conn, payload):
+        """Forward the next chunk of a streamed value, and store the value once complete."""
+        stream_id, = STREAM_ID.unpack_from(payload)
+        stream = self.streams.get((conn, stream_id))
+        if stream is None:
+            return
+        data = payload[STREAM_ID.size:]
+        chunk = chunk_frame(stream.id, data)
+        self.broadcast(stream.subscribers, lambda serialization: chunk, publisher=conn)
+
+        stream.value.write(data)
+        if stream.value.size >= stream.size:
+            del self.streams[(conn, stream_id)]
+            self.put_topic(stream.topic, stream.value)
+            if self.log is not None:
+                self.log.append_stream(stream.topic, stream.value.codec, stream.value.size, stream.value.chunks())
+
+    def send_stream(self, conn, topic, value, offset=None):
+        """Stream a stored or logged value to conn."""
+        stream_id = self.next_stream
+        self.next_stream += 1
+        message = self.encode(self.format("send", topic=topic, serialization=self.sockets[conn], stream=value.size,
+                                          stream_id=stream_id, codec=value.codec, offset=offset), self.sockets[conn])
+        self.send(conn, message)
+        # The chunks are queued as the outbox drains, not all at once
+        self.feeds.setdefault(conn, deque()).append((stream_id, value.chunks()))
+        self.feed(conn)
+        self.watch(conn)
+
+    def catch_up(self, conn, subscription, start=None):
+        """Send a new subscriber the values logged since the start offsets, or the last values.
+
+        Raises OSError when the connection is gone or disconnected by the policy."""
+        if start != None and self.log is not None:
+            # Values logged since the offsets instead of the last ones
+            self.replay(conn, subscription, start)
+            return
+        # Last values of the topic, or of every topic matching the pattern
+        for topic, last_value in self.topics.retained(subscription):
+            if isinstance(last_value, (StreamedValue, LoggedStream)):
+                self.send_stream(conn, topic, last_value)
+            elif last_value != None:
+                message = self.encode(self.format("send", topic=topic, value=last_value, serialization=self.sockets[conn]), self.sockets[conn])
                 self.send(conn,message)
-            elif data["action"]=="subscribe":
-                self.subscribe(data["topic"], conn, self.sockets[conn])
-                for topic in self.topics.keys():
-                    if data["topic"].startswith(topic):
-                        last_value = self.get_topic(data["topic"])
-                        if last_value != None:
-                            message = self.encode(self.format("send", topic=data["topic"], value=last_value, serialization=self.sockets[conn]), self.sockets[conn])
-                            self.send(conn,message)
-            elif data["action"]=="cancel":
-                self.unsubscribe(data["topic"], conn)
-            elif data["action"]=="publish":
-                self.put_topic(data["topic"], data["value"])
-                topicsArray=self.getRootsTopics(data["topic"])
-                for topic in topicsArray:
-                    if topic in self.topics.keys():
-                        for sub in self.topics[topic][0]:
-                            try:
-                                message = self.encode(self.format("send", topic=data["topic"], value=data["value"], serialization=sub[1]), sub[1])
-                                self.send(sub[0],message)
-                            except:
-                                pass
-        else:
-            self.selelector.unregister(conn)
-            conn.close()
 
+    def read(self, conn, mask):
+        """Read the frames received from connection, several may arrive at once."""
+        try:
+            received = conn.recv(RECV_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            received = b""
+        decoder = self.decoders.get(conn)
+        if not received or decoder is None:
+            self.disconnect(conn)
+            return
+
+        decoder.feed(received)
+        try:
+            for chunk, message in decoder.frames():
+                if chunk:
+                    self.stream_chunk(conn, message)
+                else:
+                    self.handle(conn, self.recv_msg(conn, message))
+                # Stop once the connection was closed while handling the frame
+                if conn not in self.decoders:
+                    return
+        except (FrameTooLarge, OSError):
+            self.disconnect(conn)
+
+    def handle(self, conn, data):
+        """Handle a message received from connection."""
+        if conn not in self.sockets.keys() and data["action"]=="format":
+            self.sockets[conn] = Serializer.getSerializer(data["value"])
+        elif data["action"]=="list_topics":
+            message = self.encode(self.format("send",value=self.list_topics(), serialization=self.sockets[conn]), self.sockets[conn])
+            self.send(conn,message)
+        elif data["action"]=="subscribe":
+            start = data.get("offsets") if data.get("offsets") != None else data.get("offset")
+            if start != None:
+                start = parse_offsets(start)
+                if start is None:
+                    message = self.encode(self.format("error", topic=data["topic"], value="offset must be a non-negative integer",
+                                                      serialization=self.sockets[conn]), self.sockets[conn])
+                    self.send(conn, message)
+                    return
+            self.subscribe(data["topic"], conn, self.sockets[conn])
+            try:
+                self.catch_up(conn, data["topic"], start)
+            except OSError:
+                # Subscribers whose connection is gone or disconnected by the policy
+                self.disconnect(conn)
+        elif data["action"]=="cancel":
+            self.unsubscribe(data["topic"], conn)
+        elif data["action"]=="publish" and data.get("stream") != None:
+            self.open_stream(conn, data["topic"], int(data["stream"]), int(data["stream_id"]), data["codec"])
+        elif data["action"]=="publish":
+            self.publish(data["topic"], data["value"], conn)
+        elif data["action"]=="publish_batch":
+            self.publish_batch(data["topic"], data["values"], conn)
 
     def run(self):
         """Run until canceled."""
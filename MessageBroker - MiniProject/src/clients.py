@@ -13,12 +13,19 @@ class Consumer:
         self.logger = get_logger(f"Consumer {topic}")
         self.received = []
 
-    def run(self, events=10):
-        """Consume at most <events> events."""
-        for _ in range(events):
-            topic, data = self.queue.pull()
-            self.logger.info("%s: %s", topic, data)
-            self.received.append(data)
+    def run(self, events=10, batch=1):
+        """Consume at most <events> events, pulling up to <batch> at a time."""
+        while events > 0:
+            if batch > 1:
+                messages = self.queue.pull_many(min(batch, events))
+                if not messages:
+                    break
+            else:
+                messages = [self.queue.pull()]
+            for topic, data in messages:
+                self.logger.info("%s: %s", topic, data)
+                self.received.append(data)
+            events -= len(messages)
 
 
 class Producer:
@@ -38,11 +45,22 @@ class Producer:
         self.produced = []
         self.gen = value_generator
 
-    def run(self, events=10):
-        """Produce at most <events> events."""
+    def run(self, events=10, batch=1):
+        """Produce at most <events> events, pushing them <batch> at a time."""
+        batches = [[] for _ in self.queue]
         for _ in range(events):
-            for queue, value in zip(self.queue, self.gen()):
-                queue.push(value)
+            for queue, values, value in zip(self.queue, batches, self.gen()):
+                if batch > 1:
+                    values.append(value)
+                    if len(values) == batch:
+                        queue.push_many(values)
+                        values.clear()
+                else:
+                    queue.push(value)
                 self.logger.info("%s: %s", queue.topic, value)
 
                 self.produced.append(value)
+
+        for queue, values in zip(self.queue, batches):
+            if values:
+                queue.push_many(values)
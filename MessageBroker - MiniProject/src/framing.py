@@ -0,0 +1,102 @@
+"""Framing of the messages exchanged with the PubSub Message Broker.
+
+Every frame starts with a 4 byte big-endian header. Its highest bit flags a
+chunk frame, the other bits are the size of the payload. A message frame
+holds a serialized message. Values whose message would be larger than the
+stream threshold are streamed instead: a publish (or send) message without
+value but with the "stream" size, "stream_id" and "codec" of the value is
+followed by chunk frames holding the stream id and the next bytes of the
+value, encoded with its codec."""
+import json
+import pickle
+import struct
+from typing import Any, Iterator, Tuple
+
+HEADER = struct.Struct(">I")
+CHUNK_FLAG = 1 << 31
+
+# Stream id at the start of the chunk frames payload
+STREAM_ID = struct.Struct(">I")
+
+# Largest frame accepted, larger values must be streamed
+MAX_FRAME_BYTES = 16 * 1024 * 1024
+
+# Default size of the messages beyond which values are streamed, and of their chunks
+STREAM_THRESHOLD = 64 * 1024
+CHUNK_BYTES = 64 * 1024
+
+# Maximum number of bytes read from a connection at once
+RECV_SIZE = 65536
+
+
+class FrameTooLarge(Exception):
+    """Exception when a frame is larger than the decoder accepts."""
+
+
+def frame(payload: bytes) -> bytes:
+    """Frame a serialized message with its header."""
+    return HEADER.pack(len(payload)) + payload
+
+
+def chunk_frame(stream_id: int, data: bytes) -> bytes:
+    """Frame the next bytes of a streamed value."""
+    return HEADER.pack((STREAM_ID.size + len(data)) | CHUNK_FLAG) + STREAM_ID.pack(stream_id) + data
+
+
+def encode_value(codec: str, value: Any) -> bytes:
+    """Encode a streamed value, XML only transfers strings."""
+    if codec == "json":
+        return json.dumps(value).encode("utf-8")
+    if codec == "pickle":
+        return pickle.dumps(value)
+    return str(value).encode("utf-8")
+
+
+def decode_value(codec: str, data: bytes) -> Any:
+    """Decode a streamed value."""
+    if codec == "json":
+        return json.loads(data.decode("utf-8"))
+    if codec == "pickle":
+        return pickle.loads(data)
+    return data.decode("utf-8")
+
+
+class FrameDecoder:
+    """Incremental decoder of the frames received from a connection."""
+
+    def __init__(self, max_frame_bytes: int = MAX_FRAME_BYTES):
+        self._buffer = bytearray()
+        self.max_frame_bytes = max_frame_bytes
+
+    def __len__(self) -> int:
+        """Number of bytes waiting for a complete frame."""
+        return len(self._buffer)
+
+    def feed(self, data: bytes):
+        """Append the bytes read from the connection to the buffer."""
+        self._buffer += data
+
+    def frames(self) -> Iterator[Tuple[bool, bytes]]:
+        """Yield whether every complete frame in the buffer is a chunk, and its payload.
+
+        Partial frames are kept until the rest of their bytes are fed. Frames
+        larger than max_frame_bytes raise FrameTooLarge."""
+        view = memoryview(self._buffer)
+        offset = 0
+        try:
+            while len(view) - offset >= HEADER.size:
+                header, = HEADER.unpack_from(view, offset)
+                chunk = bool(header & CHUNK_FLAG)
+                size = header & ~CHUNK_FLAG
+                if size > self.max_frame_bytes:
+                    raise FrameTooLarge(size)
+
+                end = offset + HEADER.size + size
+                if end > len(view):
+                    break
+                payload = bytes(view[offset + HEADER.size:end])
+                offset = end
+                yield chunk, payload
+        finally:
+            view.release()
+            del self._buffer[:offset]
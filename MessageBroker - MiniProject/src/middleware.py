@@ -1,4 +1,5 @@
 """Middleware to communicate with PubSub Message Broker."""
+from collections import deque
 from collections.abc import Callable
 from enum import Enum
 from queue import LifoQueue, Empty
@@ -8,6 +9,13 @@ import json
 import pickle
 import xml.etree.ElementTree as xml
 
+from .framing import (FrameDecoder, STREAM_ID, STREAM_THRESHOLD, CHUNK_BYTES, RECV_SIZE,
+                      frame, chunk_frame, encode_value, decode_value)
+
+
+class BrokerError(Exception):
+    """Exception when the broker rejects a message."""
+
 
 class MiddlewareType(Enum):
     """Middleware Type."""
@@ -17,17 +25,36 @@ class MiddlewareType(Enum):
 
 
 class Queue:
-    """Representation of Queue interface for both Consumers and Producers."""
+    """Representation of Queue interface for both Consumers and Producers.
+
+    Values whose message is larger than stream_threshold bytes are streamed
+    in chunks, see the framing module. When the broker logs the topics,
+    offsets holds the offset to resume each topic from, see subscribe."""
+
+    # Encoding of the streamed values
+    codec = None
 
-    def __init__(self, topic, _type=MiddlewareType.CONSUMER):
+    def __init__(self, topic, _type=MiddlewareType.CONSUMER, stream_threshold=STREAM_THRESHOLD):
         """Create Queue."""
         self.topic = topic
         self._type = _type
+        self.stream_threshold = stream_threshold
         
         # Initialize socket
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.sock.connect(("localhost", 5000))
+
+        # Frames received and not pulled yet, values of the batches not pulled yet, and values being streamed
+        self.decoder = FrameDecoder()
+        self.frames = deque()
+        self.pending = deque()
+        self.streams = {}
+        self.next_stream = 0
+
+        # Offset to resume every topic from, and of the value after the last one received
+        self.offsets = {}
+        self.received = {}
     
     def encode(self, data: Any):
         """Encodes data to be sent."""
@@ -37,37 +64,155 @@ class Queue:
         """Decodes data to be sent."""
         pass
 
-    def format(self, action, topic=None, value=None):
+    def format(self, action, topic=None, value=None, **fields):
         """Formats data to be sent."""
         pass
 
+    def subscribe(self, from_offset=None):
+        """Subscribe to the topic.
+
+        Receives the values logged since from_offset when given, of every
+        topic the subscription gets, instead of the last values only.
+        from_offset may map topics to the offset to resume each from, like
+        offsets does, the topics missing are received from their start."""
+        if isinstance(from_offset, dict):
+            message = self.encode(self.format("subscribe", topic=str(self.topic), offsets=from_offset))
+        else:
+            message = self.encode(self.format("subscribe", topic=str(self.topic), offset=from_offset))
+        self.send(message)
+
     def push(self, value):
         """Sends data to broker."""
         message = self.encode(self.format("publish", topic=self.topic, value=value))
+        if len(message) > self.stream_threshold:
+            self.stream(value)
+            return
         self.send(message)
 
+    def push_many(self, values):
+        """Sends several values to broker in one frame."""
+        values = list(values)
+        if not values:
+            return
+        message = self.encode(self.format("publish_batch", topic=self.topic, values=values))
+        if len(message) > self.stream_threshold:
+            # Batches too large for a frame are pushed value by value, the large ones streamed
+            for value in values:
+                self.push(value)
+            return
+        self.send(message)
+
+    def stream(self, value):
+        """Sends a large value to broker in chunks."""
+        data = encode_value(self.codec, value)
+        stream_id = self.next_stream
+        self.next_stream += 1
+
+        message = self.encode(self.format("publish", topic=self.topic, stream=len(data),
+                                          stream_id=stream_id, codec=self.codec))
+        self.send(message)
+        for offset in range(0, len(data), CHUNK_BYTES):
+            self.sock.sendall(chunk_frame(stream_id, data[offset:offset + CHUNK_BYTES]))
+
+    def receive(self):
+        """Receives the next frame from broker, None once the connection is closed."""
+        while not self.frames:
+            data = self.sock.recv(RECV_SIZE)
+            if not data:
+                return None
+            self.decoder.feed(data)
+            self.frames.extend(self.decoder.frames())
+        return self.frames.popleft()
+
     def pull(self) -> tuple[str, Any]:
         """Receives (topic, data) from broker.
 
         Should BLOCK the consumer!"""
 
-        header = self.sock.recv(2)
-        size = int.from_bytes(header, "big")
-        message = self.sock.recv(size)
-        
-        if len(message) != 0:
+        if self.pending:
+            return self.take()
+
+        while True:
+            received = self.receive()
+            if received is None:
+                return None
+            chunk, message = received
+
+            # Streamed values are returned once all their chunks arrived
+            if chunk:
+                stream_id, = STREAM_ID.unpack_from(message)
+                stream = self.streams.get(stream_id)
+                if stream is None:
+                    continue
+                stream["data"] += message[STREAM_ID.size:]
+                if len(stream["data"]) >= stream["size"]:
+                    del self.streams[stream_id]
+                    if stream["offset"] is not None:
+                        self.advance(stream["topic"], stream["offset"])
+                    return stream["topic"], decode_value(stream["codec"], bytes(stream["data"]))
+                continue
+
             data = self.decode(message)
-            if "topic" not in data.keys():
-                topic = None
-            else:
-                topic = data["topic"]
+            if data.get("action") == "error":
+                raise BrokerError(data.get("value"))
+
+            offset = int(data["offset"]) if data.get("offset") is not None else None
+            if data.get("stream") is not None:
+                self.streams[int(data["stream_id"])] = {
+                    "topic": data.get("topic"), "codec": data["codec"], "offset": offset,
+                    "size": int(data["stream"]), "data": bytearray(),
+                }
+                continue
+
+            # Batches are pulled value by value
+            if data.get("values") is not None:
+                self.pending.extend((data.get("topic"), value, offset + i if offset is not None else None)
+                                    for i, value in enumerate(data["values"]))
+                if self.pending:
+                    return self.take()
+                continue
+
+            if offset is not None:
+                self.advance(data.get("topic"), offset)
+            return data.get("topic"), data.get("value")
+
+    def take(self) -> tuple[str, Any]:
+        """Next value of the batches received."""
+        topic, value, offset = self.pending.popleft()
+        if offset is not None:
+            self.advance(topic, offset)
+        return topic, value
+
+    def advance(self, topic, offset):
+        """Move the offset to resume the topic from past a value received.
 
-            if "value" not in data.keys():
-                value = None
-            else:    
-                value = data["value"]
+        The chunks of a streamed value may arrive after later values, the
+        offset stays at the value still being streamed until it is received."""
+        self.received[topic] = max(self.received.get(topic, 0), offset + 1)
+        streaming = [stream["offset"] for stream in self.streams.values()
+                     if stream["topic"] == topic and stream["offset"] is not None]
+        self.offsets[topic] = min(streaming + [self.received[topic]])
 
-            return topic, value
+    def pull_many(self, max_n, timeout=None) -> list[tuple[str, Any]]:
+        """Receives at most max_n (topic, data) from broker.
+
+        Blocks until one is received, for at most timeout seconds when given,
+        then only takes the ones already received."""
+        received = []
+        previous = self.sock.gettimeout()
+        self.sock.settimeout(timeout)
+        try:
+            while len(received) < max_n:
+                message = self.pull()
+                if message is None:
+                    break
+                received.append(message)
+                self.sock.settimeout(0)
+        except (socket.timeout, BlockingIOError):
+            pass
+        finally:
+            self.sock.settimeout(previous)
+        return received
 
     def list_topics(self, callback: Callable):
         """Lists all topics available in the broker."""
@@ -81,19 +226,20 @@ class Queue:
         
     
     def send(self,message):
-        message =  len(message).to_bytes(2, "big") + message
-        self.sock.send(message)
+        # Frames up to the stream threshold go in a single send call
+        self.sock.send(frame(message))
 
 class JSONQueue(Queue):
     """Queue implementation with JSON based serialization."""
-    def __init__(self, topic, _type=MiddlewareType.CONSUMER):
-        super().__init__(topic, _type)
+    codec = "json"
+
+    def __init__(self, topic, _type=MiddlewareType.CONSUMER, stream_threshold=STREAM_THRESHOLD, from_offset=None):
+        super().__init__(topic, _type, stream_threshold)
         message = self.encode(self.format("format", value="json"))
         self.send(message)
 
         if self._type == MiddlewareType.CONSUMER:
-            message = self.encode(self.format("subscribe", topic=str(self.topic)))
-            self.send(message)
+            self.subscribe(from_offset)
     
     def encode(self, data: Any):
         return (json.dumps(data)).encode("utf-8")
@@ -101,59 +247,71 @@ class JSONQueue(Queue):
     def decode(self, data: Any):
         return json.loads(data.decode("utf-8"))
 
-    def format(self, action, topic=None, value=None):
+    def format(self, action, topic=None, value=None, **fields):
         message = {"action": action}
         if topic != None:
             message["topic"] = topic
         if value != None:
             message["value"] = value
+        message.update((key, field) for key, field in fields.items() if field != None)
         return message
 
 
 class XMLQueue(Queue):
     """Queue implementation with XML based serialization."""
-    def __init__(self, topic, _type=MiddlewareType.CONSUMER):
-        super().__init__(topic, _type)
+    codec = "xml"
+
+    def __init__(self, topic, _type=MiddlewareType.CONSUMER, stream_threshold=STREAM_THRESHOLD, from_offset=None):
+        super().__init__(topic, _type, stream_threshold)
         message = self.encode(self.format("format", value="xml"))
         self.send(message)
 
         if self._type == MiddlewareType.CONSUMER:
-            message = self.encode(self.format("subscribe", topic=str(self.topic)))
-            self.send(message)
+            self.subscribe(from_offset)
     
     def encode(self, data: Any):
         return data.encode("utf-8")
     
     def decode(self, data: Any):
-        tree = xml.ElementTree(xml.fromstring(data.decode("utf-8")))           
+        root = xml.fromstring(data.decode("utf-8"))
         data = {}
         
-        for el in tree.iter():
-            data[el.tag] = el.text
+        for el in root:
+            if el.tag == "values":
+                data[el.tag] = [value.text for value in el]
+            else:
+                data[el.tag] = el.text
 
         return data
 
-    def format(self, action, topic=None, value=None):
-        if topic == None and value == None:
-            return f"<data><action>{action}</action></data>"
-        elif value == None:
-            return f"<data><action>{action}</action><topic>{topic}</topic></data>"
-        elif topic == None:
-            return f"<data><action>{action}</action><value>{value}</value></data>"
-        else:
-            return f"<data><action>{action}</action><topic>{topic}</topic><value>{value}</value></data>"
+    def format(self, action, topic=None, value=None, **fields):
+        elements = f"<action>{action}</action>"
+        if topic != None:
+            elements += f"<topic>{topic}</topic>"
+        if value != None:
+            elements += f"<value>{value}</value>"
+        for tag, text in fields.items():
+            if text == None:
+                continue
+            if isinstance(text, list):
+                text = "".join(f"<value>{item}</value>" for item in text)
+            elif isinstance(text, dict):
+                text = "".join(f'<offset topic="{key}">{item}</offset>' for key, item in text.items())
+            elements += f"<{tag}>{text}</{tag}>"
+        return f"<data>{elements}</data>"
 
 
 class PickleQueue(Queue):
     """Queue implementation with Pickle based serialization."""
-    def __init__(self, topic, _type=MiddlewareType.CONSUMER):
-        super().__init__(topic, _type)
+    codec = "pickle"
+
+    def __init__(self, topic, _type=MiddlewareType.CONSUMER, stream_threshold=STREAM_THRESHOLD, from_offset=None):
+        super().__init__(topic, _type, stream_threshold)
         message = self.encode(self.format("format", value="pickle"))
         self.send(message)
 
         if self._type == MiddlewareType.CONSUMER:
-            message = self.encode(self.format("subscribe", topic=str(self.topic)))
-            self.send(message)
+            self.subscribe(from_offset)
     
     def encode(self, data: Any):
         return pickle.dumps(data)
@@ -161,10 +319,11 @@ class PickleQueue(Queue):
     def decode(self, data: Any):
         return pickle.loads(data)
     
-    def format(self, action, topic=None, value=None):
+    def format(self, action, topic=None, value=None, **fields):
         message = {"action": action}
         if topic != None:
             message["topic"] = topic
         if value != None:
             message["value"] = value
+        message.update((key, field) for key, field in fields.items() if field != None)
         return message
@@ -0,0 +1,112 @@
+"""Outbound buffers of the Message Broker connections."""
+import enum
+import time
+from collections import deque
+
+# Default number of frames a subscriber may fall behind before its policy applies
+MAX_PENDING = 1024
+
+
+class SlowConsumerPolicy(enum.Enum):
+    """What to do when a subscriber falls MAX_PENDING frames behind."""
+
+    BLOCK = "block"
+    DROP_OLDEST = "drop_oldest"
+    CONFLATE = "conflate"
+    DISCONNECT = "disconnect"
+
+
+class SlowConsumer(ConnectionError):
+    """Exception when a subscriber falls too far behind under the disconnect policy."""
+
+
+class Outbox:
+    """Frames waiting to be sent to a connection, oldest first.
+
+    Frames are sent without blocking: whatever the connection does not take
+    stays queued, a partially sent frame is finished before the next one.
+    Frames queued with a topic may be dropped or replaced by a later frame
+    of the same topic, the other ones (chunks of streamed values) are always
+    sent."""
+
+    __slots__ = ("frames", "latest", "offset", "max_frames", "pending_bytes", "sent", "dropped", "conflated")
+
+    def __init__(self, max_frames: int = MAX_PENDING):
+        # [topic, frame, time queued] entries, and the last entry queued per topic
+        self.frames = deque()
+        self.latest = {}
+        self.offset = 0
+        self.max_frames = max_frames
+        self.pending_bytes = 0
+        self.sent = 0
+        self.dropped = 0
+        self.conflated = 0
+
+    def __len__(self) -> int:
+        return len(self.frames)
+
+    def full(self) -> bool:
+        return len(self.frames) >= self.max_frames
+
+    def append(self, topic, frame: bytes):
+        entry = [topic, frame, time.monotonic()]
+        self.frames.append(entry)
+        self.pending_bytes += len(frame)
+        if topic is not None:
+            self.latest[topic] = entry
+
+    def forget(self, entry):
+        if self.latest.get(entry[0]) is entry:
+            del self.latest[entry[0]]
+
+    def conflate(self, topic, frame: bytes) -> bool:
+        """Replace the frame queued for the topic, False when there is none not being sent."""
+        entry = self.latest.get(topic)
+        if entry is None or (self.offset and entry is self.frames[0]):
+            return False
+        self.pending_bytes += len(frame) - len(entry[1])
+        entry[1] = frame
+        self.conflated += 1
+        return True
+
+    def drop_oldest(self) -> bool:
+        """Drop the oldest frame with a topic not being sent, False when there is none."""
+        for i, entry in enumerate(self.frames):
+            if entry[0] is not None and not (i == 0 and self.offset):
+                del self.frames[i]
+                self.forget(entry)
+                self.pending_bytes -= len(entry[1])
+                self.dropped += 1
+                return True
+        return False
+
+    def flush(self, conn):
+        """Send the frames the connection takes without blocking.
+
+        Raises OSError when the connection is gone."""
+        while self.frames:
+            entry = self.frames[0]
+            frame = entry[1]
+            try:
+                sent = conn.send(memoryview(frame)[self.offset:] if self.offset else frame)
+            except (BlockingIOError, InterruptedError):
+                return
+            self.offset += sent
+            self.pending_bytes -= sent
+            if self.offset < len(frame):
+                return
+            self.frames.popleft()
+            self.forget(entry)
+            self.offset = 0
+            self.sent += 1
+
+    def stats(self) -> dict:
+        """Lag of the connection: frames and bytes pending, seconds the oldest frame waited."""
+        return {
+            "pending": len(self.frames),
+            "pending_bytes": self.pending_bytes,
+            "lag": time.monotonic() - self.frames[0][2] if self.frames else 0.0,
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "conflated": self.conflated,
+        }
@@ -0,0 +1,261 @@
+"""Durable append-only log of the values published to the Message Broker topics."""
+import bisect
+import mmap
+import os
+import pickle
+import struct
+import time
+from typing import Any, Dict, Iterator, Tuple
+from urllib.parse import quote, unquote
+
+from .framing import CHUNK_BYTES, decode_value
+
+# Offset, time published, size and codec of every record
+RECORD = struct.Struct(">QdIB")
+
+# Codecs of the streamed values logged, the codec of the other records is 0: their value is pickled
+STREAM_CODECS = (None, "json", "pickle", "xml")
+
+# Default size at which a segment is closed and a new one started
+SEGMENT_BYTES = 16 * 1024 * 1024
+
+SEGMENT_SUFFIX = ".log"
+
+
+class LoggedStream:
+    """Streamed value logged, its encoded bytes kept in the segment and read in chunks."""
+
+    __slots__ = ("path", "position", "size", "codec")
+
+    def __init__(self, path: str, position: int, size: int, codec: str):
+        self.path = path
+        self.position = position
+        self.size = size
+        self.codec = codec
+
+    def chunks(self) -> Iterator[bytes]:
+        """Chunks of the encoded value."""
+        with open(self.path, "rb") as file:
+            file.seek(self.position)
+            left = self.size
+            while left:
+                data = file.read(min(left, CHUNK_BYTES))
+                if not data:
+                    return
+                left -= len(data)
+                yield data
+
+    def load(self) -> Any:
+        """Decoded value."""
+        return decode_value(self.codec, b"".join(self.chunks()))
+
+
+class Log:
+    """Log of a topic, split in segment files named after the offset of their first record.
+
+    Records are appended to the last segment; the older ones are only read,
+    through mmap, and deleted whole by the retention."""
+
+    def __init__(self, directory: str, segment_bytes: int = SEGMENT_BYTES):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        os.makedirs(directory, exist_ok=True)
+
+        self.segments = sorted(int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(directory)
+                               if name.endswith(SEGMENT_SUFFIX))
+        self.next = 0
+        self.last = None
+        if not self.segments:
+            self.segments.append(0)
+        else:
+            # Only the last segment may have been interrupted while written
+            self.recover(self.segments[-1])
+        self.active = open(self.path(self.segments[-1]), "ab")
+
+        # The last record is in the last segment, or in the one before when it is still empty
+        for base in reversed(self.segments[-2:]):
+            for offset, value in self.records(base, base):
+                self.next = offset + 1
+                self.last = value
+            if self.next:
+                break
+        self.next = max(self.next, self.segments[-1])
+
+    def recover(self, base: int):
+        """Truncate the segment after its last complete record, dropping one cut short by a crash."""
+        path = self.path(base)
+        size = os.path.getsize(path)
+        position = 0
+        with open(path, "rb") as file:
+            while position + RECORD.size <= size:
+                file.seek(position)
+                _, _, length, _ = RECORD.unpack(file.read(RECORD.size))
+                if position + RECORD.size + length > size:
+                    break
+                position += RECORD.size + length
+        if position != size:
+            os.truncate(path, position)
+
+    def path(self, base: int) -> str:
+        return os.path.join(self.directory, f"{base:020d}{SEGMENT_SUFFIX}")
+
+    @property
+    def first(self) -> int:
+        """Offset of the oldest record kept."""
+        return self.segments[0]
+
+    def size(self) -> int:
+        return sum(os.path.getsize(self.path(base)) for base in self.segments)
+
+    def append(self, value: Any, now: float = None) -> int:
+        """Append a value, its offset."""
+        if self.active.tell() >= self.segment_bytes:
+            self.roll()
+        offset = self.next
+        data = pickle.dumps(value)
+        self.active.write(RECORD.pack(offset, now or time.time(), len(data), 0) + data)
+        self.active.flush()
+        self.next += 1
+        self.last = value
+        return offset
+
+    def append_stream(self, codec: str, size: int, chunks: Iterator[bytes], now: float = None) -> int:
+        """Append a streamed value chunk by chunk, as encoded with its codec, its offset."""
+        if self.active.tell() >= self.segment_bytes:
+            self.roll()
+        offset = self.next
+        self.active.write(RECORD.pack(offset, now or time.time(), size, STREAM_CODECS.index(codec)))
+        position = self.active.tell()
+        for data in chunks:
+            self.active.write(data)
+        self.active.flush()
+        self.next += 1
+        self.last = LoggedStream(self.path(self.segments[-1]), position, size, codec)
+        return offset
+
+    def roll(self):
+        """Close the segment records are appended to and start a new one."""
+        self.active.close()
+        self.segments.append(self.next)
+        self.active = open(self.path(self.next), "ab")
+
+    def records(self, base: int, start: int) -> Iterator[Tuple[int, Any]]:
+        """Records of the segment from the start offset, read through mmap.
+
+        Streamed values are not loaded, a LoggedStream reads them back."""
+        path = self.path(base)
+        if not os.path.getsize(path):
+            return
+        with open(path, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as view:
+            position = 0
+            while position + RECORD.size <= len(view):
+                offset, _, size, codec = RECORD.unpack_from(view, position)
+                position += RECORD.size
+                if position + size > len(view):
+                    # Record cut short by a crash while it was written
+                    return
+                if offset >= start:
+                    if codec:
+                        yield offset, LoggedStream(path, position, size, STREAM_CODECS[codec])
+                    else:
+                        yield offset, pickle.loads(view[position:position + size])
+                position += size
+
+    def read(self, start: int = 0) -> Iterator[Tuple[int, Any]]:
+        """Records from the start offset, or from the oldest one kept."""
+        self.active.flush()
+        index = max(bisect.bisect_right(self.segments, start) - 1, 0)
+        for base in self.segments[index:]:
+            yield from self.records(base, start)
+
+    def expire(self, max_bytes: int = None, max_age: float = None, now: float = None):
+        """Delete the oldest segments while the log is larger than max_bytes,
+        or while they were last written more than max_age seconds ago.
+
+        The segment records are appended to is kept."""
+        now = now or time.time()
+        size = self.size() if max_bytes is not None else 0
+        while len(self.segments) > 1:
+            path = self.path(self.segments[0])
+            too_large = max_bytes is not None and size > max_bytes
+            too_old = max_age is not None and now - os.path.getmtime(path) > max_age
+            if not (too_large or too_old):
+                break
+            size -= os.path.getsize(path)
+            os.remove(path)
+            self.segments.pop(0)
+
+    def close(self):
+        self.active.close()
+
+
+class TopicLog:
+    """Logs of the topics, one directory per topic under the root directory.
+
+    Every value published to a topic gets the next offset of the topic,
+    starting at 0. Segments older than retention_seconds, or making a topic
+    log larger than retention_bytes, are deleted on start and whenever a
+    segment is closed."""
+
+    def __init__(self, root: str, segment_bytes: int = SEGMENT_BYTES,
+                 retention_bytes: int = None, retention_seconds: float = None):
+        self.root = root
+        self.segment_bytes = segment_bytes
+        self.retention_bytes = retention_bytes
+        self.retention_seconds = retention_seconds
+        os.makedirs(root, exist_ok=True)
+
+        self.logs: Dict[str, Log] = {}
+        for name in os.listdir(root):
+            if os.path.isdir(os.path.join(root, name)):
+                self.logs[unquote(name)] = Log(os.path.join(root, name), segment_bytes)
+        self.expire()
+
+    def log(self, topic: str) -> Log:
+        log = self.logs.get(topic)
+        if log is None:
+            log = self.logs[topic] = Log(os.path.join(self.root, quote(topic, safe="")), self.segment_bytes)
+        return log
+
+    def append(self, topic: str, value: Any) -> int:
+        """Append a value published to the topic, its offset."""
+        log = self.log(topic)
+        segments = len(log.segments)
+        offset = log.append(value)
+        if len(log.segments) != segments:
+            log.expire(self.retention_bytes, self.retention_seconds)
+        return offset
+
+    def append_stream(self, topic: str, codec: str, size: int, chunks: Iterator[bytes]) -> int:
+        """Append a value streamed to the topic from the chunks of its encoding, its offset."""
+        log = self.log(topic)
+        segments = len(log.segments)
+        offset = log.append_stream(codec, size, chunks)
+        if len(log.segments) != segments:
+            log.expire(self.retention_bytes, self.retention_seconds)
+        return offset
+
+    def read(self, topic: str, start: int = 0) -> Iterator[Tuple[int, Any]]:
+        """(offset, value) published to the topic from the start offset."""
+        log = self.logs.get(topic)
+        if log is None:
+            return iter(())
+        return log.read(start)
+
+    def topics(self):
+        return self.logs.keys()
+
+    def latest(self) -> Iterator[Tuple[str, Any]]:
+        """Last value logged of every topic."""
+        for topic, log in self.logs.items():
+            if log.next:
+                yield topic, log.last
+
+    def expire(self):
+        """Apply the retention to every topic."""
+        for log in self.logs.values():
+            log.expire(self.retention_bytes, self.retention_seconds)
+
+    def close(self):
+        for log in self.logs.values():
+            log.close()
@@ -0,0 +1,190 @@
+"""Topic trie of the Message Broker subscriptions and stored values."""
+from typing import Any, Dict, Iterator, Tuple
+
+# Wildcards of the subscriptions: one level, or every level left (none included)
+SINGLE_LEVEL = "+"
+MULTI_LEVEL = "#"
+
+
+def levels(topic: str) -> list:
+    """Levels of a topic, "/a/b" has the levels "", "a" and "b"."""
+    return topic.split("/")
+
+
+def is_pattern(topic: str) -> bool:
+    """Whether a subscription topic holds wildcards."""
+    return any(level in (SINGLE_LEVEL, MULTI_LEVEL) for level in levels(topic))
+
+
+def matches(pattern: str, topic: str) -> bool:
+    """Whether a subscription pattern matches a topic."""
+    path = levels(topic)
+    for depth, level in enumerate(levels(pattern)):
+        if level == MULTI_LEVEL:
+            return True
+        if depth == len(path) or level not in (SINGLE_LEVEL, path[depth]):
+            return False
+    return len(levels(pattern)) == len(path)
+
+
+def subscribed(subscription: str, topic: str) -> bool:
+    """Whether a subscription gets the publications to a topic, its subtopics included when it is no pattern."""
+    if not is_pattern(subscription):
+        subscription += "/" + MULTI_LEVEL
+    return matches(subscription, topic)
+
+
+class TopicNode:
+    """Level of the topic trie, with the subscribers and value of its topic."""
+
+    __slots__ = ("children", "subscribers", "topic", "value")
+
+    # Value of the topics nothing was published to
+    EMPTY = object()
+
+    def __init__(self):
+        self.children = {}
+        self.subscribers = {}
+        self.topic = None
+        self.value = TopicNode.EMPTY
+
+    def is_empty(self) -> bool:
+        return not (self.children or self.subscribers or self.value is not TopicNode.EMPTY)
+
+
+class TopicTrie:
+    """Subscriptions and last values of the topics, one trie level per topic level.
+
+    Subscription patterns match levels with + and every level left with #.
+    A subscription without wildcards also gets the publications to the
+    subtopics, as if it ended with /#. Finding the subscribers of a
+    publication walks the levels of its topic, plus the + and # branches
+    met on the way."""
+
+    def __init__(self):
+        self.root = TopicNode()
+
+    @staticmethod
+    def pattern(topic: str) -> list:
+        """Levels of the subscription pattern of a topic."""
+        if is_pattern(topic):
+            return levels(topic)
+        return levels(topic) + [MULTI_LEVEL]
+
+    def node(self, path: list, create: bool = False) -> TopicNode:
+        """Node at the end of the levels, None when missing and not created."""
+        node = self.root
+        for level in path:
+            child = node.children.get(level)
+            if child is None:
+                if not create:
+                    return None
+                child = node.children[level] = TopicNode()
+            node = child
+        return node
+
+    def prune(self, path: list):
+        """Remove the nodes left empty at the end of the levels."""
+        nodes = [self.root]
+        for level in path:
+            child = nodes[-1].children.get(level)
+            if child is None:
+                return
+            nodes.append(child)
+        for i in range(len(path), 0, -1):
+            if not nodes[i].is_empty():
+                break
+            del nodes[i - 1].children[path[i - 1]]
+
+    def subscribe(self, topic: str, subscriber, serializer):
+        """Add a subscriber to the topic, or to the topics matching the pattern."""
+        self.node(self.pattern(topic), create=True).subscribers[subscriber] = serializer
+
+    def unsubscribe(self, topic: str, subscriber):
+        """Remove a subscriber from the topic."""
+        path = self.pattern(topic)
+        node = self.node(path)
+        if node is not None and node.subscribers.pop(subscriber, None) is not None:
+            self.prune(path)
+
+    def subscribers(self, topic: str) -> Dict[Any, Any]:
+        """Subscribers of the topic, or of the pattern, and their serializer."""
+        node = self.node(self.pattern(topic))
+        return node.subscribers if node is not None else {}
+
+    def match(self, topic: str) -> Dict[Any, Any]:
+        """Subscribers of every subscription matching a publication to the topic.
+
+        A subscriber matching with several subscriptions is listed once."""
+        path = levels(topic)
+        found = {}
+        stack = [(self.root, 0)]
+        while stack:
+            node, depth = stack.pop()
+            wildcard = node.children.get(MULTI_LEVEL)
+            if wildcard is not None:
+                found.update(wildcard.subscribers)
+            if depth == len(path):
+                found.update(node.subscribers)
+                continue
+
+            child = node.children.get(path[depth])
+            if child is not None:
+                stack.append((child, depth + 1))
+            child = node.children.get(SINGLE_LEVEL)
+            if child is not None:
+                stack.append((child, depth + 1))
+        return found
+
+    def put(self, topic: str, value):
+        """Store the last value published to the topic."""
+        node = self.node(levels(topic), create=True)
+        node.topic = topic
+        node.value = value
+
+    def get(self, topic: str):
+        """Last value published to the topic, None when there is none."""
+        node = self.node(levels(topic))
+        if node is None or node.value is TopicNode.EMPTY:
+            return None
+        return node.value
+
+    def values(self, node: TopicNode = None) -> Iterator[Tuple[str, Any]]:
+        """Topics holding a value under the node, the whole trie by default, and their value."""
+        stack = [node or self.root]
+        while stack:
+            node = stack.pop()
+            if node.value is not TopicNode.EMPTY:
+                yield node.topic, node.value
+            stack.extend(node.children.values())
+
+    def retained(self, topic: str) -> Iterator[Tuple[str, Any]]:
+        """Topics holding a value the subscription pattern matches, and their value.
+
+        A topic without wildcards only retains its own value."""
+        if not is_pattern(topic):
+            value = self.get(topic)
+            if value is not None:
+                yield topic, value
+            return
+
+        path = levels(topic)
+        stack = [(self.root, 0)]
+        while stack:
+            node, depth = stack.pop()
+            if depth == len(path):
+                if node.value is not TopicNode.EMPTY:
+                    yield node.topic, node.value
+                continue
+
+            level = path[depth]
+            if level == MULTI_LEVEL:
+                yield from self.values(node)
+            elif level == SINGLE_LEVEL:
+                for key, child in node.children.items():
+                    if key not in (SINGLE_LEVEL, MULTI_LEVEL):
+                        stack.append((child, depth + 1))
+            else:
+                child = node.children.get(level)
+                if child is not None:
+                    stack.append((child, depth + 1))
@@ -0,0 +1,25 @@
+"""Test the broker forgets the connections closed."""
+import time
+
+from src.middleware import JSONQueue, PickleQueue
+
+
+def test_closed_connections_forgotten(broker):
+    sockets = len(broker.sockets)
+
+    for round in range(3):
+        queues = [JSONQueue(f"/churn/{i}") for i in range(20)] + [PickleQueue("/churn/+/x")]
+        time.sleep(0.2)
+        assert len(broker.list_subscriptions("/churn/0")) == 1
+        assert len(broker.sockets) == sockets + 21
+
+        for queue in queues:
+            queue.sock.close()
+        time.sleep(0.2)
+
+        assert len(broker.sockets) == sockets
+        assert broker.list_subscriptions("/churn/0") == []
+        assert broker.list_subscriptions("/churn/+/x") == []
+
+    # The trie nodes of the subscriptions are gone too
+    assert "churn" not in broker.topics.root.children[""].children
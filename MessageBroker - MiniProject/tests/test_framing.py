@@ -0,0 +1,71 @@
+"""Test the framing of the messages and the streaming of large values."""
+import time
+
+import pytest
+
+from src.framing import FrameDecoder, FrameTooLarge, STREAM_ID, chunk_frame, frame
+from src.middleware import JSONQueue, MiddlewareType, PickleQueue
+from src.outbox import SlowConsumerPolicy
+
+
+def test_decoder_partial_frames():
+    decoder = FrameDecoder()
+    data = frame(b"first") + frame(b"second") + chunk_frame(7, b"bytes")
+
+    decoder.feed(data[:3])
+    assert list(decoder.frames()) == []
+    decoder.feed(data[3:12])
+    assert list(decoder.frames()) == [(False, b"first")]
+    decoder.feed(data[12:])
+    frames = list(decoder.frames())
+    assert frames[0] == (False, b"second")
+    chunk, payload = frames[1]
+    assert chunk and STREAM_ID.unpack_from(payload) == (7,) and payload[STREAM_ID.size:] == b"bytes"
+    assert len(decoder) == 0
+
+
+def test_decoder_frame_too_large():
+    decoder = FrameDecoder(max_frame_bytes=8)
+    decoder.feed(frame(b"x" * 9))
+    with pytest.raises(FrameTooLarge):
+        list(decoder.frames())
+
+
+def test_stream_large_value(broker):
+    value = "x" * 300_000
+    consumer = JSONQueue("/stream/large", MiddlewareType.CONSUMER)
+    consumer.sock.settimeout(5)
+    producer = JSONQueue("/stream/large", MiddlewareType.PRODUCER, stream_threshold=1024)
+
+    producer.push(value)
+    producer.push(1)
+    assert consumer.pull() == ("/stream/large", value)
+    assert consumer.pull() == ("/stream/large", 1)
+
+    # Late subscribers get the last value streamed too
+    producer.push({"data": value})
+    assert consumer.pull() == ("/stream/large", {"data": value})
+    late = PickleQueue("/stream/large", MiddlewareType.CONSUMER)
+    late.sock.settimeout(5)
+    assert late.pull() == ("/stream/large", {"data": value})
+    assert broker.get_topic("/stream/large") == {"data": value}
+
+
+def test_stream_fed_as_outbox_drains(broker):
+    value = "y" * (40 * 64 * 1024)
+    producer = JSONQueue("/stream/fed", MiddlewareType.PRODUCER)
+    producer.push(value)
+    time.sleep(0.5)
+
+    # Chunks are queued as the subscriber reads, never more than its outbox takes
+    policy, max_pending = broker.policy, broker.max_pending
+    broker.policy, broker.max_pending = SlowConsumerPolicy.DISCONNECT, 4
+    try:
+        late = PickleQueue("/stream/fed", MiddlewareType.CONSUMER)
+        late.sock.settimeout(5)
+        assert late.pull() == ("/stream/fed", value)
+        assert not broker.feeds
+    finally:
+        broker.policy, broker.max_pending = policy, max_pending
+    for queue in (producer, late):
+        queue.sock.close()
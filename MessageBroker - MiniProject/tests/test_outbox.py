@@ -0,0 +1,60 @@
+"""Test the outbound buffers of the slow subscribers."""
+from src.outbox import Outbox
+
+
+class SlowConnection:
+    """Connection taking at most <window> bytes per send."""
+
+    def __init__(self, window):
+        self.window = window
+        self.received = b""
+
+    def send(self, data):
+        if not self.window:
+            raise BlockingIOError
+        data = bytes(data[:self.window])
+        self.window -= len(data)
+        self.received += data
+        return len(data)
+
+
+def test_partial_frames_finished_in_order():
+    outbox = Outbox()
+    outbox.append("/a", b"0123456789")
+    outbox.append("/b", b"abc")
+    conn = SlowConnection(4)
+
+    outbox.flush(conn)
+    assert len(outbox) == 2 and outbox.pending_bytes == 9
+    conn.window = 100
+    outbox.flush(conn)
+    assert conn.received == b"0123456789abc"
+    assert outbox.stats()["pending"] == 0 and outbox.sent == 2
+
+
+def test_drop_oldest_keeps_chunks_and_frame_being_sent():
+    outbox = Outbox(max_frames=3)
+    outbox.append("/a", b"first")
+    outbox.flush(SlowConnection(2))
+    outbox.append(None, b"chunk")
+    outbox.append("/a", b"second")
+
+    assert outbox.full()
+    assert outbox.drop_oldest()
+    assert [frame for _, frame, _ in outbox.frames] == [b"first", b"chunk"]
+    assert not outbox.drop_oldest()
+    assert outbox.stats()["dropped"] == 1
+
+
+def test_conflate_replaces_pending_frame_of_topic():
+    outbox = Outbox()
+    outbox.append("/a", b"1")
+    outbox.append("/b", b"2")
+    assert outbox.conflate("/a", b"3")
+    assert not outbox.conflate("/c", b"4")
+
+    conn = SlowConnection(100)
+    outbox.flush(conn)
+    assert conn.received == b"32"
+    assert outbox.conflated == 1
+    assert not outbox.conflate("/a", b"5")
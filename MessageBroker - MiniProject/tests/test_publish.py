@@ -0,0 +1,34 @@
+"""Test the fan-out of the publications."""
+import socket
+from unittest.mock import patch
+
+from src.broker import Serializer
+from src.outbox import Outbox
+
+
+def test_encode_once_per_serializer(broker):
+    pairs = [socket.socketpair() for _ in range(6)]
+    serializers = [Serializer.JSON, Serializer.PICKLE, Serializer.XML] * 2
+    for (subscriber, _), serializer in zip(pairs, serializers):
+        subscriber.setblocking(False)
+        broker.outboxes[subscriber] = Outbox()
+        broker.subscribe("/fanout", subscriber, serializer)
+
+    try:
+        with patch.object(broker, "encode", wraps=broker.encode) as encode:
+            broker.publish("/fanout/leaf", 42)
+
+        assert encode.call_count == 3
+        frames = []
+        for subscriber, peer in pairs:
+            assert broker.lag(subscriber)["sent"] == 1
+            peer.settimeout(5)
+            frames.append(peer.recv(4096))
+        assert frames[:3] == frames[3:]
+
+        assert broker.decode(frames[0][4:], Serializer.JSON) == {"action": "send", "topic": "/fanout/leaf", "value": 42}
+        assert broker.get_topic("/fanout/leaf") == 42
+    finally:
+        for subscriber, peer in pairs:
+            broker.disconnect(subscriber)
+            peer.close()
@@ -0,0 +1,35 @@
+"""Test publishing and pulling batches of values."""
+import pytest
+
+from src.middleware import JSONQueue, MiddlewareType, PickleQueue, XMLQueue
+
+
+@pytest.mark.parametrize("queue_type", [JSONQueue, XMLQueue, PickleQueue])
+def test_push_many_pull_many(broker, queue_type):
+    topic = f"/batch/{queue_type.__name__}"
+    consumer = JSONQueue(topic, MiddlewareType.CONSUMER)
+    producer = queue_type(topic, MiddlewareType.PRODUCER)
+    expected = [str(i) for i in range(6)] if queue_type is XMLQueue else list(range(6))
+
+    producer.push_many(range(5))
+    producer.push(5)
+
+    received = consumer.pull_many(3, timeout=5)
+    assert received == [(topic, value) for value in expected[:3]]
+    assert consumer.pull() == (topic, expected[3])
+
+    # The single value may arrive with the rest of the batch or after it
+    rest = consumer.pull_many(10, timeout=5)
+    if len(rest) == 1:
+        rest += consumer.pull_many(10, timeout=5)
+    assert rest == [(topic, expected[4]), (topic, expected[5])]
+    assert broker.get_topic(topic) == expected[5]
+
+    consumer.sock.close()
+    producer.sock.close()
+
+
+def test_pull_many_timeout(broker):
+    consumer = PickleQueue("/batch/empty", MiddlewareType.CONSUMER)
+    assert consumer.pull_many(10, timeout=0.1) == []
+    consumer.sock.close()
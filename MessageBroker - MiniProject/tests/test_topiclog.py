@@ -0,0 +1,172 @@
+"""Test the durable log of the topics and resuming from offsets."""
+import os
+import time
+
+import pytest
+
+from src.middleware import BrokerError, JSONQueue, MiddlewareType, PickleQueue, XMLQueue
+from src.topiclog import LoggedStream, TopicLog
+from src.topics import matches, subscribed
+
+
+def test_offsets_across_segments(tmp_path):
+    log = TopicLog(str(tmp_path), segment_bytes=100)
+    assert [log.append("/temp", i) for i in range(20)] == list(range(20))
+    assert log.append("/other", "x") == 0
+    assert len(log.log("/temp").segments) > 1
+
+    assert list(log.read("/temp", 15)) == [(i, i) for i in range(15, 20)]
+    assert list(log.read("/missing")) == []
+    log.close()
+
+    # Offsets go on after a restart, and the last values are kept
+    log = TopicLog(str(tmp_path), segment_bytes=100)
+    assert dict(log.latest()) == {"/temp": 19, "/other": "x"}
+    assert log.append("/temp", 20) == 20
+    assert [offset for offset, _ in log.read("/temp")] == list(range(21))
+
+
+def test_torn_record_truncated(tmp_path):
+    log = TopicLog(str(tmp_path))
+    for i in range(3):
+        log.append("/temp", i)
+    log.close()
+
+    # A crash cut the last record short, it is dropped before appending again
+    temp = log.log("/temp")
+    path = temp.path(temp.segments[-1])
+    os.truncate(path, os.path.getsize(path) - 3)
+    log = TopicLog(str(tmp_path))
+    assert log.append("/temp", 3) == 2
+    assert list(log.read("/temp")) == [(0, 0), (1, 1), (2, 3)]
+    log.close()
+
+
+def test_retention(tmp_path):
+    log = TopicLog(str(tmp_path), segment_bytes=100, retention_bytes=250)
+    for i in range(50):
+        log.append("/temp", i)
+    temp = log.log("/temp")
+    assert temp.size() <= 250 + 100
+    assert next(log.read("/temp"))[0] == temp.first > 0
+
+    # Segments last written too long ago are deleted, except the one appended to
+    log.retention_bytes = None
+    log.retention_seconds = 60
+    for base in temp.segments:
+        os.utime(temp.path(base), (time.time() - 120, time.time() - 120))
+    log.expire()
+    assert len(temp.segments) == 1
+    assert temp.append(50) == 50
+
+
+def test_matches():
+    assert matches("/a/+/c", "/a/b/c")
+    assert matches("/a/#", "/a/b/c")
+    assert not matches("/a/+", "/a/b/c")
+    assert not matches("/a/+/c/d", "/a/b/c")
+    assert subscribed("/a", "/a") and subscribed("/a", "/a/b")
+    assert not subscribed("/a", "/ab") and not subscribed("/a/+", "/a/b/c")
+
+
+def test_streamed_values_logged_in_chunks(tmp_path):
+    log = TopicLog(str(tmp_path), segment_bytes=100)
+    log.append("/big", "small")
+    assert log.append_stream("/big", "json", 7, iter([b'"abc', b'de"'])) == 1
+    log.append("/big", "after")
+
+    records = list(log.read("/big"))
+    assert [offset for offset, _ in records] == [0, 1, 2]
+    assert isinstance(records[1][1], LoggedStream) and records[1][1].load() == "abcde"
+    log.close()
+
+    # Streamed values stay in the log, not loaded, across restarts
+    log = TopicLog(str(tmp_path), segment_bytes=100)
+    log.append_stream("/big", "pickle", 4, iter([b"data"]))
+    log.close()
+    log = TopicLog(str(tmp_path), segment_bytes=100)
+    last = dict(log.latest())["/big"]
+    assert isinstance(last, LoggedStream) and list(last.chunks()) == [b"data"]
+
+
+def test_resume_from_offset(broker, tmp_path):
+    broker.log = TopicLog(str(tmp_path))
+    try:
+        consumer = JSONQueue("/log/temp", MiddlewareType.CONSUMER)
+        consumer.sock.settimeout(5)
+        producer = JSONQueue("/log/temp", MiddlewareType.PRODUCER)
+        producer.push(0)
+        producer.push_many([1, 2, 3])
+        producer.push(4)
+
+        assert consumer.pull() == ("/log/temp", 0)
+        assert consumer.pull() == ("/log/temp", 1)
+        assert consumer.offsets == {"/log/temp": 2}
+        consumer.sock.close()
+
+        resumed = XMLQueue("/log/temp", MiddlewareType.CONSUMER, from_offset=consumer.offsets["/log/temp"])
+        resumed.sock.settimeout(5)
+        assert resumed.pull_many(10, timeout=5) == [("/log/temp", str(i)) for i in range(2, 5)]
+        assert resumed.offsets == {"/log/temp": 5}
+
+        pattern = JSONQueue("/log/+", MiddlewareType.CONSUMER, from_offset=3)
+        pattern.sock.settimeout(5)
+        assert pattern.pull() == ("/log/temp", 3)
+        assert pattern.pull() == ("/log/temp", 4)
+
+        for queue in (producer, resumed, pattern):
+            queue.sock.close()
+    finally:
+        broker.log = None
+
+
+def test_resume_subtopics_and_offsets_per_topic(broker, tmp_path):
+    broker.log = TopicLog(str(tmp_path))
+    try:
+        producers = [JSONQueue(topic, MiddlewareType.PRODUCER) for topic in ("/resume", "/resume/sub", "/resumed")]
+        for producer in producers:
+            producer.push_many([0, 1, 2])
+        time.sleep(0.5)
+
+        # A topic resumes its subtopics too, as its subscription gets them
+        consumer = JSONQueue("/resume", MiddlewareType.CONSUMER, from_offset=1)
+        consumer.sock.settimeout(5)
+        assert sorted(consumer.pull() for _ in range(4)) == [("/resume", 1), ("/resume", 2),
+                                                              ("/resume/sub", 1), ("/resume/sub", 2)]
+        assert consumer.offsets == {"/resume": 3, "/resume/sub": 3}
+
+        # Each topic resumes from its own offset, the ones missing from their start
+        resumed = PickleQueue("/resume/#", MiddlewareType.CONSUMER, from_offset={"/resume": 2})
+        resumed.sock.settimeout(5)
+        assert sorted(resumed.pull() for _ in range(4)) == [("/resume", 2), ("/resume/sub", 0),
+                                                             ("/resume/sub", 1), ("/resume/sub", 2)]
+        xml = XMLQueue("/resume", MiddlewareType.CONSUMER, from_offset={"/resume/sub": 2, "/resume": 3})
+        xml.sock.settimeout(5)
+        assert xml.pull() == ("/resume/sub", "2")
+
+        # Streamed values are replayed as streams
+        streamer = JSONQueue("/resume/large", MiddlewareType.PRODUCER, stream_threshold=64)
+        streamer.push("x" * 1000)
+        time.sleep(0.5)
+        large = JSONQueue("/resume/large", MiddlewareType.CONSUMER, from_offset=0)
+        large.sock.settimeout(5)
+        assert large.pull() == ("/resume/large", "x" * 1000)
+        assert large.offsets == {"/resume/large": 1}
+
+        for queue in (*producers, consumer, resumed, xml, streamer, large):
+            queue.sock.close()
+    finally:
+        broker.log = None
+
+
+@pytest.mark.parametrize("offset", [-1, "-1", 1.5, True, {"/bad": -1}, {"/bad": "x"}])
+def test_bad_offset(broker, tmp_path, offset):
+    broker.log = TopicLog(str(tmp_path))
+    try:
+        consumer = PickleQueue("/bad", MiddlewareType.CONSUMER, from_offset=offset)
+        consumer.sock.settimeout(5)
+        with pytest.raises(BrokerError):
+            consumer.pull()
+        consumer.sock.close()
+    finally:
+        broker.log = None
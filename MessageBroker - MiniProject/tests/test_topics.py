@@ -0,0 +1,52 @@
+"""Test the topic trie of the broker."""
+from src.broker import Serializer
+from src.topics import TopicTrie
+
+
+def test_match():
+    trie = TopicTrie()
+    trie.subscribe("/sensors", "plain", Serializer.JSON)
+    trie.subscribe("/sensors/+/temperature", "single", Serializer.XML)
+    trie.subscribe("/sensors/#", "multi", Serializer.PICKLE)
+    trie.subscribe("/+", "root", Serializer.JSON)
+
+    # Plain subscriptions also get the subtopics, like /sensors/#
+    assert trie.match("/sensors/kitchen/temperature") == {
+        "plain": Serializer.JSON, "single": Serializer.XML, "multi": Serializer.PICKLE,
+    }
+    assert trie.match("/sensors/kitchen/humidity") == {"plain": Serializer.JSON, "multi": Serializer.PICKLE}
+    assert trie.match("/sensors") == {"plain": Serializer.JSON, "multi": Serializer.PICKLE, "root": Serializer.JSON}
+    assert trie.match("/other/temperature") == {}
+
+    assert trie.subscribers("/sensors") == {"plain": Serializer.JSON, "multi": Serializer.PICKLE}
+
+
+def test_unsubscribe_prunes():
+    trie = TopicTrie()
+    trie.subscribe("/a/b/c", "sub", Serializer.JSON)
+    trie.subscribe("/a/+/c", "sub", Serializer.JSON)
+    trie.put("/a", 1)
+
+    trie.unsubscribe("/a/b/c", "sub")
+    trie.unsubscribe("/a/+/c", "sub")
+    trie.unsubscribe("/missing", "sub")
+
+    assert list(trie.root.children[""].children) == ["a"]
+    assert trie.root.children[""].children["a"].children == {}
+
+
+def test_retained():
+    trie = TopicTrie()
+    for topic, value in (("/home/kitchen/temperature", 20), ("/home/room/temperature", 18),
+                         ("/home/room/humidity", 40), ("/home", "house")):
+        trie.put(topic, value)
+
+    assert sorted(trie.retained("/home/+/temperature")) == [
+        ("/home/kitchen/temperature", 20), ("/home/room/temperature", 18),
+    ]
+    assert len(list(trie.retained("/home/#"))) == 4
+
+    # Topics without wildcards only retain their own value
+    assert list(trie.retained("/home")) == [("/home", "house")]
+    assert list(trie.retained("/home/room")) == []
+    assert trie.get("/home/room") is None